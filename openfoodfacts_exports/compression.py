@@ -0,0 +1,129 @@
+"""Compressed output with compression running in a thread pool."""
+
+import collections
+import gzip
+import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Literal
+
+logger = logging.getLogger(__name__)
+
+Compression = Literal["gzip"]
+
+# Default size of the uncompressed blocks
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def get_block_compressor(
+    compression: Compression, level: int | None = None
+) -> Callable[[bytes], bytes]:
+    """Return a function compressing a block of data into an independent
+    gzip member.
+
+    Args:
+        compression: The compression format, only `gzip` is supported.
+        level: The compression level, defaults to 9 (as `gzip.open`).
+
+    Returns:
+        The compression function, safe to call from several threads.
+    """
+    if compression == "gzip":
+        gzip_level = 9 if level is None else level
+
+        def compress_gzip(data: bytes) -> bytes:
+            # mtime=0 makes the output reproducible
+            return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+        return compress_gzip
+
+    raise ValueError(f"Unsupported compression: {compression}")
+
+
+class ParallelCompressedWriter:
+    """Write a compressed file, compressing blocks of data in a thread pool.
+
+    Written data is buffered into blocks of about `block_size` bytes
+    (writes are never split). Each block is compressed independently (as a
+    gzip member) and blocks are written in order: the output is a valid
+    multi-member gzip file, readable by standard tools.
+
+    zlib releases the GIL while compressing, so blocks are compressed in
+    parallel with each other and with the producer.
+    """
+
+    def __init__(
+        self,
+        output_path: Path,
+        compression: Compression = "gzip",
+        level: int | None = None,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        num_threads: int | None = None,
+    ):
+        """Create a writer.
+
+        Args:
+            output_path: The path of the compressed file.
+            compression: The compression format, only `gzip` is supported.
+            level: The compression level, defaults to 9 (as `gzip.open`).
+            block_size: The size of uncompressed blocks, defaults to 4 MiB.
+            num_threads: The number of compression threads, defaults to the
+                number of CPUs.
+        """
+        self.compress = get_block_compressor(compression, level)
+        self.block_size = block_size
+        num_threads = num_threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=num_threads)
+        # Bound the number of blocks held in memory
+        self._max_pending = num_threads * 2
+        self._pending: collections.deque[Future[bytes]] = collections.deque()
+        self._buffer: list[bytes] = []
+        self._buffer_size = 0
+        self._fp = output_path.open("wb")
+        # Statistics
+        self.uncompressed_size = 0
+        self.compressed_size = 0
+
+    def write(self, data: bytes) -> None:
+        """Write data to the file."""
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self.block_size:
+            self._submit_block()
+
+    def _submit_block(self) -> None:
+        if not self._buffer:
+            return
+        block = b"".join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+        self.uncompressed_size += len(block)
+        self._pending.append(self._executor.submit(self.compress, block))
+        while self._pending and (
+            len(self._pending) >= self._max_pending or self._pending[0].done()
+        ):
+            self._write_next_block()
+
+    def _write_next_block(self) -> None:
+        compressed = self._pending.popleft().result()
+        self._fp.write(compressed)
+        self.compressed_size += len(compressed)
+
+    def close(self) -> None:
+        """Compress and write the remaining data, and close the file."""
+        if self._fp.closed:
+            return
+        try:
+            self._submit_block()
+            while self._pending:
+                self._write_next_block()
+        finally:
+            self._executor.shutdown(cancel_futures=True)
+            self._fp.close()
+
+    def __enter__(self) -> "ParallelCompressedWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
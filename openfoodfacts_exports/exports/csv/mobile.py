@@ -4,9 +4,16 @@ import tempfile
 from pathlib import Path
 
 import duckdb
+import pyarrow.parquet as pq
 
 from openfoodfacts_exports import settings
-from openfoodfacts_exports.utils import get_minio_client
+from openfoodfacts_exports.exports.export_state import (
+    save_fingerprint,
+    should_skip_export,
+)
+from openfoodfacts_exports.exports.manifest import ExportRecorder, RowCounts
+from openfoodfacts_exports.utils import get_minio_client, get_parquet_columns_sha256
+from openfoodfacts_exports.workers.redis import redis_conn
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +21,17 @@ MOBILE_APP_DUMP_DATASET_PATH = (
     settings.DATASET_DIR / "openfoodfacts-mobile-dump-products.tsv.gz"
 )
 
+# Columns of the Parquet dump read by `MOBILE_APP_DUMP_SQL_QUERY`
+MOBILE_APP_DUMP_COLUMNS = [
+    "code",
+    "product_name",
+    "quantity",
+    "brands",
+    "nutriscore_grade",
+    "nova_group",
+    "environmental_score_grade",
+]
+
 MOBILE_APP_DUMP_SQL_QUERY = r"""
 SET threads to 4;
 SET preserve_insertion_order = false;
@@ -52,20 +70,39 @@ def generate_mobile_app_dump(parquet_path: Path, output_path: Path) -> None:
 def generate_push_mobile_app_dump(parquet_path: Path) -> None:
     """Generate mobile app dump from a Parquet dump and push it to AWS S3.
 
+    The generation is skipped if the columns of the Parquet dump used by the
+    mobile app dump did not change since the last successful run.
+
     Args:
         parquet_path (Path): Path to the parquet file to generate the mobile app dump
         from.
     """
-    generate_mobile_app_dump(parquet_path, MOBILE_APP_DUMP_DATASET_PATH)
-
-    if settings.ENABLE_S3_PUSH:
-        logger.info("Uploading mobile app dump to S3")
-        client = get_minio_client()
-        client.fput_object(
-            settings.AWS_S3_DATASET_BUCKET,
-            "openfoodfacts-mobile-dump-products.tsv.gz",
-            file_path=str(MOBILE_APP_DUMP_DATASET_PATH),
-        )
-        logger.info("Mobile app dump uploaded to S3")
-    else:
-        logger.info("S3 push is disabled, skipping upload of mobile app dump")
+    columns_sha256 = get_parquet_columns_sha256(parquet_path, MOBILE_APP_DUMP_COLUMNS)
+    if should_skip_export(
+        redis_conn, "mobile-dump", columns_sha256, [MOBILE_APP_DUMP_DATASET_PATH]
+    ):
+        return
+
+    recorder = ExportRecorder("mobile-dump")
+    recorder.add_input(parquet_path)
+    with recorder.stage("generate"):
+        generate_mobile_app_dump(parquet_path, MOBILE_APP_DUMP_DATASET_PATH)
+    # All the products of the Parquet file are exported
+    row_count = pq.ParquetFile(parquet_path).metadata.num_rows
+    recorder.set_row_counts(RowCounts(rows_in=row_count, rows_out=row_count))
+    recorder.add_artifact(MOBILE_APP_DUMP_DATASET_PATH)
+
+    with recorder.stage("push"):
+        if settings.ENABLE_S3_PUSH:
+            logger.info("Uploading mobile app dump to S3")
+            client = get_minio_client()
+            client.fput_object(
+                settings.AWS_S3_DATASET_BUCKET,
+                "openfoodfacts-mobile-dump-products.tsv.gz",
+                file_path=str(MOBILE_APP_DUMP_DATASET_PATH),
+            )
+            logger.info("Mobile app dump uploaded to S3")
+        else:
+            logger.info("S3 push is disabled, skipping upload of mobile app dump")
+    recorder.finish()
+    save_fingerprint("mobile-dump", columns_sha256, connection=redis_conn)
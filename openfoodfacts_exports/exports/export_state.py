@@ -0,0 +1,99 @@
+"""State of the last successful run of each export.
+
+After a successful export, the fingerprint of its source (the ETags of the
+downloaded dumps, or a checksum of the columns read from a Parquet file) is
+saved in Redis. The next run is skipped if its source has the same
+fingerprint, and its outputs still exist.
+
+The number of skipped runs of each export is counted in Redis
+(`SKIPPED_EXPORTS_KEY`).
+"""
+
+import logging
+from pathlib import Path
+
+from openfoodfacts.utils import get_file_etag
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+EXPORT_STATE_KEY_PREFIX = "openfoodfacts_exports:export_state:"
+SKIPPED_EXPORTS_KEY = "openfoodfacts_exports:skipped_exports"
+
+
+def get_source_fingerprint(paths: list[Path]) -> str | None:
+    """Return the fingerprint of downloaded dumps, made of their ETags, or
+    None if the ETag of a dump is unknown."""
+    etags = []
+    for path in paths:
+        etag = get_file_etag(path)
+        if not etag:
+            return None
+        etags.append(etag)
+    return ",".join(etags)
+
+
+def get_saved_fingerprint(connection: Redis, export_name: str) -> str | None:
+    """Return the source fingerprint of the last successful run of an
+    export."""
+    value = connection.get(f"{EXPORT_STATE_KEY_PREFIX}{export_name}")
+    return None if value is None else value.decode("utf-8")  # type: ignore
+
+
+def save_fingerprint(
+    export_name: str, fingerprint: str, connection: Redis | None = None
+) -> None:
+    """Save the source fingerprint of a successful run of an export.
+
+    Args:
+        export_name: The name of the export (ex: `parquet-off`).
+        fingerprint: The fingerprint of the source of the run.
+        connection: The Redis connection, defaults to the connection of the
+            workers.
+    """
+    if connection is None:
+        from openfoodfacts_exports.workers.redis import redis_conn
+
+        connection = redis_conn
+    connection.set(f"{EXPORT_STATE_KEY_PREFIX}{export_name}", fingerprint)
+    logger.info("Saved source fingerprint of %s: %s", export_name, fingerprint)
+
+
+def should_skip_export(
+    connection: Redis,
+    export_name: str,
+    fingerprint: str | None,
+    output_paths: list[Path],
+) -> bool:
+    """Return True if the source of an export did not change since its last
+    successful run and its outputs exist, counting the skipped run.
+
+    Args:
+        connection: The Redis connection.
+        export_name: The name of the export (ex: `parquet-off`).
+        fingerprint: The fingerprint of the source, the export is never
+            skipped if it is None.
+        output_paths: The paths of the outputs of the export.
+    """
+    if fingerprint is None or fingerprint != get_saved_fingerprint(
+        connection, export_name
+    ):
+        return False
+    missing_paths = [path for path in output_paths if not path.exists()]
+    if missing_paths:
+        logger.info(
+            "Source of %s unchanged, but outputs are missing: %s",
+            export_name,
+            missing_paths,
+        )
+        return False
+
+    skipped_runs = connection.hincrby(SKIPPED_EXPORTS_KEY, export_name)
+    logger.info(
+        "Source of %s unchanged since the last run (%s), skipping it "
+        "(%d runs skipped so far)",
+        export_name,
+        fingerprint,
+        skipped_runs,
+    )
+    return True
@@ -21,20 +21,28 @@ Revision metadata (``timestamp``, ``product_type``, ``comment``) is
 denormalised onto every row, so the dump can be consumed without any join.
 
 This module is intentionally pure and offline: it does not read from S3, the
-Redis stream or the API. Those integrations (live capture and backlog
-backfill) are wired separately on top of these functions.
+Redis stream or the API. The backlog backfill (`historical_events_backfill.py`,
+run by the `build-historical-events` command) and the live capture of the
+update listener (`tasks/event_capture.py`) are built on top of these
+functions.
 """
 
+import datetime
 import enum
-import gzip
+import functools
 import logging
 from pathlib import Path
-from typing import Any, Iterable
+from typing import Any, Callable, Iterable, NamedTuple
 
 import orjson
 from openfoodfacts.types import JSONType
 from pydantic import BaseModel
 
+from openfoodfacts_exports.compression import (
+    DEFAULT_BLOCK_SIZE,
+    ParallelCompressedWriter,
+)
+
 logger = logging.getLogger(__name__)
 
 
@@ -45,6 +53,10 @@ class ChangeAction(enum.StrEnum):
     DELETE = "delete"
 
 
+# Operation name -> ChangeAction, to avoid an enum lookup per operation
+_CHANGE_ACTIONS = {action.value: action for action in ChangeAction}
+
+
 class FieldChange(BaseModel):
     """A single field change extracted from a revision diff."""
 
@@ -52,6 +64,14 @@ class FieldChange(BaseModel):
     action: ChangeAction
 
 
+class RawFieldChange(NamedTuple):
+    """A single field change extracted from a revision diff, without
+    validation (see :func:`flatten_diffs_raw`)."""
+
+    field: str
+    action: ChangeAction
+
+
 class RevisionInfo(BaseModel):
     """Metadata about a single product revision.
 
@@ -71,19 +91,11 @@ class RevisionInfo(BaseModel):
         return f"{self.code}_{self.rev_id}"
 
 
-def flatten_diffs(diffs: JSONType | None) -> list[FieldChange]:
+def flatten_diffs_raw(diffs: JSONType | None) -> list[RawFieldChange]:
     """Flatten a Product Opener revision diff into a list of field changes.
 
-    Product Opener groups changes by category (``fields``, ``nutriments``,
-    ``packagings``, ...) and then by operation (``add`` / ``change`` /
-    ``delete``)::
-
-        {"fields": {"change": ["brands"], "add": ["labels"]},
-         "nutriments": {"change": ["energy"]}}
-
-    We deliberately drop the category split to keep the output flat, and
-    return one :class:`FieldChange` per (field, action) pair. Duplicate pairs
-    are collapsed, and unknown operations are ignored.
+    This is the fast path of :func:`flatten_diffs`: changes are returned as
+    plain named tuples, no model is validated.
 
     Args:
         diffs: The revision diff, or ``None`` when unavailable.
@@ -94,14 +106,15 @@ def flatten_diffs(diffs: JSONType | None) -> list[FieldChange]:
     if not diffs:
         return []
 
-    changes: list[FieldChange] = []
-    seen: set[tuple[str, str]] = set()
+    changes: list[RawFieldChange] = []
+    seen: set[tuple[str, ChangeAction]] = set()
     for category_value in diffs.values():
         if not isinstance(category_value, dict):
             continue
-        for action, fields in category_value.items():
-            if action not in ChangeAction:
-                logger.warning(f"Unknown action: {action}")
+        for action_name, fields in category_value.items():
+            action = _CHANGE_ACTIONS.get(action_name)
+            if action is None:
+                logger.warning(f"Unknown action: {action_name}")
                 continue
             if not fields:
                 logger.warning(f"Unexpected empty fields: {category_value}")
@@ -110,10 +123,83 @@ def flatten_diffs(diffs: JSONType | None) -> list[FieldChange]:
                 key = (field, action)
                 if key not in seen:
                     seen.add(key)
-                    changes.append(FieldChange(field=field, action=action))
+                    changes.append(RawFieldChange(field, action))
     return changes
 
 
+def flatten_diffs(diffs: JSONType | None) -> list[FieldChange]:
+    """Flatten a Product Opener revision diff into a list of field changes.
+
+    Product Opener groups changes by category (``fields``, ``nutriments``,
+    ``packagings``, ...) and then by operation (``add`` / ``change`` /
+    ``delete``)::
+
+        {"fields": {"change": ["brands"], "add": ["labels"]},
+         "nutriments": {"change": ["energy"]}}
+
+    We deliberately drop the category split to keep the output flat, and
+    return one :class:`FieldChange` per (field, action) pair. Duplicate pairs
+    are collapsed, and unknown operations are ignored.
+
+    Use :func:`flatten_diffs_raw` when processing large diff streams, it
+    skips model creation.
+
+    Args:
+        diffs: The revision diff, or ``None`` when unavailable.
+
+    Returns:
+        The flattened list of field changes, in a deterministic order.
+    """
+    return [
+        FieldChange(field=field, action=action)
+        for field, action in flatten_diffs_raw(diffs)
+    ]
+
+
+# Maximum number of compiled field paths kept in cache. Diffs mostly involve a
+# few hundred distinct field paths.
+FIELD_PATH_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=FIELD_PATH_CACHE_SIZE)
+def compile_field_path(field: str) -> Callable[[Any], Any]:
+    """Compile a (possibly dotted) field path into a getter.
+
+    The getter returns the value at this path in a product revision, or
+    ``None`` if the path is missing. Getters are cached, so that the path is
+    only split once.
+    """
+    parts = tuple(field.split("."))
+
+    if len(parts) == 1:
+        (key,) = parts
+
+        def get(product: Any) -> Any:
+            return product.get(key) if isinstance(product, dict) else None
+
+    elif len(parts) == 2:
+        first, second = parts
+
+        def get(product: Any) -> Any:
+            if isinstance(product, dict):
+                value = product.get(first)
+                if isinstance(value, dict):
+                    return value.get(second)
+            return None
+
+    else:
+
+        def get(product: Any) -> Any:
+            value = product
+            for part in parts:
+                if not isinstance(value, dict):
+                    return None
+                value = value.get(part)
+            return value
+
+    return get
+
+
 def resolve_field_value(product: JSONType | None, field: str) -> Any:
     """Look up a (possibly dotted) field path in a product revision.
 
@@ -132,14 +218,80 @@ def resolve_field_value(product: JSONType | None, field: str) -> Any:
     """
     if product is None:
         return None
+    return compile_field_path(field)(product)
+
+
+# Fields that change at every revision, and are therefore not reported when
+# diffs are derived from two revisions.
+DIFF_IGNORED_FIELDS = frozenset(
+    {
+        "rev",
+        "last_modified_t",
+        "last_modified_by",
+        "last_updated_t",
+        "last_editor",
+        "last_edit_dates_tags",
+        "editors_tags",
+    }
+)
+
+# Fields whose sub-keys are compared one by one when diffs are derived from
+# two revisions (reported as ``{field}.{key}``).
+DIFF_NESTED_FIELDS = ("nutriments",)
+
+
+def compute_revision_diffs(
+    previous_product: JSONType | None, current_product: JSONType
+) -> JSONType:
+    """Derive a revision diff by comparing two consecutive revisions.
+
+    Stored revisions don't include the diff published by Product Opener in
+    the update stream. This builds an equivalent diff, in the same format
+    (see :func:`flatten_diffs`), from the revisions themselves: top-level
+    fields go in the ``fields`` category, and the sub-keys of
+    :data:`DIFF_NESTED_FIELDS` in a category named after the field, as dotted
+    paths (``nutriments.energy_100g``). Bookkeeping fields
+    (:data:`DIFF_IGNORED_FIELDS`) are ignored.
 
-    value: Any = product
-    for part in field.split("."):
-        if isinstance(value, dict) and part in value:
-            value = value[part]
-        else:
-            return None
-    return value
+    Args:
+        previous_product: The previous revision, or ``None`` if the product
+            was created by the current revision.
+        current_product: The current revision.
+
+    Returns:
+        The revision diff, without empty operations.
+    """
+    previous_product = previous_product or {}
+    diffs: JSONType = {}
+
+    def compare(category: str, previous: dict, current: dict, prefix: str = ""):
+        operations: dict[str, list[str]] = {}
+        for key, value in current.items():
+            if key in DIFF_IGNORED_FIELDS or (not prefix and key in DIFF_NESTED_FIELDS):
+                continue
+            if key not in previous:
+                operations.setdefault(ChangeAction.ADD, []).append(prefix + key)
+            elif previous[key] != value:
+                operations.setdefault(ChangeAction.CHANGE, []).append(prefix + key)
+        for key in previous:
+            if key in DIFF_IGNORED_FIELDS or (not prefix and key in DIFF_NESTED_FIELDS):
+                continue
+            if key not in current:
+                operations.setdefault(ChangeAction.DELETE, []).append(prefix + key)
+        if operations:
+            diffs[category] = operations
+
+    compare("fields", previous_product, current_product)
+    for field in DIFF_NESTED_FIELDS:
+        previous_value = previous_product.get(field)
+        current_value = current_product.get(field)
+        compare(
+            field,
+            previous_value if isinstance(previous_value, dict) else {},
+            current_value if isinstance(current_value, dict) else {},
+            prefix=f"{field}.",
+        )
+    return diffs
 
 
 def generate_events(
@@ -164,43 +316,67 @@ def generate_events(
     Returns:
         One row per changed field, ready to be serialised as JSONL.
     """
+    # Revision metadata, shared by all the rows of the revision
+    revision_fields = {
+        "id": revision.id,
+        "code": revision.code,
+        "rev_id": revision.rev_id,
+        "timestamp": revision.timestamp,
+        "product_type": revision.product_type,
+        "comment": revision.comment,
+    }
     events: list[JSONType] = []
-    for change in flatten_diffs(diffs):
-        previous_value = (
-            None
-            if change.action == ChangeAction.ADD
-            else resolve_field_value(previous_product, change.field)
-        )
-        current_value = (
-            None
-            if change.action == ChangeAction.DELETE
-            else resolve_field_value(current_product, change.field)
-        )
+    # Fields are resolved with cached getters (see `compile_field_path`)
+    for field, action in flatten_diffs_raw(diffs):
+        get_value = compile_field_path(field)
         events.append(
             {
-                "id": revision.id,
-                "code": revision.code,
-                "rev_id": revision.rev_id,
-                "timestamp": revision.timestamp,
-                "product_type": revision.product_type,
-                "comment": revision.comment,
-                "field": change.field,
-                "previous": previous_value,
-                "current": current_value,
-                "action": change.action,
+                **revision_fields,
+                "field": field,
+                "previous": (
+                    None if action is ChangeAction.ADD else get_value(previous_product)
+                ),
+                "current": (
+                    None
+                    if action is ChangeAction.DELETE
+                    else get_value(current_product)
+                ),
+                "action": action,
             }
         )
     return events
 
 
-def write_events_jsonl_gz(events: Iterable[JSONType], output_path: Path) -> None:
+def get_month_partition(timestamp: int) -> str:
+    """Return the monthly partition (``YYYY-MM``) of an event timestamp."""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.UTC).strftime("%Y-%m")
+
+
+def write_events_jsonl_gz(
+    events: Iterable[JSONType],
+    output_path: Path,
+    compression_level: int = 9,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    num_threads: int | None = None,
+) -> None:
     """Write event rows to a gzipped JSONL file.
 
+    Blocks of rows are compressed in a thread pool, the output is a
+    multi-member gzip file (see :class:`ParallelCompressedWriter`).
+
     Args:
         events: The event rows to write.
         output_path: The destination ``.jsonl.gz`` file.
+        compression_level: The gzip compression level, defaults to 9.
+        block_size: The size of uncompressed blocks, defaults to 4 MiB.
+        num_threads: The number of compression threads, defaults to the
+            number of CPUs.
     """
-    with gzip.open(output_path, "wb") as fp:
+    with ParallelCompressedWriter(
+        output_path,
+        level=compression_level,
+        block_size=block_size,
+        num_threads=num_threads,
+    ) as writer:
         for event in events:
-            fp.write(orjson.dumps(event))
-            fp.write(b"\n")
+            writer.write(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE))
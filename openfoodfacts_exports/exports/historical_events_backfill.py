@@ -0,0 +1,187 @@
+"""Build the historical events dump from the stored product revisions.
+
+Every revision of a product is paired with the previous stored revision, and
+the events are generated from a diff derived from the two revisions (see
+`compute_revision_diffs`). The first stored revision of a product has no
+predecessor to compare with, and yields no event.
+"""
+
+import gzip
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+import orjson
+from openfoodfacts.types import JSONType
+
+from openfoodfacts_exports.exports.historical_events import (
+    RevisionInfo,
+    compute_revision_diffs,
+    generate_events,
+)
+from openfoodfacts_exports.tasks.revision_store import RevisionStore
+from openfoodfacts_exports.utils import imap_ordered
+
+logger = logging.getLogger(__name__)
+
+# Revision store of the worker processes, set by `_init_worker`
+_worker_store: RevisionStore | None = None
+
+
+def _init_worker(store: RevisionStore) -> None:
+    global _worker_store
+    _worker_store = store
+
+
+def iter_product_events(
+    store: RevisionStore, barcode: str, rev_ids: list[int]
+) -> Iterator[JSONType]:
+    """Generate the events of all the stored revisions of a product.
+
+    At most two revisions (the current one and its predecessor) are kept in
+    memory at a time.
+
+    Args:
+        store: The revision store.
+        barcode: The barcode of the product.
+        rev_ids: The revision IDs of the product, in increasing order.
+
+    Yields:
+        The event rows, in revision order.
+    """
+    previous_product = None
+    for rev_id in rev_ids:
+        current_product = store.get_revision(barcode, rev_id)
+        if current_product is None:
+            logger.warning("Revision %s of product %s not found", rev_id, barcode)
+            continue
+        if previous_product is not None:
+            revision = RevisionInfo(
+                code=barcode,
+                rev_id=rev_id,
+                timestamp=current_product.get("last_modified_t") or 0,
+                product_type=current_product.get("product_type"),
+            )
+            yield from generate_events(
+                revision,
+                compute_revision_diffs(previous_product, current_product),
+                previous_product,
+                current_product,
+            )
+        previous_product = current_product
+
+
+def build_events_block(
+    products: list[tuple[str, list[int]]],
+    compression_level: int = 9,
+    store: RevisionStore | None = None,
+) -> tuple[bytes, int, int]:
+    """Generate the events of a block of products.
+
+    Args:
+        products: (barcode, revision IDs) tuples.
+        compression_level: The gzip compression level of the output.
+        store: The revision store, defaults to the store of the worker
+            process.
+
+    Returns:
+        The events as a gzip member of JSONL lines, the number of events and
+        the number of revisions read.
+    """
+    store = store or _worker_store
+    if store is None:
+        raise RuntimeError("No revision store available")
+    lines = []
+    revision_count = 0
+    for barcode, rev_ids in products:
+        revision_count += len(rev_ids)
+        for event in iter_product_events(store, barcode, rev_ids):
+            lines.append(orjson.dumps(event))
+    lines.append(b"")
+    output = gzip.compress(b"\n".join(lines), compresslevel=compression_level, mtime=0)
+    return output, len(lines) - 1, revision_count
+
+
+def _iter_product_blocks(
+    store: RevisionStore, block_size: int
+) -> Iterator[list[tuple[str, list[int]]]]:
+    block = []
+    for product in store.iter_products():
+        block.append(product)
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def build_historical_events(
+    store: RevisionStore,
+    output_path: Path,
+    num_processes: int | None = None,
+    block_size: int = 100,
+    compression_level: int = 9,
+) -> int:
+    """Generate the historical events of all products of a revision store,
+    and write them to a gzipped JSONL file.
+
+    Products are split into blocks, processed in a process pool and written
+    in the store order. The output is a valid multi-member gzip file, with
+    one member per block.
+
+    Args:
+        store: The revision store.
+        output_path: The output `.jsonl.gz` file.
+        num_processes: The number of worker processes, defaults to the number
+            of CPUs.
+        block_size: The number of products per block, defaults to 100.
+        compression_level: The gzip compression level, defaults to 9.
+
+    Returns:
+        The number of events written.
+    """
+    num_processes = num_processes or os.cpu_count() or 1
+    logger.info(
+        "Building historical events to %s with %d processes",
+        output_path,
+        num_processes,
+    )
+    start_time = time.monotonic()
+    event_count = 0
+    revision_count = 0
+    product_count = 0
+    tmp_output_path = output_path.with_name(f"{output_path.name}.tmp")
+
+    def iter_tasks() -> Iterator[tuple[list[tuple[str, list[int]]], int]]:
+        nonlocal product_count
+        for block in _iter_product_blocks(store, block_size):
+            product_count += len(block)
+            if product_count % 100_000 < len(block):
+                logger.info("%d products submitted", product_count)
+            yield block, compression_level
+
+    with tmp_output_path.open("wb") as output_fp:
+        for output, block_event_count, block_revision_count in imap_ordered(
+            build_events_block,
+            iter_tasks(),
+            num_processes,
+            initializer=_init_worker,
+            initargs=(store,),
+        ):
+            output_fp.write(output)
+            event_count += block_event_count
+            revision_count += block_revision_count
+
+    tmp_output_path.replace(output_path)
+    elapsed = time.monotonic() - start_time
+    logger.info(
+        "%d events generated from %d revisions of %d products in %.1fs (%.0f events/s)",
+        event_count,
+        revision_count,
+        product_count,
+        elapsed,
+        event_count / elapsed if elapsed else 0.0,
+    )
+    return event_count
@@ -0,0 +1,313 @@
+"""Incremental store of historical events.
+
+Revisions can be delivered several times by the update stream, so the same
+events can be generated more than once. The store appends events to
+month-partitioned files, and keeps an index of the revisions already stored
+in each partition, to skip duplicates::
+
+    {root}/month=2024-01/events.jsonl.gz  # multi-member gzip, one per append
+    {root}/month=2024-01/revisions.idx    # 8-byte revision keys
+    {root}/month=2024-01/commit.json      # sizes of the files after the last
+                                          # complete append
+
+If the process is killed during an append, the files may end with an
+incomplete gzip member (or index entry), that would make the whole partition
+unreadable. They are truncated to the sizes of the last complete append when
+the partition is opened.
+
+A revision key is a 64-bit hash of `{code}_{rev_id}`: the index of a
+partition takes 8 bytes per revision, and is loaded in memory as a set for
+O(1) lookups. With 10M revisions in a partition, the probability of a hash
+collision (that would drop the events of a revision) is about 3e-6.
+"""
+
+import array
+import collections
+import gzip
+import hashlib
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import orjson
+from openfoodfacts.types import JSONType
+from pydantic import BaseModel
+
+from openfoodfacts_exports.compression import ParallelCompressedWriter
+from openfoodfacts_exports.exports.historical_events import get_month_partition
+
+logger = logging.getLogger(__name__)
+
+EVENTS_FILE_NAME = "events.jsonl.gz"
+INDEX_FILE_NAME = "revisions.idx"
+COMMIT_FILE_NAME = "commit.json"
+
+
+def get_revision_key(code: str, rev_id: int) -> int:
+    """Return the 64-bit key of a revision in the index."""
+    return int.from_bytes(
+        hashlib.blake2b(f"{code}_{rev_id}".encode("utf-8"), digest_size=8).digest(),
+        "little",
+    )
+
+
+def _keys_to_bytes(keys: Iterable[int]) -> bytes:
+    data = array.array("Q", keys)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data.tobytes()
+
+
+def _keys_from_bytes(content: bytes) -> array.array:
+    data = array.array("Q")
+    data.frombytes(content)
+    if sys.byteorder == "big":
+        data.byteswap()
+    return data
+
+
+class PartitionCommit(BaseModel):
+    """Sizes of the files of a partition after the last complete append."""
+
+    events_size: int
+    index_size: int
+
+
+class CompactionStats(BaseModel):
+    """Result of the compaction of a partition."""
+
+    partition: str
+    events_before: int
+    events_after: int
+    revisions: int
+
+
+class HistoricalEventStore:
+    """Append-only, deduplicated store of historical events."""
+
+    def __init__(
+        self,
+        root: Path,
+        compression_level: int = 6,
+        max_loaded_partitions: int = 24,
+    ):
+        """Create a store.
+
+        Args:
+            root: The root directory of the store.
+            compression_level: The gzip compression level of event files,
+                defaults to 6.
+            max_loaded_partitions: The maximum number of partition indexes
+                kept in memory, defaults to 24 (2 years of monthly
+                partitions).
+        """
+        self.root = root
+        self.compression_level = compression_level
+        self.max_loaded_partitions = max_loaded_partitions
+        # partition -> revision keys, in LRU order
+        self._indexes: collections.OrderedDict[str, set[int]] = (
+            collections.OrderedDict()
+        )
+        # Partitions whose files were checked by `_recover_partition`
+        self._recovered_partitions: set[str] = set()
+
+    def get_partition_dir(self, partition: str) -> Path:
+        return self.root / f"month={partition}"
+
+    def list_partitions(self) -> list[str]:
+        """Return the partitions of the store, in chronological order."""
+        if not self.root.is_dir():
+            return []
+        return sorted(
+            path.name.removeprefix("month=")
+            for path in self.root.glob("month=*")
+            if path.is_dir()
+        )
+
+    def _save_commit(self, partition: str) -> None:
+        """Record the current sizes of the files of a partition, atomically."""
+        partition_dir = self.get_partition_dir(partition)
+        sizes = [
+            path.stat().st_size if path.is_file() else 0
+            for path in (
+                partition_dir / EVENTS_FILE_NAME,
+                partition_dir / INDEX_FILE_NAME,
+            )
+        ]
+        tmp_path = partition_dir / f"{COMMIT_FILE_NAME}.tmp"
+        tmp_path.write_text(
+            PartitionCommit(events_size=sizes[0], index_size=sizes[1]).model_dump_json()
+        )
+        tmp_path.replace(partition_dir / COMMIT_FILE_NAME)
+
+    def _recover_partition(self, partition: str) -> None:
+        """Truncate the files of a partition to the sizes of the last
+        complete append, removing the data of an interrupted append."""
+        if partition in self._recovered_partitions:
+            return
+        self._recovered_partitions.add(partition)
+        commit_path = self.get_partition_dir(partition) / COMMIT_FILE_NAME
+        if not commit_path.is_file():
+            return
+        commit = PartitionCommit.model_validate_json(commit_path.read_bytes())
+        for name, size in (
+            (EVENTS_FILE_NAME, commit.events_size),
+            (INDEX_FILE_NAME, commit.index_size),
+        ):
+            path = commit_path.with_name(name)
+            if path.is_file() and path.stat().st_size > size:
+                logger.warning(
+                    "Truncating %s from %d to %d bytes (interrupted append)",
+                    path,
+                    path.stat().st_size,
+                    size,
+                )
+                os.truncate(path, size)
+
+    def _get_index(self, partition: str) -> set[int]:
+        index = self._indexes.get(partition)
+        if index is not None:
+            self._indexes.move_to_end(partition)
+            return index
+        self._recover_partition(partition)
+        index_path = self.get_partition_dir(partition) / INDEX_FILE_NAME
+        index = (
+            set(_keys_from_bytes(index_path.read_bytes()))
+            if index_path.is_file()
+            else set()
+        )
+        self._indexes[partition] = index
+        if len(self._indexes) > self.max_loaded_partitions:
+            self._indexes.popitem(last=False)
+        return index
+
+    def contains(self, code: str, rev_id: int, timestamp: int) -> bool:
+        """Return True if the events of a revision are already stored."""
+        return get_revision_key(code, rev_id) in self._get_index(
+            get_month_partition(timestamp)
+        )
+
+    def append(self, events: Iterable[JSONType]) -> int:
+        """Append events to the store, skipping the revisions that are
+        already stored.
+
+        Appending the same events again is a no-op. Events of a revision
+        must be appended in a single call.
+
+        Args:
+            events: The event rows, as generated by `generate_events`.
+
+        Returns:
+            The number of events written.
+        """
+        # partition -> new revision key -> (field, action) pairs already seen
+        new_revisions: dict[str, dict[int, set[tuple[str, str]]]] = {}
+        new_lines: dict[str, list[bytes]] = {}
+        for event in events:
+            partition = get_month_partition(event["timestamp"])
+            key = get_revision_key(event["code"], event["rev_id"])
+            partition_revisions = new_revisions.setdefault(partition, {})
+            seen_changes = partition_revisions.get(key)
+            if seen_changes is None:
+                if key in self._get_index(partition):
+                    continue
+                seen_changes = partition_revisions[key] = set()
+            # The same revision may be delivered twice in the same batch
+            change = (event["field"], event["action"])
+            if change in seen_changes:
+                continue
+            seen_changes.add(change)
+            new_lines.setdefault(partition, []).append(
+                orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE)
+            )
+
+        count = 0
+        for partition, lines in new_lines.items():
+            partition_dir = self.get_partition_dir(partition)
+            if not partition_dir.is_dir():
+                partition_dir.mkdir(parents=True)
+                self._save_commit(partition)
+            keys = new_revisions[partition].keys()
+            # The events and the index are committed together: if the
+            # process is interrupted before `_save_commit`, both are
+            # truncated when the partition is opened again
+            with (partition_dir / EVENTS_FILE_NAME).open("ab") as fp:
+                fp.write(
+                    gzip.compress(
+                        b"".join(lines), compresslevel=self.compression_level, mtime=0
+                    )
+                )
+            with (partition_dir / INDEX_FILE_NAME).open("ab") as fp:
+                fp.write(_keys_to_bytes(keys))
+            self._save_commit(partition)
+            self._get_index(partition).update(keys)
+            count += len(lines)
+        return count
+
+    def iter_events(self, partition: str) -> Iterator[JSONType]:
+        """Iterate over the events of a partition, in append order."""
+        self._recover_partition(partition)
+        events_path = self.get_partition_dir(partition) / EVENTS_FILE_NAME
+        if not events_path.is_file():
+            return
+        with gzip.open(events_path, "rb") as fp:
+            for line in fp:
+                yield orjson.loads(line)
+
+    def compact(self, partition: str) -> CompactionStats:
+        """Compact a partition.
+
+        The events file is rewritten in large gzip members (instead of one
+        per append), without duplicate rows and sorted by (timestamp, code,
+        rev_id), and the index is rewritten sorted and without duplicates.
+        """
+        partition_dir = self.get_partition_dir(partition)
+        events_before = 0
+        events_by_change: dict[tuple[str, str, str], JSONType] = {}
+        for event in self.iter_events(partition):
+            events_before += 1
+            events_by_change.setdefault(
+                (event["id"], event["field"], event["action"]), event
+            )
+        events = sorted(
+            events_by_change.values(),
+            key=lambda event: (event["timestamp"], event["code"], event["rev_id"]),
+        )
+        keys = sorted({get_revision_key(e["code"], e["rev_id"]) for e in events})
+
+        tmp_events_path = partition_dir / f"{EVENTS_FILE_NAME}.tmp"
+        with ParallelCompressedWriter(
+            tmp_events_path, level=self.compression_level
+        ) as writer:
+            for event in events:
+                writer.write(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE))
+        tmp_index_path = partition_dir / f"{INDEX_FILE_NAME}.tmp"
+        tmp_index_path.write_bytes(_keys_to_bytes(keys))
+        # Without commit file, the files are used as is: the compacted files
+        # may be larger than the sizes of the last commit
+        (partition_dir / COMMIT_FILE_NAME).unlink(missing_ok=True)
+        tmp_events_path.replace(partition_dir / EVENTS_FILE_NAME)
+        tmp_index_path.replace(partition_dir / INDEX_FILE_NAME)
+        self._save_commit(partition)
+        self._indexes.pop(partition, None)
+
+        stats = CompactionStats(
+            partition=partition,
+            events_before=events_before,
+            events_after=len(events),
+            revisions=len(keys),
+        )
+        logger.info(
+            "Partition %s compacted: %d -> %d events, %d revisions",
+            partition,
+            stats.events_before,
+            stats.events_after,
+            stats.revisions,
+        )
+        return stats
+
+    def compact_all(self) -> list[CompactionStats]:
+        """Compact all partitions of the store."""
+        return [self.compact(partition) for partition in self.list_partitions()]
@@ -0,0 +1,303 @@
+"""Manifests of the exports.
+
+Each export writes a JSON manifest next to its artifact
+(`{artifact}.manifest.json`), with:
+
+- the input files (size, ETag of the downloaded dump)
+- the number of rows read, written and rejected
+- the duration of each stage of the export, and the peak memory usage of the
+  worker process
+- the output files (size, SHA-256, row count and row group statistics for
+  Parquet files)
+
+The last `MANIFEST_HISTORY_SIZE` manifests of each export are also kept in
+Redis, to detect performance regressions run over run (see
+`diff_manifests`).
+"""
+
+import contextlib
+import datetime
+import logging
+import time
+from pathlib import Path
+from typing import Iterator
+
+import pyarrow.parquet as pq
+from openfoodfacts.utils import get_file_etag
+from pydantic import BaseModel
+from redis import Redis
+from redis.exceptions import RedisError
+
+from openfoodfacts_exports.utils import get_file_sha256, get_peak_rss_mb
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_HISTORY_KEY_PREFIX = "openfoodfacts_exports:manifests:"
+MANIFEST_HISTORY_SIZE = 30
+
+
+class RowCounts(BaseModel):
+    """Number of rows read and written by a conversion."""
+
+    rows_in: int = 0
+    rows_out: int = 0
+
+    @property
+    def rows_rejected(self) -> int:
+        return self.rows_in - self.rows_out
+
+
+class InputFile(BaseModel):
+    path: str
+    size: int
+    # ETag of the downloaded file, if known
+    etag: str | None = None
+
+
+class RowGroupStats(BaseModel):
+    num_row_groups: int
+    min_rows: int
+    max_rows: int
+    # Mean compressed size of the row groups, in bytes
+    mean_size: int
+
+
+class Artifact(BaseModel):
+    path: str
+    size: int
+    sha256: str
+    # Number of rows and row group statistics of Parquet files
+    row_count: int | None = None
+    row_groups: RowGroupStats | None = None
+
+
+class ExportManifest(BaseModel):
+    export_name: str
+    started_at: datetime.datetime
+    # Total duration, in seconds
+    duration: float
+    inputs: list[InputFile] = []
+    rows_in: int | None = None
+    rows_out: int | None = None
+    rows_rejected: int | None = None
+    # Duration of each stage, in seconds
+    stages: dict[str, float] = {}
+    # Peak RSS of the process running the export (or of its largest
+    # terminated child), in MB. It includes the memory used by the other jobs
+    # run by the process (ex: with thread workers), so it is not compared by
+    # `diff_manifests`
+    process_peak_rss_mb: float | None = None
+    artifacts: list[Artifact] = []
+
+
+def get_manifest_path(artifact_path: Path) -> Path:
+    return artifact_path.with_name(f"{artifact_path.name}.manifest.json")
+
+
+def get_artifact(path: Path) -> Artifact:
+    """Return the description of an output file."""
+    artifact = Artifact(
+        path=str(path), size=path.stat().st_size, sha256=get_file_sha256(path)
+    )
+    if path.suffix == ".parquet":
+        metadata = pq.ParquetFile(path).metadata
+        artifact.row_count = metadata.num_rows
+        row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+        if row_groups:
+            artifact.row_groups = RowGroupStats(
+                num_row_groups=len(row_groups),
+                min_rows=min(row_group.num_rows for row_group in row_groups),
+                max_rows=max(row_group.num_rows for row_group in row_groups),
+                mean_size=round(
+                    sum(row_group.total_byte_size for row_group in row_groups)
+                    / len(row_groups)
+                ),
+            )
+    return artifact
+
+
+class ExportRecorder:
+    """Record the inputs, stages and outputs of an export, to build its
+    manifest.
+
+    Usage::
+
+        recorder = ExportRecorder("parquet-off")
+        recorder.add_input(dataset_path)
+        with recorder.stage("convert"):
+            row_counts = convert(...)
+        recorder.set_row_counts(row_counts)
+        recorder.add_artifact(output_path)
+        recorder.finish()
+    """
+
+    def __init__(self, export_name: str):
+        self.export_name = export_name
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self._start_time = time.monotonic()
+        self.inputs: list[InputFile] = []
+        self.row_counts: RowCounts | None = None
+        self.stages: dict[str, float] = {}
+        self.artifacts: list[Artifact] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Context manager recording the duration of a stage."""
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = round(
+                self.stages.get(name, 0.0) + time.monotonic() - start_time, 3
+            )
+
+    def add_input(self, path: Path) -> None:
+        self.inputs.append(
+            InputFile(
+                path=str(path), size=path.stat().st_size, etag=get_file_etag(path)
+            )
+        )
+
+    def set_row_counts(self, row_counts: RowCounts) -> None:
+        self.row_counts = row_counts
+
+    def add_artifact(self, path: Path) -> None:
+        self.artifacts.append(get_artifact(path))
+
+    def get_manifest(self) -> ExportManifest:
+        return ExportManifest(
+            export_name=self.export_name,
+            started_at=self.started_at,
+            duration=round(time.monotonic() - self._start_time, 3),
+            inputs=self.inputs,
+            rows_in=None if self.row_counts is None else self.row_counts.rows_in,
+            rows_out=None if self.row_counts is None else self.row_counts.rows_out,
+            rows_rejected=None
+            if self.row_counts is None
+            else self.row_counts.rows_rejected,
+            stages=self.stages,
+            process_peak_rss_mb=round(get_peak_rss_mb(), 1),
+            artifacts=self.artifacts,
+        )
+
+    def finish(
+        self, manifest_path: Path | None = None, connection: Redis | None = None
+    ) -> ExportManifest:
+        """Write the manifest and add it to the history of the export.
+
+        Args:
+            manifest_path: The path of the manifest, defaults to
+                `{artifact}.manifest.json` for the first artifact.
+            connection: The Redis connection, defaults to the connection of
+                the workers.
+
+        Returns:
+            The manifest.
+        """
+        manifest = self.get_manifest()
+        if manifest_path is None:
+            manifest_path = get_manifest_path(Path(manifest.artifacts[0].path))
+        manifest_path.write_text(manifest.model_dump_json(indent=2))
+        if connection is None:
+            from openfoodfacts_exports.workers.redis import redis_conn
+
+            connection = redis_conn
+        try:
+            add_to_history(connection, manifest)
+        except RedisError as e:
+            logger.warning("Failed to save the manifest in Redis: %s", e)
+        logger.info(
+            "Export %s done in %.1fs, manifest saved in %s",
+            self.export_name,
+            manifest.duration,
+            manifest_path,
+        )
+        return manifest
+
+
+def add_to_history(connection: Redis, manifest: ExportManifest) -> None:
+    key = f"{MANIFEST_HISTORY_KEY_PREFIX}{manifest.export_name}"
+    with connection.pipeline() as pipeline:
+        pipeline.lpush(key, manifest.model_dump_json())
+        pipeline.ltrim(key, 0, MANIFEST_HISTORY_SIZE - 1)
+        pipeline.execute()
+
+
+def get_history(connection: Redis, export_name: str) -> list[ExportManifest]:
+    """Return the last manifests of an export, most recent first."""
+    return [
+        ExportManifest.model_validate_json(item)
+        for item in connection.lrange(
+            f"{MANIFEST_HISTORY_KEY_PREFIX}{export_name}", 0, -1
+        )  # type: ignore
+    ]
+
+
+class MetricDiff(BaseModel):
+    name: str
+    old: float | None
+    new: float | None
+
+    @property
+    def relative_change(self) -> float | None:
+        if self.old is None or self.new is None or self.old == 0:
+            return None
+        return (self.new - self.old) / self.old
+
+
+def get_metrics(manifest: ExportManifest) -> dict[str, float]:
+    """Return the numeric values of a manifest, by name."""
+    metrics: dict[str, float] = {
+        "duration": manifest.duration,
+        "input_size": sum(input_file.size for input_file in manifest.inputs),
+    }
+    for key in ("rows_in", "rows_out", "rows_rejected"):
+        value = getattr(manifest, key)
+        if value is not None:
+            metrics[key] = value
+    for stage, duration in manifest.stages.items():
+        metrics[f"stages.{stage}"] = duration
+    for artifact in manifest.artifacts:
+        prefix = f"artifacts.{Path(artifact.path).name}"
+        metrics[f"{prefix}.size"] = artifact.size
+        if artifact.row_count is not None:
+            metrics[f"{prefix}.row_count"] = artifact.row_count
+        if artifact.row_groups is not None:
+            metrics[f"{prefix}.num_row_groups"] = artifact.row_groups.num_row_groups
+    return metrics
+
+
+def diff_manifests(old: ExportManifest, new: ExportManifest) -> list[MetricDiff]:
+    """Compare the metrics of two manifests of an export."""
+    old_metrics = get_metrics(old)
+    new_metrics = get_metrics(new)
+    return [
+        MetricDiff(name=name, old=old_metrics.get(name), new=new_metrics.get(name))
+        for name in list(old_metrics)
+        + [name for name in new_metrics if name not in old_metrics]
+    ]
+
+
+def format_diff(diffs: list[MetricDiff], threshold: float = 0.1) -> str:
+    """Format a manifest diff as a table, flagging with `!` the metrics that
+    changed by more than `threshold` (relative change)."""
+    lines = [f"  {'metric':<50} {'old':>14} {'new':>14} {'change':>9}"]
+    for diff in diffs:
+        change = diff.relative_change
+        flag = "!" if change is None or abs(change) > threshold else " "
+        if diff.old == diff.new:
+            flag = " "
+        lines.append(
+            f"{flag} {diff.name:<50} {_format_value(diff.old):>14} "
+            f"{_format_value(diff.new):>14} "
+            f"{'' if change is None else f'{change:+.1%}':>9}"
+        )
+    return "\n".join(lines)
+
+
+def _format_value(value: float | None) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float) and not value.is_integer():
+        return f"{value:.3f}"
+    return str(int(value))
@@ -1,20 +1,32 @@
+import gzip
 import logging
 import shutil
 import tempfile
 from pathlib import Path
+from typing import Iterable, Iterator
 
+import orjson
 import pyarrow as pa
 import pyarrow.parquet as pq
 import tqdm
-from more_itertools import chunked
+from more_itertools import chunked, ichunked
 from openfoodfacts import Flavor
-from openfoodfacts.utils import jsonl_iter
+from openfoodfacts.utils import get_open_fn
 
 from openfoodfacts_exports import settings
+from openfoodfacts_exports.exports.manifest import ExportRecorder, RowCounts
 
 from .beauty import BEAUTY_DTYPE_MAP, BEAUTY_PRODUCT_SCHEMA, BeautyProduct
+from .checkpoint import (
+    clear_checkpoint,
+    get_part_path,
+    load_checkpoint,
+    save_checkpoint,
+    stitch_parts,
+)
 from .common import Product, push_parquet_file_to_hf
 from .food import FOOD_DTYPE_MAP, FOOD_PRODUCT_SCHEMA, FoodProduct
+from .partitioned import push_partitioned_dataset_to_hf, write_partitioned_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +38,11 @@ PARQUET_DATASET_PATH = {
 
 
 def export_parquet(
-    dataset_path: Path, output_path: Path, flavor: Flavor, use_tqdm: bool = False
+    dataset_path: Path,
+    output_path: Path,
+    flavor: Flavor,
+    use_tqdm: bool = False,
+    dataset_url: str | None = None,
 ) -> None:
     """Convert a JSONL dataset to Parquet format and push it to Hugging Face
     Hub.
@@ -37,6 +53,10 @@ def export_parquet(
         flavor (Flavor): The flavor of the dataset.
         use_tqdm (bool, optional): Whether to use tqdm to display a progress
             bar. Defaults to False.
+        dataset_url (str, optional): If provided, the gzipped JSONL dataset
+            is downloaded from this URL to `dataset_path` while it is
+            converted, instead of being read from `dataset_path`. Defaults to
+            None.
     """
     logger.info("Start JSONL export to Parquet.")
 
@@ -52,28 +72,112 @@ def export_parquet(
     else:
         raise ValueError(f"Unsupported flavor: {flavor}")
 
+    recorder = ExportRecorder(f"parquet-{flavor.name}")
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_converted_parquet_path = Path(tmp_dir) / "converted_data.parquet"
-        convert_jsonl_to_parquet(
-            output_file_path=tmp_converted_parquet_path,
-            dataset_path=dataset_path,
-            pydantic_cls=pydantic_cls,
-            schema=schema,
-            dtype_map=dtype_map,
-            use_tqdm=use_tqdm,
-        )
+        with recorder.stage("convert"):
+            if dataset_url is None:
+                row_counts = convert_jsonl_to_parquet(
+                    output_file_path=tmp_converted_parquet_path,
+                    dataset_path=dataset_path,
+                    pydantic_cls=pydantic_cls,
+                    schema=schema,
+                    dtype_map=dtype_map,
+                    use_tqdm=use_tqdm,
+                    # Kept across job attempts, removed once the conversion is
+                    # done
+                    checkpoint_dir=settings.CHECKPOINT_DIR / f"parquet-{flavor.name}",
+                )
+            else:
+                # Imported here, as `openfoodfacts_exports.tasks` imports this
+                # module
+                from openfoodfacts_exports.tasks.download import (
+                    open_streaming_download,
+                )
+
+                logger.info("Converting %s while it is downloaded", dataset_url)
+                with (
+                    open_streaming_download(dataset_url, dataset_path) as stream,
+                    gzip.GzipFile(fileobj=stream) as f,
+                ):
+                    row_counts = convert_jsonl_stream_to_parquet(
+                        output_file_path=tmp_converted_parquet_path,
+                        stream=f,
+                        pydantic_cls=pydantic_cls,
+                        schema=schema,
+                        dtype_map=dtype_map,
+                    )
+        recorder.add_input(dataset_path)
+        recorder.set_row_counts(row_counts)
         # Move dataset file to output_path
         shutil.move(tmp_converted_parquet_path, output_path)
+    recorder.add_artifact(output_path)
 
-    if settings.ENABLE_HF_PUSH:
-        push_parquet_file_to_hf(
-            data_path=output_path, repo_id="openfoodfacts/product-database"
-        )
-    else:
-        logger.info("Hugging Face push is disabled.")
+    # ex: datasets/food for datasets/food.parquet
+    partitioned_dataset_path = output_path.with_suffix("")
+    if settings.ENABLE_PARQUET_PARTITIONS:
+        with recorder.stage("partition"):
+            write_partitioned_dataset(output_path, partitioned_dataset_path)
+
+    with recorder.stage("push"):
+        if settings.ENABLE_HF_PUSH:
+            push_parquet_file_to_hf(
+                data_path=output_path, repo_id="openfoodfacts/product-database"
+            )
+            if settings.ENABLE_PARQUET_PARTITIONS:
+                push_partitioned_dataset_to_hf(
+                    dataset_dir=partitioned_dataset_path,
+                    repo_id="openfoodfacts/product-database",
+                    path_in_repo=partitioned_dataset_path.name,
+                )
+        else:
+            logger.info("Hugging Face push is disabled.")
+    recorder.finish()
     logger.info("JSONL to Parquet conversion and postprocessing completed.")
 
 
+def iter_jsonl_with_offsets(
+    dataset_path: Path, offset: int = 0
+) -> Iterator[tuple[dict, int]]:
+    """Iterate over the items of a JSONL file (plain or gzipped).
+
+    Args:
+        dataset_path (Path): The path to the JSONL file.
+        offset (int, optional): The offset (in the decompressed file) of the
+            line to start from. Defaults to 0.
+
+    Yields:
+        (item, offset) tuples, where offset is the offset of the next line.
+    """
+    open_fn = get_open_fn(dataset_path)
+    with open_fn(str(dataset_path), "rb") as f:
+        if offset:
+            # Gzipped files are decompressed up to the offset
+            f.seek(offset)
+        yield from iter_jsonl_stream_with_offsets(f, offset)
+
+
+def iter_jsonl_stream_with_offsets(
+    stream: Iterable[bytes], offset: int = 0
+) -> Iterator[tuple[dict, int]]:
+    """Iterate over the items of a (decompressed) JSONL stream.
+
+    Args:
+        stream (Iterable[bytes]): The JSONL stream (ex: a binary file
+            object), iterated line by line.
+        offset (int, optional): The offset of the stream position. Defaults
+            to 0.
+
+    Yields:
+        (item, offset) tuples, where offset is the offset of the next line.
+    """
+    for line in stream:
+        offset += len(line)
+        line = line.strip(b"\n")
+        if line:
+            yield orjson.loads(line), offset
+
+
 def convert_jsonl_to_parquet(
     output_file_path: Path,
     dataset_path: Path,
@@ -83,7 +187,9 @@ def convert_jsonl_to_parquet(
     batch_size: int = 1024,
     row_group_size: int = 122_880,  # DuckDB default row group size,
     use_tqdm: bool = False,
-) -> None:
+    checkpoint_dir: Path | None = None,
+    checkpoint_interval: int = 200,
+) -> RowCounts:
     """Convert the Open Food Facts JSONL dataset to Parquet format.
 
     Args:
@@ -99,21 +205,137 @@ def convert_jsonl_to_parquet(
             Parquet file. Defaults to 122_880.
         use_tqdm (bool, optional): Whether to use tqdm to display a progress
             bar. Defaults to False.
+        checkpoint_dir (Path, optional): If provided, the conversion is
+            checkpointed in this directory, and resumed from the last
+            checkpoint if it was interrupted (see `checkpoint.py`). The
+            directory is removed once the conversion is complete. Defaults
+            to None.
+        checkpoint_interval (int, optional): The number of batches between two
+            checkpoints. Defaults to 200.
+
+    Returns:
+        RowCounts: The number of JSONL items read and of rows written.
     """
-    writer = None
     if dtype_map is None:
         dtype_map = {}
-    item_iter = jsonl_iter(dataset_path)
+    checkpoint = None
+    if checkpoint_dir is not None:
+        checkpoint = load_checkpoint(checkpoint_dir, dataset_path, batch_size)
+    item_iter: Iterable[tuple[dict, int]] = iter_jsonl_with_offsets(
+        dataset_path, offset=0 if checkpoint is None else checkpoint.offset
+    )
     if use_tqdm:
         item_iter = tqdm.tqdm(item_iter, desc="JSONL")
+    # The counts of a resumed conversion include the completed parts
+    row_counts = RowCounts() if checkpoint is None else checkpoint.row_counts
+    record_batches = iter_record_batches(
+        item_iter, pydantic_cls, schema, dtype_map, batch_size, row_counts
+    )
+
+    if checkpoint_dir is None or checkpoint is None:
+        write_record_batches(record_batches, output_file_path, row_group_size)
+        return row_counts
+
+    for part in ichunked(record_batches, checkpoint_interval):
+        part_path = get_part_path(checkpoint_dir, checkpoint.num_parts)
+        with pq.ParquetWriter(part_path, schema=schema) as part_writer:
+            for record_batch, offset in part:
+                part_writer.write_batch(record_batch, row_group_size=row_group_size)
+        checkpoint.num_parts += 1
+        checkpoint.offset = offset
+        save_checkpoint(checkpoint_dir, checkpoint)
+
+    if checkpoint.num_parts:
+        stitch_parts(checkpoint_dir, checkpoint.num_parts, output_file_path, schema)
+    clear_checkpoint(checkpoint_dir)
+    return row_counts
+
+
+def convert_jsonl_stream_to_parquet(
+    output_file_path: Path,
+    stream: Iterable[bytes],
+    pydantic_cls: type[Product],
+    schema: pa.Schema,
+    dtype_map: dict[str, pa.DataType] | None = None,
+    batch_size: int = 1024,
+    row_group_size: int = 122_880,
+) -> RowCounts:
+    """Convert a (decompressed) JSONL stream of the Open Food Facts dataset to
+    Parquet format, as it is read.
+
+    Unlike `convert_jsonl_to_parquet`, the conversion cannot be
+    checkpointed. If reading the stream fails, the exception is propagated
+    and the Parquet file is incomplete.
+
+    Args:
+        output_file_path (Path): The path where the Parquet file will be saved.
+        stream (Iterable[bytes]): The JSONL stream (ex: a binary file
+            object), iterated line by line.
+        pydantic_cls: The Pydantic class used to validate the JSONL items.
+        schema (pa.Schema): The schema of the Parquet file.
+        dtype_map (dict[str, pa.DataType], optional): A mapping of field names
+            to PyArrow data types. Defaults to None.
+        batch_size (int, optional): The size of the batches used to convert the
+            dataset. Defaults to 1024.
+        row_group_size (int, optional): The size of the row groups in the
+            Parquet file. Defaults to 122_880.
+
+    Returns:
+        RowCounts: The number of JSONL items read and of rows written.
+    """
+    row_counts = RowCounts()
+    record_batches = iter_record_batches(
+        iter_jsonl_stream_with_offsets(stream),
+        pydantic_cls,
+        schema,
+        dtype_map or {},
+        batch_size,
+        row_counts,
+    )
+    write_record_batches(record_batches, output_file_path, row_group_size)
+    return row_counts
 
+
+def write_record_batches(
+    record_batches: Iterable[tuple[pa.RecordBatch, int]],
+    output_file_path: Path,
+    row_group_size: int,
+) -> None:
+    """Write (record batch, offset) tuples to a Parquet file, the file is
+    only created if there is at least one record batch."""
+    writer = None
+    try:
+        for record_batch, _ in record_batches:
+            if writer is None:
+                writer = pq.ParquetWriter(output_file_path, schema=record_batch.schema)
+            writer.write_batch(record_batch, row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def iter_record_batches(
+    item_iter: Iterable[tuple[dict, int]],
+    pydantic_cls: type[Product],
+    schema: pa.Schema,
+    dtype_map: dict[str, pa.DataType],
+    batch_size: int,
+    row_counts: RowCounts,
+) -> Iterator[tuple[pa.RecordBatch, int]]:
+    """Convert (item, offset) tuples to record batches of `batch_size`
+    items, counting the items read and converted in `row_counts`.
+
+    Yields:
+        (record batch, offset) tuples, where offset is the offset of the line
+        following the last item of the batch.
+    """
     for batch in chunked(item_iter, batch_size):
         # We use by_alias=True because some fields start with a digit
         # (ex: nutriments.100g), and we cannot declare the schema with
         # Pydantic without an alias.
         products = []
 
-        for item in batch:
+        for item, _ in batch:
             try:
                 product = pydantic_cls(**item).model_dump(by_alias=True)
             except Exception:
@@ -133,10 +355,6 @@ def convert_jsonl_to_parquet(
             )
             for key in keys
         }
-        record_batch = pa.record_batch(data, schema=schema)
-        if writer is None:
-            writer = pq.ParquetWriter(output_file_path, schema=record_batch.schema)
-        writer.write_batch(record_batch, row_group_size=row_group_size)
-
-    if writer is not None:
-        writer.close()
+        row_counts.rows_in += len(batch)
+        row_counts.rows_out += len(products)
+        yield pa.record_batch(data, schema=schema), batch[-1][1]
@@ -0,0 +1,143 @@
+"""Checkpoints of JSONL to Parquet conversions.
+
+A conversion of the full Open Food Facts dataset takes hours. To avoid losing
+all progress when the job is killed (ex: job timeout), the converted rows are
+written to a sequence of part files in a checkpoint directory. After each
+part, a checkpoint file records the number of completed parts and the offset
+in the (decompressed) JSONL input of the next line to convert:
+
+    {checkpoint_dir}/checkpoint.json
+    {checkpoint_dir}/part-00000.parquet
+    {checkpoint_dir}/part-00001.parquet
+    ...
+
+A conversion started with the same checkpoint directory and the same input
+resumes from the last checkpoint. Once all the input is converted, the row
+groups of the parts are copied in order into the output file, that is
+identical to the output of a conversion without checkpoints.
+"""
+
+import logging
+import shutil
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pydantic import BaseModel, Field
+
+from openfoodfacts_exports.exports.manifest import RowCounts
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE_NAME = "checkpoint.json"
+# Fields of the checkpoint updated as the conversion progresses
+PROGRESS_FIELDS = {"num_parts", "offset", "row_counts"}
+
+
+class ConversionCheckpoint(BaseModel):
+    """State of a conversion, saved after each completed part."""
+
+    # Identification of the input, a checkpoint of another input is discarded
+    dataset_path: str
+    dataset_size: int
+    dataset_mtime_ns: int
+    batch_size: int
+    # Number of completed part files
+    num_parts: int = 0
+    # Offset (in the decompressed input) of the first line not converted yet
+    offset: int = 0
+    # Number of rows converted in the completed parts
+    row_counts: RowCounts = Field(default_factory=RowCounts)
+
+
+def get_part_path(checkpoint_dir: Path, part_id: int) -> Path:
+    return checkpoint_dir / f"part-{part_id:05d}.parquet"
+
+
+def new_checkpoint(dataset_path: Path, batch_size: int) -> ConversionCheckpoint:
+    """Return the initial checkpoint of a conversion of `dataset_path`."""
+    stat = dataset_path.stat()
+    return ConversionCheckpoint(
+        dataset_path=str(dataset_path.resolve()),
+        dataset_size=stat.st_size,
+        dataset_mtime_ns=stat.st_mtime_ns,
+        batch_size=batch_size,
+    )
+
+
+def load_checkpoint(
+    checkpoint_dir: Path, dataset_path: Path, batch_size: int
+) -> ConversionCheckpoint:
+    """Load the checkpoint of a conversion.
+
+    The checkpoint directory is cleared if it holds no valid checkpoint for
+    this input, and part files written after the last checkpoint are
+    removed.
+
+    Args:
+        checkpoint_dir: The checkpoint directory, created if needed.
+        dataset_path: The path of the JSONL input.
+        batch_size: The number of JSONL items per batch.
+
+    Returns:
+        The checkpoint to resume from.
+    """
+    initial_checkpoint = new_checkpoint(dataset_path, batch_size)
+    checkpoint_path = checkpoint_dir / CHECKPOINT_FILE_NAME
+    checkpoint = None
+    if checkpoint_path.is_file():
+        try:
+            checkpoint = ConversionCheckpoint.model_validate_json(
+                checkpoint_path.read_bytes()
+            )
+        except ValueError as e:
+            logger.warning("Invalid checkpoint %s: %s", checkpoint_path, e)
+    if checkpoint is None or checkpoint.model_dump(
+        exclude=PROGRESS_FIELDS
+    ) != initial_checkpoint.model_dump(exclude=PROGRESS_FIELDS):
+        if checkpoint is not None:
+            logger.info("Discarding checkpoint of another input: %s", checkpoint)
+        clear_checkpoint(checkpoint_dir)
+        checkpoint = initial_checkpoint
+    else:
+        logger.info(
+            "Resuming conversion from checkpoint: %d parts, offset %d",
+            checkpoint.num_parts,
+            checkpoint.offset,
+        )
+
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    # Parts written after the last checkpoint are incomplete
+    for path in checkpoint_dir.glob("part-*.parquet"):
+        if int(path.stem.removeprefix("part-")) >= checkpoint.num_parts:
+            path.unlink()
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_dir: Path, checkpoint: ConversionCheckpoint) -> None:
+    """Save a checkpoint, atomically."""
+    checkpoint_path = checkpoint_dir / CHECKPOINT_FILE_NAME
+    tmp_path = checkpoint_path.with_suffix(".tmp")
+    tmp_path.write_text(checkpoint.model_dump_json())
+    tmp_path.replace(checkpoint_path)
+
+
+def clear_checkpoint(checkpoint_dir: Path) -> None:
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+def stitch_parts(
+    checkpoint_dir: Path, num_parts: int, output_file_path: Path, schema: pa.Schema
+) -> None:
+    """Copy the row groups of the part files into the output file.
+
+    Row groups are copied one at a time, so that the memory usage does not
+    depend on the size of the dataset.
+    """
+    logger.info("Stitching %d parts into %s", num_parts, output_file_path)
+    with pq.ParquetWriter(output_file_path, schema=schema) as writer:
+        for part_id in range(num_parts):
+            part_file = pq.ParquetFile(get_part_path(checkpoint_dir, part_id))
+            for i in range(part_file.num_row_groups):
+                row_group = part_file.read_row_group(i)
+                writer.write_table(row_group, row_group_size=row_group.num_rows)
@@ -0,0 +1,196 @@
+"""Parquet output for the historical events stream.
+
+Events are written to a Hive-partitioned dataset, with one partition per
+month of the event timestamp::
+
+    {output_dir}/month=2024-01/events.parquet
+
+`previous` and `current` can be any JSON value: they are stored as JSON
+strings, and scalar values are also stored in typed shadow columns
+(`previous_num`/`previous_str`, `current_num`/`current_str`), so that most
+analyses don't need to parse JSON.
+"""
+
+import logging
+from pathlib import Path
+from typing import Any, Iterable
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openfoodfacts.types import JSONType
+
+from openfoodfacts_exports.exports.historical_events import get_month_partition
+from openfoodfacts_exports.utils import open_dataset
+
+logger = logging.getLogger(__name__)
+
+
+PA_DICTIONARY_STRING_DATATYPE = pa.dictionary(pa.int32(), pa.string())
+
+HISTORICAL_EVENT_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("code", pa.string()),
+        pa.field("rev_id", pa.int32()),
+        # Parquet doesn't support timestamps in seconds
+        pa.field("timestamp", pa.timestamp("ms", tz="UTC")),
+        pa.field("product_type", PA_DICTIONARY_STRING_DATATYPE, nullable=True),
+        pa.field("comment", pa.string(), nullable=True),
+        pa.field("field", PA_DICTIONARY_STRING_DATATYPE),
+        pa.field("action", PA_DICTIONARY_STRING_DATATYPE),
+        pa.field("previous", pa.string(), nullable=True),
+        pa.field("previous_num", pa.float64(), nullable=True),
+        pa.field("previous_str", pa.string(), nullable=True),
+        pa.field("current", pa.string(), nullable=True),
+        pa.field("current_num", pa.float64(), nullable=True),
+        pa.field("current_str", pa.string(), nullable=True),
+    ]
+)
+
+# Columns copied as-is from the event rows
+EVENT_KEYS = ["id", "code", "rev_id", "product_type", "comment", "field", "action"]
+
+
+def _split_value(value: Any) -> tuple[str | None, float | None, str | None]:
+    """Return the JSON, numeric and string representations of an event
+    value. Booleans and non-scalar values are only stored as JSON."""
+    if value is None:
+        return None, None, None
+    json_value = orjson.dumps(value).decode("utf-8")
+    if isinstance(value, str):
+        return json_value, None, value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return json_value, float(value), None
+    return json_value, None, None
+
+
+def events_to_record_batch(events: list[JSONType]) -> pa.RecordBatch:
+    """Convert event rows to an Arrow record batch with the
+    `HISTORICAL_EVENT_SCHEMA` schema."""
+    data: dict[str, list] = {key: [] for key in HISTORICAL_EVENT_SCHEMA.names}
+    for event in events:
+        for key in EVENT_KEYS:
+            data[key].append(event.get(key))
+        data["timestamp"].append(event["timestamp"] * 1000)
+        for side in ("previous", "current"):
+            json_value, num_value, str_value = _split_value(event.get(side))
+            data[side].append(json_value)
+            data[f"{side}_num"].append(num_value)
+            data[f"{side}_str"].append(str_value)
+    return pa.record_batch(
+        [
+            pa.array(data[field.name], type=field.type)
+            for field in HISTORICAL_EVENT_SCHEMA
+        ],
+        schema=HISTORICAL_EVENT_SCHEMA,
+    )
+
+
+class HistoricalEventParquetWriter:
+    """Write historical events to a month-partitioned Parquet dataset.
+
+    Events are buffered per partition and written as record batches of
+    `batch_size` rows. A Parquet file is kept open for each partition until
+    `close` is called.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        batch_size: int = 10_000,
+        row_group_size: int = 122_880,  # DuckDB default row group size
+    ):
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.row_group_size = row_group_size
+        self._buffers: dict[str, list[JSONType]] = {}
+        self._writers: dict[str, pq.ParquetWriter] = {}
+        # partition -> number of rows written
+        self.row_counts: dict[str, int] = {}
+
+    def get_partition_path(self, partition: str) -> Path:
+        return self.output_dir / f"month={partition}" / "events.parquet"
+
+    def write(self, event: JSONType) -> None:
+        """Add an event to the dataset."""
+        partition = get_month_partition(event["timestamp"])
+        buffer = self._buffers.setdefault(partition, [])
+        buffer.append(event)
+        if len(buffer) >= self.batch_size:
+            self._flush_partition(partition)
+
+    def write_events(self, events: Iterable[JSONType]) -> None:
+        for event in events:
+            self.write(event)
+
+    def _flush_partition(self, partition: str) -> None:
+        buffer = self._buffers.pop(partition, None)
+        if not buffer:
+            return
+        writer = self._writers.get(partition)
+        if writer is None:
+            path = self.get_partition_path(partition)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writer = pq.ParquetWriter(path, schema=HISTORICAL_EVENT_SCHEMA)
+            self._writers[partition] = writer
+        writer.write_batch(
+            events_to_record_batch(buffer), row_group_size=self.row_group_size
+        )
+        self.row_counts[partition] = self.row_counts.get(partition, 0) + len(buffer)
+
+    def close(self) -> dict[str, int]:
+        """Write the buffered events and close all files.
+
+        Returns:
+            The number of rows written per partition.
+        """
+        for partition in list(self._buffers):
+            self._flush_partition(partition)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        return self.row_counts
+
+    def __enter__(self) -> "HistoricalEventParquetWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def write_events_parquet(
+    events: Iterable[JSONType], output_dir: Path, batch_size: int = 10_000
+) -> dict[str, int]:
+    """Write event rows to a month-partitioned Parquet dataset.
+
+    Args:
+        events: The event rows to write.
+        output_dir: The root directory of the dataset.
+        batch_size: The number of rows per record batch, defaults to 10,000.
+
+    Returns:
+        The number of rows written per partition (`YYYY-MM`).
+    """
+    with HistoricalEventParquetWriter(output_dir, batch_size=batch_size) as writer:
+        writer.write_events(events)
+    logger.info(
+        "%d events written to %d partitions in %s",
+        sum(writer.row_counts.values()),
+        len(writer.row_counts),
+        output_dir,
+    )
+    return writer.row_counts
+
+
+def convert_events_jsonl_to_parquet(
+    input_path: Path, output_dir: Path, batch_size: int = 10_000
+) -> dict[str, int]:
+    """Convert a historical events JSONL dump (plain or gzipped) to a
+    month-partitioned Parquet dataset."""
+    with open_dataset(input_path) as fp:
+        return write_events_parquet(
+            (orjson.loads(line) for line in fp if line.strip()),
+            output_dir,
+            batch_size=batch_size,
+        )
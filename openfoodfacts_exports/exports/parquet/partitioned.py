@@ -0,0 +1,355 @@
+"""Partitioned Parquet output for the product datasets.
+
+The product Parquet file (ex: `food.parquet`) is kept as is, and can also be
+split into a Hive-partitioned dataset, with one partition per main language of
+the products (the `lang` column)::
+
+    {output_dir}/lang=en/products.parquet
+    {output_dir}/lang=fr/products.parquet
+    ...
+    {output_dir}/lang=__HIVE_DEFAULT_PARTITION__/products.parquet  # no lang
+    {output_dir}/manifest.json
+
+As in any Hive-partitioned dataset, the `lang` column is not stored in the
+files, but in the directory names: DuckDB (`hive_partitioning = true`),
+Polars or `pyarrow.dataset` (`partitioning="hive"`) restore it, and skip the
+partitions that don't match a filter on `lang`.
+
+The manifest lists the files of the dataset with their row count, size and
+SHA-256 checksum. It lets readers open only the partitions they need (see
+`read_partitioned_dataset`), and the Hugging Face push upload only the
+partitions whose checksum changed (see `push_partitioned_dataset_to_hf`).
+
+Rows keep the order of the input file in each partition, and row groups have a
+fixed number of rows, so a partition whose products did not change is written
+identically.
+
+Partitioning by country was left out: `countries_tags` is a list column, so
+a product sold in several countries would be stored in several partitions.
+"""
+
+import logging
+import shutil
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import quote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, HfApi
+from huggingface_hub.utils import EntryNotFoundError
+from pydantic import BaseModel
+
+from openfoodfacts_exports.utils import get_file_sha256
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "manifest.json"
+PARTITION_KEY = "lang"
+PARTITION_FILE_NAME = "products.parquet"
+# Name of the partition of the products without main language, the default of
+# Hive (and of the readers of Hive-partitioned datasets)
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+PARTITIONING = ds.partitioning(
+    pa.schema([pa.field(PARTITION_KEY, pa.string())]), flavor="hive"
+)
+
+
+class PartitionFile(BaseModel):
+    # Path of the file, relative to the dataset directory
+    path: str
+    # None for the partition of the products without main language
+    lang: str | None
+    row_count: int
+    size: int
+    sha256: str
+
+
+class PartitionedDatasetManifest(BaseModel):
+    partition_key: str = PARTITION_KEY
+    row_count: int
+    files: list[PartitionFile]
+
+    def get_files(
+        self, langs: Iterable[str | None] | None = None
+    ) -> list[PartitionFile]:
+        """Return the files of the dataset, or only the files of the
+        partitions of the given languages."""
+        if langs is None:
+            return self.files
+        lang_set = set(langs)
+        return [file for file in self.files if file.lang in lang_set]
+
+
+def get_partition_dir_name(lang: str | None) -> str:
+    """Return the name of the directory of a partition (ex: `lang=fr`)."""
+    if not lang:
+        return f"{PARTITION_KEY}={NULL_PARTITION}"
+    # Escaped like the values of Hive partitions
+    return f"{PARTITION_KEY}={quote(lang, safe='')}"
+
+
+def load_manifest(dataset_dir: Path) -> PartitionedDatasetManifest:
+    return PartitionedDatasetManifest.model_validate_json(
+        (dataset_dir / MANIFEST_FILE_NAME).read_bytes()
+    )
+
+
+class PartitionedParquetWriter:
+    """Split record batches of products into partitions by main language.
+
+    Rows are buffered per partition, and written as a row group once
+    `row_group_size` rows are buffered.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        schema: pa.Schema,
+        row_group_size: int = 16_384,
+    ):
+        self.output_dir = output_dir
+        # The partition key is stored in the directory names
+        self.schema = schema.remove(schema.get_field_index(PARTITION_KEY))
+        self.row_group_size = row_group_size
+        self._buffers: dict[str | None, list[pa.RecordBatch]] = {}
+        self._buffer_sizes: dict[str | None, int] = {}
+        self._writers: dict[str | None, pq.ParquetWriter] = {}
+        # lang -> number of rows written
+        self.row_counts: dict[str | None, int] = {}
+
+    def get_partition_path(self, lang: str | None) -> Path:
+        return self.output_dir / get_partition_dir_name(lang) / PARTITION_FILE_NAME
+
+    def write_batch(self, record_batch: pa.RecordBatch) -> None:
+        langs = record_batch.column(PARTITION_KEY)
+        # Products with an empty lang go to the partition without lang
+        langs = pc.if_else(pc.equal(langs, ""), None, langs)
+        record_batch = record_batch.drop_columns([PARTITION_KEY])
+        for lang in pc.unique(langs).to_pylist():
+            mask = pc.is_null(langs) if lang is None else pc.equal(langs, lang)
+            partition_batch = record_batch.filter(pc.fill_null(mask, False))
+            self._buffers.setdefault(lang, []).append(partition_batch)
+            self._buffer_sizes[lang] = (
+                self._buffer_sizes.get(lang, 0) + partition_batch.num_rows
+            )
+            if self._buffer_sizes[lang] >= self.row_group_size:
+                self._flush_partition(lang)
+
+    def _flush_partition(self, lang: str | None, final: bool = False) -> None:
+        """Write the buffered rows of a partition, as row groups of exactly
+        `row_group_size` rows (except the last one), so that the files do not
+        depend on how the rows of the partition were batched."""
+        buffer = self._buffers.pop(lang, None)
+        self._buffer_sizes.pop(lang, None)
+        if not buffer:
+            return
+        writer = self._writers.get(lang)
+        if writer is None:
+            path = self.get_partition_path(lang)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            writer = pq.ParquetWriter(path, schema=self.schema)
+            self._writers[lang] = writer
+        table = pa.Table.from_batches(buffer, schema=self.schema)
+        written_rows = (
+            table.num_rows
+            if final
+            else table.num_rows - table.num_rows % self.row_group_size
+        )
+        for offset in range(0, written_rows, self.row_group_size):
+            row_group = table.slice(
+                offset, min(self.row_group_size, written_rows - offset)
+            )
+            writer.write_table(row_group, row_group_size=row_group.num_rows)
+        if written_rows < table.num_rows:
+            self._buffers[lang] = table.slice(written_rows).to_batches()
+            self._buffer_sizes[lang] = table.num_rows - written_rows
+        self.row_counts[lang] = self.row_counts.get(lang, 0) + written_rows
+
+    def close(self) -> PartitionedDatasetManifest:
+        """Write the buffered rows, close all files and write the manifest.
+
+        Returns:
+            The manifest of the dataset.
+        """
+        for lang in list(self._buffers):
+            self._flush_partition(lang, final=True)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+        files = []
+        for lang in sorted(self.row_counts, key=lambda lang: lang or ""):
+            path = self.get_partition_path(lang)
+            files.append(
+                PartitionFile(
+                    path=str(path.relative_to(self.output_dir)),
+                    lang=lang,
+                    row_count=self.row_counts[lang],
+                    size=path.stat().st_size,
+                    sha256=get_file_sha256(path),
+                )
+            )
+        manifest = PartitionedDatasetManifest(
+            row_count=sum(self.row_counts.values()), files=files
+        )
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        (self.output_dir / MANIFEST_FILE_NAME).write_text(
+            manifest.model_dump_json(indent=2)
+        )
+        return manifest
+
+
+def write_partitioned_dataset(
+    parquet_path: Path, output_dir: Path, row_group_size: int = 16_384
+) -> PartitionedDatasetManifest:
+    """Split a product Parquet file into a dataset partitioned by main
+    language.
+
+    The dataset is written next to `output_dir` and replaces it once
+    complete. The input file is read one row group at a time.
+
+    Args:
+        parquet_path: The path of the product Parquet file.
+        output_dir: The root directory of the dataset.
+        row_group_size: The number of rows of the row groups of the
+            partitions, defaults to 16384. Up to this number of rows is
+            buffered in memory for each partition.
+
+    Returns:
+        The manifest of the dataset.
+    """
+    tmp_dir = output_dir.with_name(f"{output_dir.name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    parquet_file = pq.ParquetFile(parquet_path)
+    writer = PartitionedParquetWriter(
+        tmp_dir, parquet_file.schema_arrow, row_group_size=row_group_size
+    )
+    for i in range(parquet_file.num_row_groups):
+        for record_batch in parquet_file.read_row_group(i).to_batches():
+            writer.write_batch(record_batch)
+    manifest = writer.close()
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    tmp_dir.rename(output_dir)
+    logger.info(
+        "%d products written to %d partitions in %s",
+        manifest.row_count,
+        len(manifest.files),
+        output_dir,
+    )
+    return manifest
+
+
+def read_partitioned_dataset(
+    dataset_dir: Path,
+    langs: Iterable[str | None] | None = None,
+    columns: list[str] | None = None,
+    filter: pc.Expression | None = None,
+) -> pa.Table:
+    """Read a product dataset partitioned by main language.
+
+    Args:
+        dataset_dir: The root directory of the dataset.
+        langs: If provided, only the partitions of these main languages are
+            read (None for the products without main language).
+        columns: The columns to read (`lang` included), defaults to all
+            columns.
+        filter: An optional filter on the rows (ex:
+            `pc.field("code") == "3017620422003"`).
+
+    Returns:
+        The products, with the `lang` column last.
+    """
+    files = load_manifest(dataset_dir).get_files(langs)
+    dataset = ds.dataset(
+        [str(dataset_dir / file.path) for file in files],
+        format="parquet",
+        partitioning=PARTITIONING,
+        partition_base_dir=str(dataset_dir),
+    )
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def push_partitioned_dataset_to_hf(
+    dataset_dir: Path,
+    repo_id: str,
+    path_in_repo: str,
+    revision: str = "main",
+    commit_message: str = "Database updated",
+) -> None:
+    """Push the partitions of a dataset that changed to Hugging Face Hub.
+
+    The local manifest is compared with the manifest of the repository:
+    only the files whose checksum changed are uploaded, and the files that
+    no longer exist are deleted, in a single commit.
+
+    Args:
+        dataset_dir: The root directory of the dataset.
+        repo_id: The repository ID on Hugging Face Hub.
+        path_in_repo: The directory of the dataset in the repository.
+        revision: The revision to push the data to. Defaults to "main".
+        commit_message: The commit message. Defaults to "Database updated".
+    """
+    api = HfApi()
+    manifest = load_manifest(dataset_dir)
+    try:
+        remote_manifest = PartitionedDatasetManifest.model_validate_json(
+            Path(
+                api.hf_hub_download(
+                    repo_id=repo_id,
+                    filename=f"{path_in_repo}/{MANIFEST_FILE_NAME}",
+                    repo_type="dataset",
+                    revision=revision,
+                )
+            ).read_bytes()
+        )
+        remote_checksums = {file.path: file.sha256 for file in remote_manifest.files}
+    except EntryNotFoundError:
+        remote_checksums = {}
+
+    changed_files = [
+        file
+        for file in manifest.files
+        if remote_checksums.get(file.path) != file.sha256
+    ]
+    deleted_paths = set(remote_checksums) - {file.path for file in manifest.files}
+    if not changed_files and not deleted_paths:
+        logger.info("No partition changed, skipping push to %s", repo_id)
+        return
+
+    logger.info(
+        "Pushing %d changed partitions (%d bytes, %d unchanged, %d deleted) to %s",
+        len(changed_files),
+        sum(file.size for file in changed_files),
+        len(manifest.files) - len(changed_files),
+        len(deleted_paths),
+        repo_id,
+    )
+    operations: list[CommitOperationAdd | CommitOperationDelete] = [
+        CommitOperationAdd(
+            path_in_repo=f"{path_in_repo}/{file.path}",
+            path_or_fileobj=dataset_dir / file.path,
+        )
+        for file in changed_files
+    ]
+    operations += [
+        CommitOperationDelete(path_in_repo=f"{path_in_repo}/{path}")
+        for path in sorted(deleted_paths)
+    ]
+    operations.append(
+        CommitOperationAdd(
+            path_in_repo=f"{path_in_repo}/{MANIFEST_FILE_NAME}",
+            path_or_fileobj=dataset_dir / MANIFEST_FILE_NAME,
+        )
+    )
+    api.create_commit(
+        repo_id=repo_id,
+        operations=operations,
+        commit_message=commit_message,
+        repo_type="dataset",
+        revision=revision,
+    )
+    logger.info("Data succesfully pushed to Hugging Face at %s", repo_id)
@@ -1,20 +1,27 @@
 import datetime
-import hashlib
 import logging
+import os
 import shutil
 import tempfile
 from decimal import Decimal
 from pathlib import Path
+from typing import Iterable, Iterator
 
+import orjson
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
 import pyarrow.parquet as pq
 import tqdm
 from more_itertools import chunked
-from openfoodfacts.utils import jsonl_iter
+from openfoodfacts.utils import get_open_fn, jsonl_iter
 from pydantic import BaseModel, field_serializer
 
 from openfoodfacts_exports import settings
+from openfoodfacts_exports.exports.manifest import ExportRecorder, RowCounts
 from openfoodfacts_exports.exports.parquet.common import push_parquet_file_to_hf
+from openfoodfacts_exports.exports.parquet.pseudonymize import get_owner_pseudonymizer
+from openfoodfacts_exports.utils import imap_ordered
 
 logger = logging.getLogger(__name__)
 
@@ -39,9 +46,7 @@ class ProofModel(BaseModel):
 
     @field_serializer("owner")
     def serialize_owner(self, owner: str | None, _info) -> str | None:
-        if owner is None:
-            return None
-        return hashlib.sha256(owner.encode("utf-8")).hexdigest()[:8]
+        return get_owner_pseudonymizer().pseudonymize(owner)
 
 
 class LocationModel(BaseModel):
@@ -92,9 +97,7 @@ class PriceModel(BaseModel):
 
     @field_serializer("owner")
     def serialize_owner(self, owner: str | None, _info) -> str | None:
-        if owner is None:
-            return None
-        return hashlib.sha256(owner.encode("utf-8")).hexdigest()[:8]
+        return get_owner_pseudonymizer().pseudonymize(owner)
 
 
 PRICE_PRODUCT_SCHEMA = pa.schema(
@@ -192,7 +195,7 @@ def convert_jsonl_to_parquet(
     batch_size: int = 1024,
     row_group_size: int = 122_880,  # DuckDB default row group size,
     use_tqdm: bool = False,
-) -> None:
+) -> RowCounts:
     """Convert the Open Prices JSONL dataset to Parquet format.
 
     Args:
@@ -209,8 +212,12 @@ def convert_jsonl_to_parquet(
             Parquet file. Defaults to 122_880.
         use_tqdm (bool, optional): Whether to use tqdm to display a progress
             bar. Defaults to False.
+
+    Returns:
+        RowCounts: The number of prices read and of rows written.
     """
     writer = None
+    row_counts = RowCounts()
     item_iter = jsonl_iter(dataset_price_path)
     if use_tqdm:
         item_iter = tqdm.tqdm(item_iter, desc="JSONL")
@@ -266,9 +273,227 @@ def convert_jsonl_to_parquet(
         if writer is None:
             writer = pq.ParquetWriter(output_file_path, schema=record_batch.schema)
         writer.write_batch(record_batch, row_group_size=row_group_size)
+        row_counts.rows_in += len(batch)
+        row_counts.rows_out += len(prices)
 
     if writer is not None:
         writer.close()
+    return row_counts
+
+
+def write_lookup_table(
+    output_path: Path,
+    items: Iterable[dict],
+    model_cls: type[BaseModel],
+    keys: list[str],
+    prefix: str,
+    batch_size: int = 10_000,
+) -> None:
+    """Write the proofs or locations in an Arrow IPC file, to be memory-mapped
+    by the workers of `convert_jsonl_to_parquet_parallel`.
+
+    The table is indexed by ID: the row `i` is the item with ID `i` (IDs are
+    auto-incremented database IDs), rows of missing IDs are null. It has an
+    `id` column and a `{prefix}_{key}` column for each key, with the type of
+    this column in `PRICE_PRODUCT_SCHEMA`.
+
+    The items are converted to Arrow `batch_size` items at a time, so that
+    the memory usage stays close to the size of the table.
+    """
+    schema = pa.schema(
+        [pa.field("id", pa.int64())]
+        + [PRICE_PRODUCT_SCHEMA.field(f"{prefix}_{key}") for key in keys]
+    )
+    chunks = []
+    for batch in chunked(items, batch_size):
+        rows = [model_cls(**item).model_dump() for item in batch]
+        chunks.append(
+            pa.record_batch(
+                [pa.array([row["id"] for row in rows], type=pa.int64())]
+                + [
+                    pa.array([row[key] for row in rows]).cast(
+                        schema.field(f"{prefix}_{key}").type
+                    )
+                    for key in keys
+                ],
+                schema=schema,
+            )
+        )
+    table = pa.Table.from_batches(chunks, schema=schema)
+    # Position in `table` of each ID, the last item wins if an ID is
+    # duplicated
+    max_id = pc.max(table["id"]).as_py()
+    positions: list[int | None] = [None] * (0 if max_id is None else max_id + 1)
+    for position, item_id in enumerate(table["id"].to_pylist()):
+        if item_id is not None:
+            positions[item_id] = position
+    table = table.take(pa.array(positions, type=pa.int64())).combine_chunks()
+    with pa.ipc.new_file(output_path, schema) as writer:
+        writer.write_table(table)
+    logger.info(
+        "%d %s items written to %s",
+        len(positions) - table["id"].null_count,
+        prefix,
+        output_path,
+    )
+
+
+class LookupTable:
+    """Immutable table of proofs or locations indexed by ID, memory-mapped
+    from the file written by `write_lookup_table`.
+
+    The table is shared by all the processes that map it (through the page
+    cache), so the memory usage does not grow with the number of workers.
+    """
+
+    def __init__(self, path: Path):
+        with pa.memory_map(str(path)) as source:
+            self.table = pa.ipc.open_file(source).read_all()
+
+    def take(self, ids: pa.Array) -> pa.Table:
+        """Return the rows with the given IDs (null rows for null IDs),
+        without the `id` column.
+
+        Raises:
+            KeyError: if an ID is not in the table.
+        """
+        max_id = pc.max(ids).as_py()
+        if max_id is not None and max_id >= self.table.num_rows:
+            raise KeyError(max_id)
+        rows = self.table.take(ids)
+        missing = pc.and_(ids.is_valid(), rows["id"].is_null())
+        if pc.any(missing).as_py():
+            raise KeyError(ids.filter(missing)[0].as_py())
+        return rows.drop_columns(["id"])
+
+
+# Lookup tables of the current worker process, see `_init_price_worker`
+_proof_table: LookupTable | None = None
+_location_table: LookupTable | None = None
+
+
+def _init_price_worker(proof_table_path: Path, location_table_path: Path) -> None:
+    global _proof_table, _location_table
+    _proof_table = LookupTable(proof_table_path)
+    _location_table = LookupTable(location_table_path)
+
+
+def convert_price_lines(lines: list[bytes], batch_size: int) -> list[pa.RecordBatch]:
+    """Convert a shard of price JSONL lines to record batches of
+    `batch_size` prices, joined with the lookup tables of the worker."""
+    assert _proof_table is not None and _location_table is not None
+    record_batches = []
+    for batch in chunked(lines, batch_size):
+        prices = [PriceModel(**orjson.loads(line)).model_dump() for line in batch]
+        columns = {key: pa.array([price[key] for price in prices]) for key in prices[0]}
+        proofs = _proof_table.take(
+            pa.array([price["proof_id"] for price in prices], type=pa.int64())
+        )
+        locations = _location_table.take(
+            pa.array([price["location_id"] for price in prices], type=pa.int64())
+        )
+        for table in (proofs, locations):
+            for name, column in zip(table.column_names, table.columns):
+                columns[name] = column.combine_chunks()
+        record_batches.append(
+            pa.record_batch(
+                [columns[name] for name in PRICE_PRODUCT_SCHEMA.names],
+                schema=PRICE_PRODUCT_SCHEMA,
+            )
+        )
+    return record_batches
+
+
+def _iter_shards(dataset_path: Path, shard_size: int) -> Iterator[list[bytes]]:
+    """Iterate over shards of at most `shard_size` non-empty JSONL lines."""
+    open_fn = get_open_fn(dataset_path)
+    with open_fn(str(dataset_path), "rb") as f:
+        yield from chunked((line for line in f if line.strip()), shard_size)
+
+
+def convert_jsonl_to_parquet_parallel(
+    output_file_path: Path,
+    dataset_price_path: Path,
+    dataset_proof_path: Path,
+    dataset_location_path: Path,
+    num_processes: int | None = None,
+    batch_size: int = 1024,
+    batches_per_shard: int = 16,
+    row_group_size: int = 122_880,  # DuckDB default row group size,
+) -> RowCounts:
+    """Convert the Open Prices JSONL dataset to Parquet format, in a process
+    pool.
+
+    The proofs and locations are written once to lookup tables (see
+    `write_lookup_table`), memory-mapped by the workers. Shards of prices are
+    converted and joined with the lookup tables by the workers, and written
+    in the input order. The output is the same as `convert_jsonl_to_parquet`.
+
+    Args:
+        output_file_path (Path): The path where the Parquet file will be saved.
+        dataset_price_path (Path): The path to the `price` JSONL dataset.
+        dataset_proof_path (Path): The path to the `proof` JSONL dataset.
+        dataset_location_path (Path): The path to the `location` JSONL dataset.
+        num_processes (int, optional): The number of worker processes,
+            defaults to the number of CPUs.
+        batch_size (int, optional): The size of the batches used to convert the
+            dataset. Defaults to 1024.
+        batches_per_shard (int, optional): The number of batches sent to a
+            worker at once. Defaults to 16.
+        row_group_size (int, optional): The size of the row groups in the
+            Parquet file. Defaults to 122_880.
+
+    Returns:
+        RowCounts: The number of prices read and of rows written.
+    """
+    num_processes = num_processes or os.cpu_count() or 1
+    row_counts = RowCounts()
+    writer = None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        proof_table_path = Path(tmp_dir) / "proofs.arrow"
+        location_table_path = Path(tmp_dir) / "locations.arrow"
+        write_lookup_table(
+            proof_table_path,
+            jsonl_iter(dataset_proof_path),
+            ProofModel,
+            PROOF_KEYS,
+            "proof",
+        )
+        write_lookup_table(
+            location_table_path,
+            jsonl_iter(dataset_location_path),
+            LocationModel,
+            LOCATION_KEYS,
+            "location",
+        )
+        logger.info("Converting prices with %d processes", num_processes)
+
+        try:
+            for record_batches in imap_ordered(
+                convert_price_lines,
+                (
+                    (shard, batch_size)
+                    for shard in _iter_shards(
+                        dataset_price_path, batch_size * batches_per_shard
+                    )
+                ),
+                num_processes,
+                initializer=_init_price_worker,
+                initargs=(proof_table_path, location_table_path),
+            ):
+                for record_batch in record_batches:
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            output_file_path, schema=record_batch.schema
+                        )
+                    writer.write_batch(record_batch, row_group_size=row_group_size)
+                    row_counts.rows_in += record_batch.num_rows
+                    row_counts.rows_out += record_batch.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+    return row_counts
 
 
 def export_parquet(
@@ -285,22 +510,39 @@ def export_parquet(
     """
     logger.info("Start Open Prices JSONL export to Parquet.")
 
+    recorder = ExportRecorder("parquet-price")
+    for dataset_path in dataset_paths.values():
+        recorder.add_input(dataset_path)
     with tempfile.TemporaryDirectory() as tmp_dir:
         tmp_converted_parquet_path = Path(tmp_dir) / "converted_data.parquet"
-        convert_jsonl_to_parquet(
-            output_file_path=tmp_converted_parquet_path,
-            dataset_price_path=dataset_paths["price"],
-            dataset_proof_path=dataset_paths["proof"],
-            dataset_location_path=dataset_paths["location"],
-            use_tqdm=use_tqdm,
-        )
+        with recorder.stage("convert"):
+            if settings.PRICE_EXPORT_NUM_PROCESSES > 1:
+                row_counts = convert_jsonl_to_parquet_parallel(
+                    output_file_path=tmp_converted_parquet_path,
+                    dataset_price_path=dataset_paths["price"],
+                    dataset_proof_path=dataset_paths["proof"],
+                    dataset_location_path=dataset_paths["location"],
+                    num_processes=settings.PRICE_EXPORT_NUM_PROCESSES,
+                )
+            else:
+                row_counts = convert_jsonl_to_parquet(
+                    output_file_path=tmp_converted_parquet_path,
+                    dataset_price_path=dataset_paths["price"],
+                    dataset_proof_path=dataset_paths["proof"],
+                    dataset_location_path=dataset_paths["location"],
+                    use_tqdm=use_tqdm,
+                )
+        recorder.set_row_counts(row_counts)
         # Move dataset file to output_path
         shutil.move(tmp_converted_parquet_path, output_path)
+    recorder.add_artifact(output_path)
 
-    if settings.ENABLE_HF_PUSH:
-        push_parquet_file_to_hf(
-            data_path=output_path, repo_id="openfoodfacts/open-prices"
-        )
-    else:
-        logger.info("Hugging Face push is disabled.")
+    with recorder.stage("push"):
+        if settings.ENABLE_HF_PUSH:
+            push_parquet_file_to_hf(
+                data_path=output_path, repo_id="openfoodfacts/open-prices"
+            )
+        else:
+            logger.info("Hugging Face push is disabled.")
+    recorder.finish()
     logger.info("JSONL to Parquet conversion and postprocessing completed.")
@@ -0,0 +1,82 @@
+"""Pseudonymization of the owners of prices and proofs.
+
+Owners (Open Food Facts user names) are replaced in the price export by the
+first 8 hex characters of a hash:
+
+- by default, the SHA-256 of the owner. The pseudonyms are stable across
+  exports, but can be reversed with a dictionary of user names.
+- if `settings.PRICE_OWNER_HASH_KEY` is set, the HMAC-SHA256 of the owner
+  with this secret key, that can't be reversed without the key.
+
+There are few distinct owners compared to the number of prices, so the
+pseudonyms are cached (in a bounded LRU cache).
+"""
+
+import functools
+import hashlib
+import hmac
+
+import pyarrow as pa
+
+from openfoodfacts_exports import settings
+
+# Number of owners whose pseudonym is cached
+OWNER_CACHE_SIZE = 65_536
+# Number of hex characters of the pseudonyms
+PSEUDONYM_LENGTH = 8
+
+
+class OwnerPseudonymizer:
+    """Replace owners by the truncated SHA-256 (or HMAC-SHA256 if a key is
+    given) of their name, with a bounded cache of the pseudonyms.
+
+    Args:
+        key: The secret key of the HMAC, owners are hashed with SHA-256 if
+            it is empty or None.
+        cache_size: The maximum number of pseudonyms cached.
+    """
+
+    def __init__(self, key: str | None = None, cache_size: int = OWNER_CACHE_SIZE):
+        self._key = key.encode("utf-8") if key else None
+        self._get_pseudonym = functools.lru_cache(maxsize=cache_size)(
+            self._compute_pseudonym
+        )
+
+    def _compute_pseudonym(self, owner: str) -> str:
+        data = owner.encode("utf-8")
+        if self._key is None:
+            digest = hashlib.sha256(data).hexdigest()
+        else:
+            digest = hmac.new(self._key, data, hashlib.sha256).hexdigest()
+        return digest[:PSEUDONYM_LENGTH]
+
+    def pseudonymize(self, owner: str | None) -> str | None:
+        """Return the pseudonym of an owner (None for a None owner)."""
+        if owner is None:
+            return None
+        return self._get_pseudonym(owner)
+
+    def pseudonymize_array(self, owners: pa.Array | pa.ChunkedArray) -> pa.Array:
+        """Return the pseudonyms of a string array of owners (nulls are kept).
+
+        Each distinct owner is hashed once: the array is dictionary-encoded,
+        and the pseudonyms of the dictionary are taken by index.
+        """
+        if isinstance(owners, pa.ChunkedArray):
+            owners = owners.combine_chunks()
+        encoded = owners.dictionary_encode()
+        pseudonyms = pa.array(
+            [self._get_pseudonym(owner) for owner in encoded.dictionary.to_pylist()],
+            type=pa.string(),
+        )
+        return pseudonyms.take(encoded.indices)
+
+    def cache_info(self) -> functools._CacheInfo:
+        return self._get_pseudonym.cache_info()
+
+
+@functools.cache
+def get_owner_pseudonymizer() -> OwnerPseudonymizer:
+    """Return the pseudonymizer of the price export, configured with
+    `settings.PRICE_OWNER_HASH_KEY`."""
+    return OwnerPseudonymizer(settings.PRICE_OWNER_HASH_KEY)
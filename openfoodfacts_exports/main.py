@@ -1,3 +1,5 @@
+from pathlib import Path
+
 import typer
 
 from openfoodfacts_exports.types import ExportFlavor
@@ -50,8 +52,36 @@ def run_worker(queues: list[str], burst: bool = False):
 
 
 @app.command()
-def launch_export(flavor: ExportFlavor) -> None:
-    """Launch an export job for a given flavor."""
+def run_worker_pool(
+    num_cpu_workers: int | None = None,
+    num_threads: int | None = None,
+    burst: bool = False,
+):
+    """Run workers in pool mode: CPU-heavy jobs run in a pool of processes
+    sized by the available cores and memory, light jobs in a pool of threads.
+    """
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports import settings
+    from openfoodfacts_exports.utils import init_sentry
+    from openfoodfacts_exports.workers.pool import run_pool
+
+    # configure root logger
+    get_logger()
+    init_sentry()
+    run_pool(
+        num_cpu_workers=num_cpu_workers,
+        num_threads=num_threads or settings.LIGHT_JOB_THREADS,
+        burst=burst,
+    )
+
+
+@app.command()
+def launch_export(flavor: ExportFlavor, force: bool = False) -> None:
+    """Launch an export job for a given flavor.
+
+    The export is skipped if the dataset did not change since the last
+    successful export, unless `--force` is used."""
     from openfoodfacts.utils import get_logger
 
     from openfoodfacts_exports.tasks import export_job
@@ -60,4 +90,270 @@ def launch_export(flavor: ExportFlavor) -> None:
     # configure root logger
     get_logger()
     init_sentry()
-    export_job(flavor)
+    export_job(flavor, force=force)
+
+
+@app.command()
+def backfill_revisions(
+    dataset_path: Path | None = None,
+    flavor: ExportFlavor = ExportFlavor.off,
+    checkpoint_path: Path | None = None,
+    num_workers: int = 32,
+    rate_limit: float | None = None,
+    skip_existing: bool = True,
+) -> None:
+    """Upload product revisions from the JSONL dump to the revision bucket.
+
+    If no dataset path is provided, the JSONL dump of the flavor is
+    downloaded. The backfill resumes from the last checkpoint if it was
+    interrupted. `rate_limit` is the maximum number of products processed per
+    second.
+    """
+    from openfoodfacts import Flavor, get_dataset
+    from openfoodfacts.types import DatasetType
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports.tasks.backfill import (
+        backfill_revisions as _backfill_revisions,
+    )
+    from openfoodfacts_exports.utils import init_sentry
+
+    # configure root logger
+    get_logger()
+    init_sentry()
+
+    if dataset_path is None:
+        dataset_path = get_dataset(
+            flavor=Flavor[flavor], dataset_type=DatasetType.jsonl, download_newer=True
+        )
+    _backfill_revisions(
+        dataset_path=dataset_path,
+        checkpoint_path=checkpoint_path,
+        num_workers=num_workers,
+        rate_limit=rate_limit,
+        skip_existing=skip_existing,
+    )
+
+
+@app.command()
+def redact_jsonl(
+    input_path: Path,
+    output_path: Path,
+    num_processes: int | None = None,
+    block_size: int = 1000,
+    compression_level: int = 6,
+) -> None:
+    """Remove user IDs from all products of a JSONL dump.
+
+    The same rules as for the revisions uploaded to S3 are used. Input and
+    output can be gzipped (`.gz` extension).
+    """
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports.tasks.redaction import redact_jsonl_dump
+
+    # configure root logger
+    get_logger()
+    redact_jsonl_dump(
+        input_path=input_path,
+        output_path=output_path,
+        num_processes=num_processes,
+        block_size=block_size,
+        compression_level=compression_level,
+    )
+
+
+@app.command()
+def build_historical_events(
+    revision_dir: Path | None = None,
+    revision_index_path: Path | None = None,
+    output_path: Path | None = None,
+    parquet_dir: Path | None = None,
+    flavor: ExportFlavor = ExportFlavor.off,
+    num_processes: int | None = None,
+    block_size: int = 100,
+    compression_level: int = 9,
+) -> None:
+    """Build the historical events dump from the stored product revisions.
+
+    Revisions are read from `revision_dir` if provided (same layout as the
+    revision bucket), from the S3 revision bucket otherwise. With
+    `--revision-index-path`, the products of the S3 revision bucket are listed
+    from this local revision index instead of the bucket. The events are
+    written to `{flavor}_historical_events.jsonl.gz` in the
+    dataset directory by default. If `parquet_dir` is provided, the events
+    are also converted to a month-partitioned Parquet dataset in this
+    directory.
+    """
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports import settings
+    from openfoodfacts_exports.exports.historical_events_backfill import (
+        build_historical_events as _build_historical_events,
+    )
+    from openfoodfacts_exports.tasks.revision_index import RevisionIndex
+    from openfoodfacts_exports.tasks.revision_store import (
+        LocalRevisionStore,
+        RevisionStore,
+        S3RevisionStore,
+    )
+
+    # configure root logger
+    get_logger()
+
+    store: RevisionStore
+    if revision_dir is None:
+        store = S3RevisionStore(
+            revision_index=(
+                RevisionIndex(revision_index_path) if revision_index_path else None
+            )
+        )
+    else:
+        store = LocalRevisionStore(revision_dir)
+    if output_path is None:
+        output_path = (
+            settings.DATASET_DIR / f"{flavor.value}_historical_events.jsonl.gz"
+        )
+    _build_historical_events(
+        store=store,
+        output_path=output_path,
+        num_processes=num_processes,
+        block_size=block_size,
+        compression_level=compression_level,
+    )
+    if parquet_dir is not None:
+        from openfoodfacts_exports.exports.parquet.historical_events import (
+            convert_events_jsonl_to_parquet,
+        )
+
+        convert_events_jsonl_to_parquet(output_path, parquet_dir)
+
+
+@app.command()
+def build_revision_index(index_path: Path | None = None) -> None:
+    """Rebuild the local revision index from a listing of the S3 revision
+    bucket.
+
+    The index is written to `index_path` if provided, to the path of the
+    `REVISION_INDEX_PATH` setting otherwise.
+    """
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports import settings
+    from openfoodfacts_exports.tasks.revision_index import (
+        build_revision_index_from_bucket,
+    )
+    from openfoodfacts_exports.utils import get_minio_client
+
+    # configure root logger
+    get_logger()
+
+    if index_path is None:
+        if not settings.REVISION_INDEX_PATH:
+            raise typer.BadParameter(
+                "--index-path is required if REVISION_INDEX_PATH is not set"
+            )
+        index_path = Path(settings.REVISION_INDEX_PATH)
+    build_revision_index_from_bucket(index_path, get_minio_client())
+
+
+@app.command()
+def pack_revisions(
+    pack_dir: Path,
+    revision_dir: Path | None = None,
+    revision_index_path: Path | None = None,
+    upload: bool = False,
+    shard_prefix_length: int = 3,
+    num_threads: int = 8,
+) -> None:
+    """Append the product revisions that are not packed yet to the revision
+    packs (one pack per barcode prefix) in `pack_dir`.
+
+    Revisions are read from `revision_dir` if provided (same layout as the
+    revision bucket), from the S3 revision bucket otherwise. With
+    `--revision-index-path`, the products of the S3 revision bucket are listed
+    from this local revision index instead of the bucket. With `--upload`,
+    the updated packs are uploaded to the revision bucket.
+    """
+    from openfoodfacts.utils import get_logger
+
+    from openfoodfacts_exports.tasks.revision_packs import (
+        pack_revisions as _pack_revisions,
+    )
+    from openfoodfacts_exports.tasks.revision_packs import upload_packs
+    from openfoodfacts_exports.tasks.revision_index import RevisionIndex
+    from openfoodfacts_exports.tasks.revision_store import (
+        LocalRevisionStore,
+        RevisionStore,
+        S3RevisionStore,
+    )
+
+    # configure root logger
+    get_logger()
+
+    store: RevisionStore
+    if revision_dir is None:
+        store = S3RevisionStore(
+            revision_index=(
+                RevisionIndex(revision_index_path) if revision_index_path else None
+            )
+        )
+    else:
+        store = LocalRevisionStore(revision_dir)
+    stats = _pack_revisions(
+        store,
+        pack_dir,
+        shard_prefix_length=shard_prefix_length,
+        num_threads=num_threads,
+    )
+    if upload:
+        upload_packs(pack_dir, stats.updated_shards, api_version=store.api_version)
+
+
+@app.command()
+def diff_export_manifests(
+    old_manifest_path: Path | None = None,
+    new_manifest_path: Path | None = None,
+    export_name: str | None = None,
+    threshold: float = 0.1,
+) -> None:
+    """Compare two export manifests (durations, memory, row counts, output
+    sizes...).
+
+    Either give the paths of two manifests, or the name of an export (ex:
+    `parquet-off`) to compare its last two runs, from the history stored in
+    Redis. Metrics that changed by more than `threshold` (relative change)
+    are flagged with `!`.
+    """
+    from openfoodfacts_exports.exports.manifest import (
+        ExportManifest,
+        diff_manifests,
+        format_diff,
+        get_history,
+    )
+
+    if export_name is not None:
+        from openfoodfacts_exports.workers.redis import redis_conn
+
+        history = get_history(redis_conn, export_name)
+        if len(history) < 2:
+            raise typer.BadParameter(
+                f"Less than 2 manifests in the history of {export_name}"
+            )
+        new_manifest, old_manifest = history[:2]
+    elif old_manifest_path is not None and new_manifest_path is not None:
+        old_manifest = ExportManifest.model_validate_json(
+            old_manifest_path.read_bytes()
+        )
+        new_manifest = ExportManifest.model_validate_json(
+            new_manifest_path.read_bytes()
+        )
+    else:
+        raise typer.BadParameter(
+            "Either two manifest paths or --export-name must be provided"
+        )
+    typer.echo(
+        f"{old_manifest.export_name}: {old_manifest.started_at} -> "
+        f"{new_manifest.started_at}"
+    )
+    typer.echo(format_diff(diff_manifests(old_manifest, new_manifest), threshold))
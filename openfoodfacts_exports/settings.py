@@ -5,26 +5,99 @@ PROJECT_DIR = Path(__file__).parent.parent
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 
+# Worker pool mode (`run-worker-pool`): memory budget (in MB) of a CPU-heavy job,
+# used to size the pool of CPU-heavy job workers, and number of threads running
+# light jobs
+CPU_JOB_MEMORY_MB = int(os.getenv("CPU_JOB_MEMORY_MB", "4096"))
+LIGHT_JOB_THREADS = int(os.getenv("LIGHT_JOB_THREADS", "4"))
+# Admission control (see `workers/admission.py`): memory (in MB) and CPUs shared
+# by the concurrently running jobs that have a budget
+ADMISSION_MEMORY_MB = int(os.getenv("ADMISSION_MEMORY_MB", "7168"))
+ADMISSION_CPUS = float(os.getenv("ADMISSION_CPUS", str(os.cpu_count() or 1)))
+
 DATASET_DIR_STR = os.getenv("DATASET_DIR", PROJECT_DIR / "datasets")
 DATASET_DIR = Path(DATASET_DIR_STR)
 
 if not DATASET_DIR.exists():
     raise FileNotFoundError(f"{str(DATASET_DIR_STR)} was not found.")
 
+# Directory where long-running conversions save their checkpoints, to resume
+# from them if the job is interrupted
+CHECKPOINT_DIR = Path(os.getenv("CHECKPOINT_DIR", DATASET_DIR / "checkpoints"))
+
+# Number of connections used to download the dataset dumps (with HTTP range
+# requests, see `tasks/download.py`)
+DOWNLOAD_NUM_CONNECTIONS = int(os.getenv("DOWNLOAD_NUM_CONNECTIONS", "4"))
+# If enabled, the product dataset is converted to Parquet while it is downloaded
+# (with a single connection), instead of being downloaded first
+ENABLE_STREAMING_CONVERSION = int(os.getenv("ENABLE_STREAMING_CONVERSION", "0"))
+
 
 SENTRY_DSN = os.environ.get("SENTRY_DSN")
 ENVIRONMENT = os.environ.get("ENVIRONMENT", "dev")
 
 ENABLE_HF_PUSH = int(os.getenv("ENABLE_HF_PUSH", "0"))
 
+# If enabled, the product Parquet files are also split into a dataset
+# partitioned by main language (see `exports/parquet/partitioned.py`), written
+# next to them (ex: `food/` for `food.parquet`). With ENABLE_HF_PUSH, the
+# partitions that changed are pushed to Hugging Face next to the full files.
+ENABLE_PARQUET_PARTITIONS = int(os.getenv("ENABLE_PARQUET_PARTITIONS", "0"))
+
+# Number of processes converting the prices to Parquet. If greater than 1, the
+# prices are converted in a process pool, with the proofs and locations in
+# memory-mapped lookup tables (see `exports/parquet/price.py`)
+PRICE_EXPORT_NUM_PROCESSES = int(os.getenv("PRICE_EXPORT_NUM_PROCESSES", "1"))
+# Secret key used to pseudonymize the owners of prices and proofs with an
+# HMAC-SHA256 (see `exports/parquet/pseudonymize.py`). If empty, owners are
+# replaced by their (unkeyed) SHA-256, that can be reversed with a dictionary of
+# user names. Changing it changes all the pseudonyms of the export.
+PRICE_OWNER_HASH_KEY = os.getenv("PRICE_OWNER_HASH_KEY", "")
+
 ENABLE_S3_PUSH = int(os.getenv("ENABLE_S3_PUSH", "0"))
 
+# S3 endpoint, can be changed to use a S3-compatible storage (ex: a local MinIO
+# instance for development)
+AWS_S3_ENDPOINT = os.getenv("AWS_S3_ENDPOINT", "s3.amazonaws.com")
+AWS_S3_SECURE = bool(int(os.getenv("AWS_S3_SECURE", "1")))
+
 AWS_S3_DATASET_BUCKET = os.getenv("AWS_S3_DATASET_BUCKET", "openfoodfacts-ds")
 AWS_S3_IMAGE_BUCKET = os.getenv("AWS_S3_IMAGE_BUCKET", "openfoodfacts-images")
 AWS_S3_REVISION_BUCKET = os.getenv(
     "AWS_S3_REVISION_BUCKET", "openfoodfacts-product-revisions"
 )
 
+# Maximum number of seconds S3 deletions triggered by the update listener are
+# buffered before being sent in a single multi-object delete request
+S3_DELETION_WINDOW = float(os.getenv("S3_DELETION_WINDOW", "5"))
+
+# If enabled, all the revisions of a product are removed from S3 when the
+# product is deleted (only `latest.json` is removed otherwise)
+PURGE_REVISIONS_ON_DELETION = int(os.getenv("PURGE_REVISIONS_ON_DELETION", "0"))
+
+# Path of the local revision index (see `tasks/revision_index.py`), updated by
+# the update listener when revisions are uploaded. Disabled if empty.
+REVISION_INDEX_PATH = os.getenv("REVISION_INDEX_PATH", "")
+# Number of journal records of the revision index after which the update
+# listener enqueues a job merging the journal into the index file
+REVISION_INDEX_MERGE_THRESHOLD = int(
+    os.getenv("REVISION_INDEX_MERGE_THRESHOLD", "100000")
+)
+
+# If enabled, the update listener generates the historical events of updated
+# products, and appends them to the historical event store
+ENABLE_HISTORICAL_EVENT_CAPTURE = int(os.getenv("ENABLE_HISTORICAL_EVENT_CAPTURE", "0"))
+HISTORICAL_EVENT_STORE_DIR = Path(
+    os.getenv("HISTORICAL_EVENT_STORE_DIR", DATASET_DIR / "historical_events")
+)
+# Memory budget (in MB) of the cache of the last revision of each product,
+# used to generate historical events
+HISTORICAL_EVENT_CACHE_SIZE_MB = int(os.getenv("HISTORICAL_EVENT_CACHE_SIZE_MB", "256"))
+# Maximum number of seconds historical events are buffered before being written
+HISTORICAL_EVENT_FLUSH_INTERVAL = float(
+    os.getenv("HISTORICAL_EVENT_FLUSH_INTERVAL", "60")
+)
+
 # Remote Redis where Product Opener publishes product updates in a stream
 REDIS_UPDATE_HOST = os.environ.get("REDIS_UPDATE_HOST", "localhost")
 REDIS_UPDATE_PORT = int(os.environ.get("REDIS_UPDATE_PORT", 6379))
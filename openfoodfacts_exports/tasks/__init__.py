@@ -1,60 +1,115 @@
 import logging
 from pathlib import Path
 
-from openfoodfacts import Flavor, get_dataset
-from openfoodfacts.dataset import DEFAULT_CACHE_DIR
+from openfoodfacts import Environment, Flavor
+from openfoodfacts.dataset import DATASET_FILE_NAMES, DEFAULT_CACHE_DIR
 from openfoodfacts.types import DatasetType
 from openfoodfacts.utils import (
-    download_file,
+    URLBuilder,
+    fetch_etag,
+    get_file_etag,
     should_download_file,
 )
+from rq import Retry
 
-from openfoodfacts_exports.exports.csv.mobile import generate_push_mobile_app_dump
+from openfoodfacts_exports import settings
+from openfoodfacts_exports.exports.csv.mobile import (
+    MOBILE_APP_DUMP_DATASET_PATH,
+    generate_push_mobile_app_dump,
+)
+from openfoodfacts_exports.exports.export_state import (
+    get_source_fingerprint,
+    save_fingerprint,
+    should_skip_export,
+)
 from openfoodfacts_exports.exports.parquet import PARQUET_DATASET_PATH, export_parquet
 from openfoodfacts_exports.exports.parquet.price import PRICE_DATASET_PATH
 from openfoodfacts_exports.exports.parquet.price import (
     export_parquet as export_price_parquet,
 )
+from openfoodfacts_exports.tasks.download import download_file_parallel
 from openfoodfacts_exports.types import ExportFlavor
-from openfoodfacts_exports.workers.queues import high_queue
+from openfoodfacts_exports.workers.admission import enqueue_with_budget
+from openfoodfacts_exports.workers.queues import cpu_queue, high_queue
+from openfoodfacts_exports.workers.redis import redis_conn
 
 logger = logging.getLogger(__name__)
 
 
-def export_job(export_flavor: ExportFlavor) -> None:
-    """Download the JSONL dataset and launch exports through new rq jobs."""
+def export_job(export_flavor: ExportFlavor, force: bool = False) -> None:
+    """Download the JSONL dataset and launch exports through new rq jobs.
+
+    The exports are skipped if the dataset did not change (same ETag) since
+    the last successful export, unless `force` is True.
+    """
     logger.info("Start export job for flavor %s", export_flavor)
 
     if export_flavor == ExportFlavor.op:
-        export_price_job()
+        export_price_job(force=force)
         return
 
     flavor = Flavor[export_flavor]
-    dataset_path = get_dataset(
-        flavor=flavor, dataset_type=DatasetType.jsonl, download_newer=True
-    )
+    if flavor in (Flavor.off, Flavor.obf) and settings.ENABLE_STREAMING_CONVERSION:
+        url, dataset_path = get_product_dataset_location(flavor)
+        remote_etag = fetch_etag(url)
+        # A new dataset is downloaded by the conversion job, while it is
+        # converted
+        dataset_url = url if remote_etag != get_file_etag(dataset_path) else None
+        fingerprint = remote_etag or None
+    else:
+        dataset_path = get_product_dataset(flavor, download_newer=True)
+        dataset_url = None
+        fingerprint = get_source_fingerprint([dataset_path])
 
     if flavor in (Flavor.off, Flavor.obf):
-        export_parquet_job = high_queue.enqueue(
+        export_name = f"parquet-{flavor.name}"
+        output_paths = [PARQUET_DATASET_PATH[flavor]]
+        if flavor is Flavor.off:
+            output_paths.append(MOBILE_APP_DUMP_DATASET_PATH)
+        if not force and should_skip_export(
+            redis_conn, export_name, fingerprint, output_paths
+        ):
+            return
+
+        last_job = export_parquet_job = enqueue_with_budget(
+            cpu_queue,
             export_parquet,
             dataset_path,
             PARQUET_DATASET_PATH[flavor],
             export_flavor,
+            dataset_url=dataset_url,
+            input_paths=[dataset_path],
             job_timeout="3h",
+            # The conversion resumes from its last checkpoint (or restarts the
+            # download in streaming mode)
+            retry=Retry(max=2),
         )
 
         if flavor is Flavor.off:
-            high_queue.enqueue(
+            last_job = enqueue_with_budget(
+                cpu_queue,
                 generate_push_mobile_app_dump,
                 PARQUET_DATASET_PATH[flavor],
+                # The Parquet file of the previous export, if any
+                input_paths=[PARQUET_DATASET_PATH[flavor]],
                 depends_on=export_parquet_job,
                 job_timeout="3h",
             )
 
+        if fingerprint is not None:
+            # Only saved once all the exports succeeded
+            high_queue.enqueue(
+                save_fingerprint, export_name, fingerprint, depends_on=last_job
+            )
+
 
-def export_price_job() -> None:
+def export_price_job(force: bool = False) -> None:
     """Download the Open Prices dataset (made of 3 JSONL dumps) and launch the
-    Parquet export through a new rq job."""
+    Parquet export through a new rq job.
+
+    The export is skipped if none of the dumps changed since the last
+    successful export, unless `force` is True.
+    """
     logger.info("Start export job for price dataset")
 
     dataset_paths = {}
@@ -65,13 +120,68 @@ def export_price_job() -> None:
     ):
         dataset_paths[key] = get_price_dataset(file_name, download_newer=True)
 
+    fingerprint = get_source_fingerprint(list(dataset_paths.values()))
+    if not force and should_skip_export(
+        redis_conn, "parquet-price", fingerprint, [PRICE_DATASET_PATH]
+    ):
+        return
+
     logger.info("Enqueueing export job for price dataset")
-    high_queue.enqueue(
+    price_export_job = enqueue_with_budget(
+        cpu_queue,
         export_price_parquet,
         dataset_paths,
         PRICE_DATASET_PATH,
+        input_paths=list(dataset_paths.values()),
         job_timeout="3h",
     )
+    if fingerprint is not None:
+        high_queue.enqueue(
+            save_fingerprint, "parquet-price", fingerprint, depends_on=price_export_job
+        )
+
+
+def get_product_dataset_location(
+    flavor: Flavor, cache_dir: Path | None = None
+) -> tuple[str, Path]:
+    """Return the URL of the JSONL dataset of a flavor, and its path in the
+    cache directory (created if needed)."""
+    cache_dir = DEFAULT_CACHE_DIR if cache_dir is None else cache_dir
+    file_name = DATASET_FILE_NAMES[flavor][DatasetType.jsonl]
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return (
+        f"{URLBuilder.static(flavor, Environment.org)}/data/{file_name}",
+        cache_dir / file_name,
+    )
+
+
+def get_product_dataset(
+    flavor: Flavor, download_newer: bool = False, cache_dir: Path | None = None
+) -> Path:
+    """Download (and cache) the JSONL dataset of a flavor.
+
+    Same as `openfoodfacts.get_dataset`, but the dataset is downloaded with
+    several connections (see `tasks/download.py`).
+
+    Args:
+        flavor (Flavor): The flavor of the dataset.
+        download_newer (bool, optional): if True, download the dataset if a
+        more recent version is available (based on file Etag)
+        cache_dir (Path, optional): the cache directory to use, defaults to
+        ~/.cache/openfoodfacts/datasets.
+
+    Returns:
+        The path to the downloaded dataset.
+    """
+    url, dataset_path = get_product_dataset_location(flavor, cache_dir)
+    if not should_download_file(url, dataset_path, False, download_newer):
+        return dataset_path
+
+    logger.info("Downloading dataset, saving it in %s", dataset_path)
+    download_file_parallel(
+        url, dataset_path, num_connections=settings.DOWNLOAD_NUM_CONNECTIONS
+    )
+    return dataset_path
 
 
 def get_price_dataset(
@@ -108,5 +218,7 @@ def get_price_dataset(
         return dataset_path
 
     logger.info("Downloading dataset, saving it in %s", dataset_path)
-    download_file(url, dataset_path)
+    download_file_parallel(
+        url, dataset_path, num_connections=settings.DOWNLOAD_NUM_CONNECTIONS
+    )
     return dataset_path
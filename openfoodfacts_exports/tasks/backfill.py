@@ -0,0 +1,259 @@
+"""Bulk synchronization of product revisions from the JSONL dump.
+
+Revisions are normally uploaded to S3 by the update listener, when a product
+is updated. Products that were not edited since the listener went live have
+no revision stored, this module fills the gap from the JSONL dump.
+"""
+
+import collections
+import enum
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import orjson
+from minio import Minio
+from openfoodfacts import APIVersion
+from openfoodfacts.utils import get_file_etag
+from pydantic import BaseModel
+
+from openfoodfacts_exports.tasks.revisions import (
+    revision_exists,
+    strip_product_from_user_ids,
+    upload_revision,
+)
+from openfoodfacts_exports.utils import RateLimiter, get_minio_client, open_dataset
+
+logger = logging.getLogger(__name__)
+
+
+class BackfillCheckpoint(BaseModel):
+    """Progress of a backfill, persisted to be able to resume it."""
+
+    dataset_path: str
+    # Etag of the dataset, the checkpoint is discarded if the dataset changed
+    dataset_etag: str | None = None
+    # Offset in the uncompressed JSONL stream, all products before this
+    # offset were processed
+    offset: int = 0
+    products: int = 0
+    uploaded_objects: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+
+class BackfillResult(enum.Enum):
+    """Outcome of the backfill of a single product."""
+
+    # Only the revision was uploaded
+    UPLOADED = 1
+    # The revision was uploaded and set as latest
+    UPLOADED_AS_LATEST = 2
+    SKIPPED = 3
+    FAILED = 4
+
+
+def get_default_checkpoint_path(dataset_path: Path) -> Path:
+    """Return the path of the checkpoint file for a dataset."""
+    return dataset_path.with_name(f"{dataset_path.name}.backfill.json")
+
+
+def load_checkpoint(checkpoint_path: Path, dataset_path: Path) -> BackfillCheckpoint:
+    """Load the checkpoint of a previous backfill run, or return a fresh
+    checkpoint if none is available or if the dataset changed since."""
+    dataset_etag = get_file_etag(dataset_path)
+    if checkpoint_path.is_file():
+        checkpoint = BackfillCheckpoint.model_validate_json(
+            checkpoint_path.read_bytes()
+        )
+        if (
+            checkpoint.dataset_path == str(dataset_path)
+            and checkpoint.dataset_etag == dataset_etag
+        ):
+            return checkpoint
+        logger.warning(
+            "Dataset changed since checkpoint %s was saved, starting from scratch",
+            checkpoint_path,
+        )
+    return BackfillCheckpoint(dataset_path=str(dataset_path), dataset_etag=dataset_etag)
+
+
+def save_checkpoint(checkpoint: BackfillCheckpoint, checkpoint_path: Path) -> None:
+    """Save the checkpoint atomically."""
+    tmp_path = checkpoint_path.with_name(f"{checkpoint_path.name}.tmp")
+    tmp_path.write_text(checkpoint.model_dump_json())
+    tmp_path.replace(checkpoint_path)
+
+
+def backfill_product(
+    minio_client: Minio,
+    line: bytes,
+    api_version: APIVersion = APIVersion.v2,
+    skip_existing: bool = True,
+) -> BackfillResult:
+    """Upload the revision of a single product from the JSONL dump.
+
+    The revision is set as latest only if no latest revision is stored yet,
+    as the revision from the dump may be older than the one uploaded by the
+    update listener.
+
+    Args:
+        minio_client: The Minio client.
+        line: The JSONL line of the product.
+        api_version: The API version used in revision paths.
+        skip_existing: If True, don't upload revisions that are already on
+            S3.
+
+    Returns:
+        BackfillResult: what was done for this product.
+    """
+    product = orjson.loads(line)
+    barcode = product.get("code")
+    if not barcode or product.get("rev") is None:
+        return BackfillResult.SKIPPED
+
+    try:
+        if skip_existing and revision_exists(
+            minio_client, api_version, barcode, product["rev"]
+        ):
+            return BackfillResult.SKIPPED
+        set_as_latest = not revision_exists(
+            minio_client, api_version, barcode, "latest"
+        )
+        upload_revision(
+            minio_client=minio_client,
+            api_version=api_version,
+            barcode=barcode,
+            product=strip_product_from_user_ids(product),
+            set_as_latest=set_as_latest,
+        )
+    except Exception as e:
+        logger.error("Failed to backfill revision for barcode %s: %s", barcode, e)
+        return BackfillResult.FAILED
+
+    return (
+        BackfillResult.UPLOADED_AS_LATEST if set_as_latest else BackfillResult.UPLOADED
+    )
+
+
+def backfill_revisions(
+    dataset_path: Path,
+    checkpoint_path: Path | None = None,
+    num_workers: int = 32,
+    rate_limit: float | None = None,
+    skip_existing: bool = True,
+    checkpoint_interval: float = 10.0,
+    minio_client: Minio | None = None,
+) -> BackfillCheckpoint:
+    """Upload the revisions of all products of a JSONL dump to S3.
+
+    Products are processed concurrently in a thread pool. The progress is
+    saved regularly in a checkpoint file, as the byte offset in the
+    (uncompressed) JSONL stream up to which all products were processed: if
+    the backfill is interrupted, it resumes from this offset.
+
+    Args:
+        dataset_path: The path of the JSONL dump (plain or gzipped).
+        checkpoint_path: The path of the checkpoint file, defaults to
+            `{dataset_path}.backfill.json`.
+        num_workers: The number of concurrent uploads, defaults to 32.
+        rate_limit: The maximum number of products processed per second,
+            no limit by default.
+        skip_existing: If True (default), don't upload revisions that are
+            already on S3.
+        checkpoint_interval: The number of seconds between two checkpoint
+            saves, defaults to 10.
+        minio_client: The Minio client, a new client is created if not
+            provided.
+
+    Returns:
+        BackfillCheckpoint: the final state of the backfill.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = get_default_checkpoint_path(dataset_path)
+    if minio_client is None:
+        minio_client = get_minio_client()
+
+    checkpoint = load_checkpoint(checkpoint_path, dataset_path)
+    if checkpoint.offset:
+        logger.info("Resuming backfill from offset %d", checkpoint.offset)
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    # Bound the number of lines held in memory
+    max_pending = num_workers * 4
+    # (end offset of the line, future), in submission order
+    pending: collections.deque[tuple[int, Future[BackfillResult]]] = collections.deque()
+    start_time = time.monotonic()
+    start_uploaded_objects = checkpoint.uploaded_objects
+    last_checkpoint_time = start_time
+
+    def commit(end_offset: int, result: BackfillResult) -> None:
+        checkpoint.offset = end_offset
+        checkpoint.products += 1
+        if result is BackfillResult.UPLOADED:
+            checkpoint.uploaded_objects += 1
+        elif result is BackfillResult.UPLOADED_AS_LATEST:
+            checkpoint.uploaded_objects += 2
+        elif result is BackfillResult.SKIPPED:
+            checkpoint.skipped += 1
+        else:
+            checkpoint.failed += 1
+
+    def log_progress() -> None:
+        elapsed = time.monotonic() - start_time
+        uploaded_objects = checkpoint.uploaded_objects - start_uploaded_objects
+        logger.info(
+            "%d products processed (%d skipped, %d failed), %d objects uploaded "
+            "(%.1f objects/s)",
+            checkpoint.products,
+            checkpoint.skipped,
+            checkpoint.failed,
+            checkpoint.uploaded_objects,
+            uploaded_objects / elapsed if elapsed else 0.0,
+        )
+
+    with (
+        open_dataset(dataset_path) as fp,
+        ThreadPoolExecutor(max_workers=num_workers) as executor,
+    ):
+        if checkpoint.offset:
+            # With gzip, this decompresses (but does not parse) the skipped part
+            fp.seek(checkpoint.offset)
+        offset = checkpoint.offset
+        for line in fp:
+            offset += len(line)
+            if not line.strip():
+                continue
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            pending.append(
+                (
+                    offset,
+                    executor.submit(
+                        backfill_product,
+                        minio_client,
+                        line,
+                        skip_existing=skip_existing,
+                    ),
+                )
+            )
+            # The checkpoint only moves forward when all previous products
+            # were processed
+            while pending and (len(pending) >= max_pending or pending[0][1].done()):
+                end_offset, future = pending.popleft()
+                commit(end_offset, future.result())
+
+            if time.monotonic() - last_checkpoint_time >= checkpoint_interval:
+                save_checkpoint(checkpoint, checkpoint_path)
+                log_progress()
+                last_checkpoint_time = time.monotonic()
+
+        while pending:
+            end_offset, future = pending.popleft()
+            commit(end_offset, future.result())
+        # Also account for trailing empty lines
+        checkpoint.offset = offset
+
+    save_checkpoint(checkpoint, checkpoint_path)
+    log_progress()
+    return checkpoint
@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Iterable
+
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+from more_itertools import chunked
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of keys accepted by the S3 multi-object delete API
+MAX_DELETE_BATCH_SIZE = 1000
+# Redis set of the buffered deletions (`{bucket}/{object name}`), so that they
+# are sent after a restart if the process was killed before sending them
+PENDING_DELETIONS_KEY = "openfoodfacts_exports:pending_s3_deletions"
+
+
+class BatchDeleter:
+    """Aggregate S3 object deletions and send them using the multi-object
+    delete API (`remove_objects`).
+
+    Deletions added with `add` are buffered and sent at most `window` seconds
+    later, or as soon as `max_batch_size` objects are pending. This allows
+    grouping deletions triggered by several update events into a single
+    request. Objects that failed to be deleted are retried with exponential
+    backoff.
+
+    With `window=0`, every `add` call flushes pending deletions immediately.
+
+    If a Redis client is provided, buffered deletions are also saved in
+    Redis until they are sent, and `recover` sends the deletions left by a
+    previous process.
+    """
+
+    def __init__(
+        self,
+        minio_client: Minio,
+        window: float = 0,
+        max_batch_size: int = MAX_DELETE_BATCH_SIZE,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+        redis_client: Redis | None = None,
+    ):
+        """Create a batch deleter.
+
+        Args:
+            minio_client: The Minio client.
+            window: The maximum number of seconds a deletion is kept
+                pending before being sent. Defaults to 0 (no buffering).
+            max_batch_size: The maximum number of objects per request,
+                defaults to 1000 (S3 limit).
+            max_retries: The number of retries for objects that could not be
+                deleted, defaults to 3.
+            retry_delay: The delay in seconds before the first retry, doubled
+                after each retry. Defaults to 1 second.
+            redis_client: The Redis client where buffered deletions are
+                saved, they are only kept in memory if not provided.
+        """
+        if not 0 < max_batch_size <= MAX_DELETE_BATCH_SIZE:
+            raise ValueError(
+                f"max_batch_size must be between 1 and {MAX_DELETE_BATCH_SIZE}"
+            )
+        self.minio_client = minio_client
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.redis_client = redis_client
+        # bucket name -> object names to delete
+        self._pending: dict[str, set[str]] = defaultdict(set)
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        # Statistics, mostly useful for monitoring and benchmarking
+        self.request_count = 0
+        self.deleted_count = 0
+        self.failed_count = 0
+
+    @property
+    def pending_count(self) -> int:
+        """Number of objects waiting to be deleted."""
+        with self._lock:
+            return sum(len(names) for names in self._pending.values())
+
+    def add(self, bucket_name: str, object_names: Iterable[str]) -> None:
+        """Schedule the deletion of objects from a bucket.
+
+        Args:
+            bucket_name: The name of the bucket.
+            object_names: The names of the objects to delete.
+        """
+        object_names = list(object_names)
+        if self.redis_client is not None and object_names:
+            self.redis_client.sadd(
+                PENDING_DELETIONS_KEY,
+                *(f"{bucket_name}/{name}" for name in object_names),
+            )
+        with self._lock:
+            self._pending[bucket_name].update(object_names)
+            pending_count = sum(len(names) for names in self._pending.values())
+            should_flush = self.window <= 0 or pending_count >= self.max_batch_size
+            if not should_flush and self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if should_flush:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send all pending deletions."""
+        with self._lock:
+            pending = self._pending
+            self._pending = defaultdict(set)
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for bucket_name, object_names in pending.items():
+            self.delete(bucket_name, object_names)
+            if self.redis_client is not None and object_names:
+                self.redis_client.srem(
+                    PENDING_DELETIONS_KEY,
+                    *(f"{bucket_name}/{name}" for name in object_names),
+                )
+
+    def delete(self, bucket_name: str, object_names: Iterable[str]) -> None:
+        """Delete objects from a bucket immediately, without buffering them.
+
+        Args:
+            bucket_name: The name of the bucket.
+            object_names: The names of the objects to delete.
+        """
+        for batch in chunked(sorted(set(object_names)), self.max_batch_size):
+            self._delete_batch(bucket_name, batch)
+
+    def recover(self) -> None:
+        """Send the deletions saved in Redis by a previous process that did
+        not send them (ex: killed before the end of the window)."""
+        if self.redis_client is None:
+            return
+        members = self.redis_client.smembers(PENDING_DELETIONS_KEY)
+        if not members:
+            return
+        logger.info("Recovering %d pending deletions", len(members))  # type: ignore
+        with self._lock:
+            for member in members:  # type: ignore
+                if isinstance(member, bytes):
+                    member = member.decode("utf-8")
+                bucket_name, object_name = member.split("/", 1)
+                self._pending[bucket_name].add(object_name)
+        self.flush()
+
+    def _delete_batch(self, bucket_name: str, object_names: list[str]) -> None:
+        """Delete a batch of objects (at most `max_batch_size`) from a bucket,
+        retrying the objects that failed to be deleted."""
+        remaining = object_names
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            logger.info(
+                "Deleting %d objects from bucket %s", len(remaining), bucket_name
+            )
+            self.request_count += 1
+            try:
+                # remove_objects is lazy, the request is sent when the error
+                # iterator is consumed
+                errors = list(
+                    self.minio_client.remove_objects(
+                        bucket_name, [DeleteObject(name) for name in remaining]
+                    )
+                )
+            except Exception as e:
+                logger.warning(
+                    "Error during deletion of %d objects from bucket %s "
+                    "(attempt %d): %s",
+                    len(remaining),
+                    bucket_name,
+                    attempt + 1,
+                    e,
+                )
+                continue
+
+            # Deleting a missing object is not an error
+            failed = {
+                error.name
+                for error in errors
+                if error.name is not None and error.code != "NoSuchKey"
+            }
+            self.deleted_count += len(remaining) - len(failed)
+            if not failed:
+                return
+            logger.warning(
+                "%d objects could not be deleted from bucket %s (attempt %d)",
+                len(failed),
+                bucket_name,
+                attempt + 1,
+            )
+            remaining = [name for name in remaining if name in failed]
+
+        self.failed_count += len(remaining)
+        logger.error(
+            "Failed to delete %d objects from bucket %s after %d attempts: %s",
+            len(remaining),
+            bucket_name,
+            self.max_retries + 1,
+            remaining,
+        )
@@ -0,0 +1,337 @@
+"""Parallel download of the dataset dumps.
+
+The dumps (several GB) are downloaded with HTTP range requests over several
+connections. Each connection downloads fixed-size chunks of the file, that
+are written (`os.pwrite`) at their offset in a preallocated partial file:
+
+    {output}.part       the partial file, with the size of the dump
+    {output}.part.json  the download state: ETag, size and completed chunks
+
+If the download fails (after retries), the next download of the same dump
+(same URL, size and ETag) only downloads the missing chunks. Range requests
+are sent with an `If-Range` header, so that a dump updated during the
+download is detected.
+
+Once complete, the file is moved to its final path, and its metadata (ETag,
+URL) are saved like `openfoodfacts.utils.download_file` does, so that
+`should_download_file` works the same way with both downloaders. Servers
+that do not support range requests fall back to `download_file`.
+
+`open_streaming_download` downloads a file with a single connection, while
+it is read by the caller (ex: to convert a dump while it is downloaded).
+"""
+
+import contextlib
+import io
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+import requests
+import urllib3
+from openfoodfacts.utils import download_file
+from pydantic import BaseModel, Field
+from requests.adapters import HTTPAdapter
+
+from openfoodfacts_exports import settings
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks downloaded with a single range request
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+# Size of the blocks read from a response and written to the file
+READ_BLOCK_SIZE = 1024 * 1024
+# Number of attempts to download a chunk, the download resumes from the last
+# byte received
+MAX_CHUNK_ATTEMPTS = 3
+# Delay before the retries (multiplied by the attempt number), in seconds
+RETRY_DELAY = 1.0
+REQUEST_TIMEOUT = 60
+
+
+class DatasetChangedError(Exception):
+    """Raised when the remote file changed during a download."""
+
+
+class DownloadState(BaseModel):
+    url: str
+    # ETag of the remote file, as sent by the server (with quotes)
+    etag: str
+    size: int
+    chunk_size: int
+    # Indices of the chunks written to the partial file
+    done_chunks: set[int] = Field(default_factory=set)
+
+
+def get_metadata_path(path: Path) -> Path:
+    """Return the path of the metadata file of a downloaded file, as
+    written by `openfoodfacts.utils.download_file`."""
+    return path.with_name(path.name.replace(".", "_") + ".json")
+
+
+def get_session(num_connections: int) -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"User-Agent": settings.USER_AGENT})
+    adapter = HTTPAdapter(pool_maxsize=num_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_file_parallel(
+    url: str,
+    output_path: Path,
+    num_connections: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    session: requests.Session | None = None,
+) -> None:
+    """Download a file with range requests over `num_connections`
+    connections, resuming the previous download if it failed.
+
+    Args:
+        url: The URL of the file.
+        output_path: The path of the downloaded file.
+        num_connections: The number of chunks downloaded in parallel.
+        chunk_size: The size of the chunks, in bytes.
+        session: The HTTP session, defaults to a new session.
+
+    Raises:
+        DatasetChangedError: if the remote file changed during the download,
+            the partial download is removed.
+    """
+    session = get_session(num_connections) if session is None else session
+    response = session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    etag = response.headers.get("ETag")
+    size = int(response.headers.get("Content-Length", -1))
+    if (
+        response.headers.get("Accept-Ranges") != "bytes"
+        or etag is None
+        or size <= chunk_size
+        or num_connections <= 1
+    ):
+        logger.info("Downloading %s with a single connection", url)
+        download_file(url, output_path)
+        return
+
+    part_path = output_path.with_name(f"{output_path.name}.part")
+    state_path = output_path.with_name(f"{output_path.name}.part.json")
+    state = load_download_state(state_path, part_path)
+    if state is None or (state.url, state.etag, state.size, state.chunk_size) != (
+        url,
+        etag,
+        size,
+        chunk_size,
+    ):
+        state = DownloadState(url=url, etag=etag, size=size, chunk_size=chunk_size)
+        with part_path.open("wb") as f:
+            preallocate(f.fileno(), size)
+        save_download_state(state_path, state)
+
+    num_chunks = (size + chunk_size - 1) // chunk_size
+    pending_chunks = [i for i in range(num_chunks) if i not in state.done_chunks]
+    logger.info(
+        "Downloading %s (%d bytes) with %d connections: %d chunks out of %d left",
+        url,
+        size,
+        num_connections,
+        len(pending_chunks),
+        num_chunks,
+    )
+    fd = os.open(part_path, os.O_WRONLY)
+    try:
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            futures = {
+                executor.submit(
+                    download_chunk,
+                    session,
+                    url,
+                    fd,
+                    etag,
+                    chunk_id * chunk_size,
+                    min(size, (chunk_id + 1) * chunk_size) - 1,
+                ): chunk_id
+                for chunk_id in pending_chunks
+            }
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    state.done_chunks.add(futures[future])
+                    save_download_state(state_path, state)
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    except DatasetChangedError:
+        part_path.unlink(missing_ok=True)
+        state_path.unlink(missing_ok=True)
+        raise
+    finally:
+        os.close(fd)
+
+    if part_path.stat().st_size != size:
+        raise OSError(f"Downloaded file {part_path} does not have {size} bytes")
+    part_path.replace(output_path)
+    write_metadata(output_path, url, etag)
+    state_path.unlink()
+    logger.info("%s downloaded to %s", url, output_path)
+
+
+class TeeReader(io.RawIOBase):
+    """Read-only file-like object over a raw HTTP response, that writes the
+    bytes read to `output_file`."""
+
+    def __init__(self, response: requests.Response, output_file: BinaryIO):
+        self._raw = response.raw
+        self._output_file = output_file
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        try:
+            data = self._raw.read(len(buffer), decode_content=False)
+        except urllib3.exceptions.ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e) from e
+        self._output_file.write(data)
+        self.bytes_read += len(data)
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def write_metadata(output_path: Path, url: str, etag: str) -> None:
+    get_metadata_path(output_path).write_text(
+        json.dumps(
+            {"etag": etag.strip("'\""), "created_at": int(time.time()), "url": url}
+        )
+    )
+
+
+@contextlib.contextmanager
+def open_streaming_download(
+    url: str, output_path: Path, session: requests.Session | None = None
+) -> Iterator[BinaryIO]:
+    """Download a file, while it is read.
+
+    The context manager yields a file object reading the (undecoded)
+    response, the bytes read are also written to a temporary file. The
+    remaining bytes are downloaded when the context manager exits, and the
+    temporary file is moved to `output_path`, with its metadata.
+
+    If the download or the caller fails, the temporary file is removed and
+    the exception is propagated.
+
+    Args:
+        url: The URL of the file.
+        output_path: The path of the downloaded file.
+        session: The HTTP session, defaults to a new session.
+    """
+    session = get_session(1) if session is None else session
+    tmp_path = output_path.with_name(f"{output_path.name}.streaming")
+    with session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", -1))
+        try:
+            with tmp_path.open("wb") as f:
+                reader = TeeReader(response, f)
+                yield io.BufferedReader(reader, buffer_size=READ_BLOCK_SIZE)
+                # Download the bytes not read by the caller
+                while reader.read(READ_BLOCK_SIZE):
+                    pass
+            if size != -1 and reader.bytes_read != size:
+                raise requests.exceptions.ChunkedEncodingError(
+                    f"Incomplete download of {url}: {reader.bytes_read} bytes "
+                    f"out of {size}"
+                )
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+    tmp_path.replace(output_path)
+    write_metadata(output_path, url, response.headers.get("ETag", ""))
+    logger.info("%s downloaded to %s", url, output_path)
+
+
+def download_chunk(
+    session: requests.Session, url: str, fd: int, etag: str, start: int, end: int
+) -> None:
+    """Download the bytes `start` to `end` (inclusive) of a file, and write
+    them at the same offset in the file `fd`.
+
+    The download is retried from the last byte written in case of network
+    error.
+    """
+    offset = start
+    for attempt in range(1, MAX_CHUNK_ATTEMPTS + 1):
+        try:
+            with session.get(
+                url,
+                headers={"Range": f"bytes={offset}-{end}", "If-Range": etag},
+                stream=True,
+                timeout=REQUEST_TIMEOUT,
+            ) as response:
+                if response.status_code == 200:
+                    # The If-Range condition failed: the file changed
+                    raise DatasetChangedError(f"{url} changed during the download")
+                response.raise_for_status()
+                if response.headers.get("ETag", etag) != etag:
+                    raise DatasetChangedError(f"{url} changed during the download")
+                for block in response.iter_content(chunk_size=READ_BLOCK_SIZE):
+                    view = memoryview(block)
+                    while view:
+                        written = os.pwrite(fd, view, offset)
+                        offset += written
+                        view = view[written:]
+            if offset == end + 1:
+                return
+            raise requests.exceptions.ChunkedEncodingError(
+                f"Incomplete range {offset}-{end} of {url}"
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as e:
+            if attempt == MAX_CHUNK_ATTEMPTS:
+                raise
+            logger.info(
+                "Error while downloading range %d-%d of %s (attempt %d): %s",
+                offset,
+                end,
+                url,
+                attempt,
+                e,
+            )
+            time.sleep(attempt * RETRY_DELAY)
+
+
+def preallocate(fd: int, size: int) -> None:
+    """Allocate `size` bytes to a file, to avoid fragmentation."""
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by the file system
+            pass
+    os.truncate(fd, size)
+
+
+def load_download_state(state_path: Path, part_path: Path) -> DownloadState | None:
+    if not state_path.is_file() or not part_path.is_file():
+        return None
+    try:
+        return DownloadState.model_validate_json(state_path.read_bytes())
+    except ValueError as e:
+        logger.warning("Invalid download state %s: %s", state_path, e)
+        return None
+
+
+def save_download_state(state_path: Path, state: DownloadState) -> None:
+    """Save the download state, atomically."""
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(state.model_dump_json())
+    tmp_path.replace(state_path)
@@ -0,0 +1,254 @@
+"""Live capture of historical events in the update listener.
+
+When a product is updated, the listener fetches and stores the new revision.
+The events of the revision are generated at the same time, from the diff
+published by Product Opener and the previous revision, so that no second
+pass over all revisions is needed.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import orjson
+from openfoodfacts.redis import ProductUpdateEvent
+from openfoodfacts.types import JSONType
+
+from openfoodfacts_exports.exports.historical_events import (
+    RevisionInfo,
+    generate_events,
+)
+from openfoodfacts_exports.exports.historical_events_store import (
+    HistoricalEventStore,
+)
+from openfoodfacts_exports.tasks.revision_store import RevisionStore
+
+logger = logging.getLogger(__name__)
+
+
+class RevisionCache:
+    """LRU cache of the last revision of each product, within a memory
+    budget.
+
+    Revisions are kept serialized, so that their memory usage is known.
+    """
+
+    def __init__(self, max_size: int):
+        """Create a cache.
+
+        Args:
+            max_size: The maximum total size of the cached revisions, in
+                bytes.
+        """
+        self.max_size = max_size
+        self.size = 0
+        # barcode -> (revision ID, serialized revision), in LRU order
+        self._revisions: collections.OrderedDict[str, tuple[int, bytes]] = (
+            collections.OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._revisions)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, barcode: str, rev_id: int) -> JSONType | None:
+        """Return a revision of a product if it is the cached one, None
+        otherwise."""
+        item = self._revisions.get(barcode)
+        if item is None or item[0] != rev_id:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._revisions.move_to_end(barcode)
+        return orjson.loads(item[1])
+
+    def put(self, barcode: str, rev_id: int, product: JSONType) -> None:
+        """Cache the last revision of a product."""
+        content = orjson.dumps(product)
+        previous_item = self._revisions.pop(barcode, None)
+        if previous_item is not None:
+            self.size -= len(previous_item[1])
+        if len(content) > self.max_size:
+            return
+        self._revisions[barcode] = (rev_id, content)
+        self.size += len(content)
+        while self.size > self.max_size:
+            _, (_, evicted_content) = self._revisions.popitem(last=False)
+            self.size -= len(evicted_content)
+
+
+class LiveEventCapture:
+    """Generate the events of updated products and append them to a
+    historical event store, in batches.
+
+    Buffered events are flushed when `batch_size` events are buffered, or
+    `flush_interval` seconds after the last flush: by `capture`, or by the
+    background thread started with `start_flush_thread` while no update is
+    received. `flush` must be called before exiting.
+    """
+
+    def __init__(
+        self,
+        event_store: HistoricalEventStore,
+        revision_store: RevisionStore,
+        cache_size: int = 256 * 1024 * 1024,
+        batch_size: int = 1000,
+        flush_interval: float = 60.0,
+    ):
+        """Create a live event capture.
+
+        Args:
+            event_store: The store where events are appended.
+            revision_store: The revision store, used to fetch the previous
+                revision when it is not in cache.
+            cache_size: The memory budget of the revision cache, in bytes.
+                Defaults to 256 MiB.
+            batch_size: The number of buffered events triggering a flush,
+                defaults to 1000.
+            flush_interval: The maximum number of seconds events are
+                buffered, defaults to 60.
+        """
+        self.event_store = event_store
+        self.revision_store = revision_store
+        self.cache = RevisionCache(cache_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: list[JSONType] = []
+        self._last_flush_time = time.monotonic()
+        # Held while the buffer is updated or flushed, as the flush thread
+        # flushes it concurrently
+        self._lock = threading.Lock()
+        self._flush_thread: threading.Thread | None = None
+        self._stop_event = threading.Event()
+        # Statistics
+        self.revision_count = 0
+        self.total_duration = 0.0
+        # Number of events skipped, as the product was modified since
+        self.skipped_count = 0
+
+    def get_previous_revision(self, barcode: str, rev_id: int) -> JSONType | None:
+        """Return the revision preceding `rev_id`, from the cache or from the
+        revision store."""
+        if rev_id <= 1:
+            return None
+        previous_product = self.cache.get(barcode, rev_id - 1)
+        if previous_product is None:
+            previous_product = self.revision_store.get_revision(barcode, rev_id - 1)
+        return previous_product
+
+    def capture(self, event: ProductUpdateEvent, product: JSONType) -> None:
+        """Generate the events of a product update.
+
+        Args:
+            event: The update event, with the diff of the revision.
+            product: The new revision of the product, as stored in the
+                revision store. The event is skipped if it is a later
+                revision (modified after the event).
+        """
+        with self._lock:
+            self._capture(event, product)
+
+    def _capture(self, event: ProductUpdateEvent, product: JSONType) -> None:
+        start_time = time.perf_counter()
+        rev_id = product["rev"]
+        timestamp = int(event.timestamp.timestamp())
+        # Update events don't include the revision number. The product is
+        # fetched after the event was published: if it was modified since,
+        # it is a later revision, and the diff of the event does not apply
+        last_modified_t = product.get("last_modified_t")
+        if isinstance(last_modified_t, int) and last_modified_t > timestamp:
+            logger.info(
+                "Revision %d of %s was saved after the update event (%d > %d), "
+                "skipping the event",
+                rev_id,
+                event.code,
+                last_modified_t,
+                timestamp,
+            )
+            self.skipped_count += 1
+            return
+        previous_product = self.get_previous_revision(event.code, rev_id)
+        revision = RevisionInfo(
+            code=event.code,
+            rev_id=rev_id,
+            timestamp=timestamp,
+            product_type=event.product_type,
+            comment=event.comment,
+        )
+        self._buffer.extend(
+            generate_events(revision, event.diffs, previous_product, product)
+        )
+        self.cache.put(event.code, rev_id, product)
+        self.revision_count += 1
+        self.total_duration += time.perf_counter() - start_time
+
+        if len(self._buffer) >= self.batch_size or self._is_flush_due():
+            self._flush()
+
+    def _is_flush_due(self) -> bool:
+        return time.monotonic() - self._last_flush_time >= self.flush_interval
+
+    def flush(self) -> None:
+        """Append the buffered events to the event store."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self._last_flush_time = time.monotonic()
+        if not self._buffer:
+            return
+        try:
+            count = self.event_store.append(self._buffer)
+        except Exception:
+            # The events are kept in the buffer, to be written by the next
+            # flush (the store skips the events already appended)
+            logger.exception("Failed to write %d historical events", len(self._buffer))
+            return
+        buffer = self._buffer
+        self._buffer = []
+        logger.info(
+            "%d historical events written (%d duplicates skipped), cache hit "
+            "rate: %.1f%% (%d revisions, %.1f MB), %.2fms per revision",
+            count,
+            len(buffer) - count,
+            self.cache.hit_rate * 100,
+            len(self.cache),
+            self.cache.size / 1_000_000,
+            self.total_duration / self.revision_count * 1000
+            if self.revision_count
+            else 0.0,
+        )
+
+    def _run_flush_thread(self) -> None:
+        # Check twice per interval, so that events are not buffered for
+        # more than 1.5 interval
+        while not self._stop_event.wait(self.flush_interval / 2):
+            with self._lock:
+                if self._buffer and self._is_flush_due():
+                    self._flush()
+
+    def start_flush_thread(self) -> None:
+        """Start a background thread flushing the buffered events every
+        `flush_interval` seconds, if `capture` did not."""
+        if self._flush_thread is not None:
+            return
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(
+            target=self._run_flush_thread, name="event-capture-flush", daemon=True
+        )
+        self._flush_thread.start()
+
+    def stop_flush_thread(self) -> None:
+        """Stop the flush thread, without flushing."""
+        if self._flush_thread is None:
+            return
+        self._stop_event.set()
+        self._flush_thread.join()
+        self._flush_thread = None
@@ -1,23 +1,78 @@
-import gzip
 import io
 import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
 import requests
+from minio import Minio
 from openfoodfacts import Environment, Flavor
 from openfoodfacts.images import (
     _generate_file_path,
     generate_image_url,
     generate_json_ocr_url,
 )
-from openfoodfacts.utils import (
-    get_asset_from_url,
-)
 
 from openfoodfacts_exports import settings
+from openfoodfacts_exports.tasks.deletion import BatchDeleter
 from openfoodfacts_exports.utils import get_minio_client
 
 logger = logging.getLogger(__name__)
 
+# Size of the parts sent to S3. Assets smaller than this are uploaded with a
+# single PUT request, larger ones (mostly original images) with a multipart
+# upload. This is also an upper bound on the memory used per transfer.
+UPLOAD_PART_SIZE = 10 * 1024 * 1024
+
+# Size of the chunks read from the HTTP response
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Compression level used for OCR files, same as `gzip.compress` default
+OCR_COMPRESSION_LEVEL = 9
+
+
+class StreamingReader(io.RawIOBase):
+    """Read-only file-like object over an iterator of byte chunks.
+
+    It lets us pass an HTTP response body to `Minio.put_object` without
+    loading it fully in memory. If `gzip_compress` is True, the data is
+    gzip-compressed on the fly as it is read.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], gzip_compress: bool = False):
+        self._chunks = chunks
+        self._buffer = bytearray()
+        self._eof = False
+        self._compressor = (
+            # wbits=31 generates a gzip header and trailer
+            zlib.compressobj(OCR_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+            if gzip_compress
+            else None
+        )
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int | None = -1) -> bytes:
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._eof = True
+                if self._compressor is not None:
+                    self._buffer += self._compressor.flush()
+            elif self._compressor is not None:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += chunk
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        # Copy through a memoryview to avoid an intermediate bytearray copy
+        with memoryview(self._buffer) as view:
+            data = view[:size].tobytes()
+        del self._buffer[:size]
+        return data
+
 
 def upload_new_image_to_s3(
     image_id: str, barcode: str, flavor: Flavor, environment: Environment
@@ -28,6 +83,9 @@ def upload_new_image_to_s3(
     - Image (original and 400px version)
     - OCR result, gzipped
 
+    The assets are transferred concurrently, and streamed from the HTTP
+    response to S3 without being fully loaded in memory.
+
     Args:
         image_id (str): The ID of the image.
         barcode (str): The barcode of the product.
@@ -45,6 +103,8 @@ def upload_new_image_to_s3(
             "User-Agent": settings.USER_AGENT,
         }
     )
+    # List of (asset URL, S3 path, whether to gzip the asset)
+    transfers: list[tuple[str, str, bool]] = []
     for image_prefix in (image_id, f"{image_id}.400"):
         image_url = generate_image_url(
             barcode,
@@ -52,64 +112,126 @@ def upload_new_image_to_s3(
             flavor=flavor,
             environment=environment,
         )
-        image_asset = get_asset_from_url(
-            asset_url=image_url, error_raise=False, session=session
-        )
         image_base_path = _generate_file_path(
             code=barcode, image_id=image_prefix, suffix=".jpg"
         )
-        if image_asset.response is not None and image_asset.response.status_code == 200:
-            s3_path = f"data{image_base_path}"
-            image_fp = io.BytesIO(image_asset.response.content)
-            logger.info(
-                "Uploading image to %s/%s", settings.AWS_S3_IMAGE_BUCKET, s3_path
-            )
-            client.put_object(
-                bucket_name=settings.AWS_S3_IMAGE_BUCKET,
-                object_name=s3_path,
-                data=image_fp,
-                length=len(image_asset.response.content),
-            )
+        transfers.append((image_url, f"data{image_base_path}", False))
+
     ocr_url = generate_json_ocr_url(
         barcode,
         image_id,
         flavor=flavor,
         environment=environment,
     )
-    ocr_asset = get_asset_from_url(
-        asset_url=ocr_url, error_raise=False, session=session
-    )
     ocr_base_path = _generate_file_path(
         code=barcode, image_id=image_id, suffix=".json.gz"
     )
-    if ocr_asset.response is not None and ocr_asset.response.status_code == 200:
-        s3_path = f"data{ocr_base_path}"
-        compressed_bytes = gzip.compress(ocr_asset.response.content)
-        ocr_fp = io.BytesIO(compressed_bytes)
+    transfers.append((ocr_url, f"data{ocr_base_path}", True))
+
+    with ThreadPoolExecutor(max_workers=len(transfers)) as executor:
+        futures = [
+            executor.submit(
+                transfer_asset_to_s3,
+                client=client,
+                session=session,
+                asset_url=asset_url,
+                s3_path=s3_path,
+                gzip_compress=gzip_compress,
+            )
+            for asset_url, s3_path, gzip_compress in transfers
+        ]
+        for future in futures:
+            # Propagate S3 errors
+            future.result()
+
+
+def transfer_asset_to_s3(
+    client: Minio,
+    session: requests.Session,
+    asset_url: str,
+    s3_path: str,
+    gzip_compress: bool = False,
+) -> bool:
+    """Stream an asset from `asset_url` to the image bucket on S3.
+
+    Args:
+        client (Minio): The Minio client.
+        session (requests.Session): The session used to fetch the asset.
+        asset_url (str): The URL of the asset.
+        s3_path (str): The path of the object in the S3 bucket.
+        gzip_compress (bool, optional): Whether to gzip the asset before
+            upload. Defaults to False.
+
+    Returns:
+        bool: True if the asset was uploaded, False if it could not be
+            downloaded.
+    """
+    try:
+        response = session.get(asset_url, stream=True)
+    except (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.SSLError,
+        requests.exceptions.Timeout,
+    ) as e:
+        logger.info("Cannot download %s", asset_url, exc_info=e)
+        return False
+
+    with response:
+        if response.status_code != 200:
+            logger.log(
+                logging.INFO if response.status_code < 500 else logging.WARNING,
+                "Cannot download %s: HTTP %s",
+                asset_url,
+                response.status_code,
+            )
+            return False
+
         logger.info(
-            "Uploading OCR file to %s/%s", settings.AWS_S3_IMAGE_BUCKET, s3_path
+            "Uploading %s to %s/%s",
+            "OCR file" if gzip_compress else "image",
+            settings.AWS_S3_IMAGE_BUCKET,
+            s3_path,
+        )
+        reader = StreamingReader(
+            response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+            gzip_compress=gzip_compress,
         )
         client.put_object(
             bucket_name=settings.AWS_S3_IMAGE_BUCKET,
             object_name=s3_path,
-            data=ocr_fp,
-            length=len(compressed_bytes),
+            data=reader,  # type: ignore[arg-type]
+            # Unknown length: the data is uploaded part by part
+            length=-1,
+            part_size=UPLOAD_PART_SIZE,
+            # Upload parts sequentially to bound memory usage
+            num_parallel_uploads=1,
         )
+    return True
 
 
-def delete_image_from_s3(image_id: str, barcode: str) -> None:
+def delete_image_from_s3(
+    image_id: str, barcode: str, deleter: BatchDeleter | None = None
+) -> None:
     """Delete images and OCR results from S3, after the image deletion from Product
-    Opener."""
+    Opener.
+
+    Args:
+        image_id (str): The ID of the image.
+        barcode (str): The barcode of the product.
+        deleter (BatchDeleter, optional): The batch deleter used to aggregate
+            deletions. If not provided, the objects are deleted immediately
+            with a single multi-object delete request.
+    """
     if not settings.ENABLE_S3_PUSH:
         logger.debug("S3 push is disabled, skipping deletion")
         return
 
-    client = get_minio_client()
+    if deleter is None:
+        deleter = BatchDeleter(get_minio_client())
+
+    s3_paths = []
     for suffix in (".jpg", ".400.jpg", ".json.gz"):
         file_path = _generate_file_path(barcode, image_id, suffix=suffix)
-        s3_path = f"data{file_path}"
-        logger.info("Deleting file %s", s3_path)
-        client.remove_object(
-            bucket_name=settings.AWS_S3_IMAGE_BUCKET,
-            object_name=s3_path,
-        )
+        s3_paths.append(f"data{file_path}")
+    logger.info("Deleting files %s", s3_paths)
+    deleter.add(settings.AWS_S3_IMAGE_BUCKET, s3_paths)
@@ -0,0 +1,127 @@
+"""Bulk removal of user IDs from JSONL product dumps.
+
+The same redaction rules as for the live revision sync
+(`strip_product_from_user_ids`) are applied, so that both stay consistent.
+"""
+
+import gzip
+import logging
+import os
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+from openfoodfacts_exports.tasks.revisions import strip_product_json_from_user_ids
+from openfoodfacts_exports.utils import imap_ordered, open_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def _iter_blocks(fp: BinaryIO, block_size: int) -> Iterator[list[bytes]]:
+    """Iterate over blocks of at most `block_size` non-empty lines."""
+    block: list[bytes] = []
+    for line in fp:
+        if not line.strip():
+            continue
+        block.append(line)
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def redact_block(
+    lines: list[bytes], compression_level: int | None = None
+) -> tuple[bytes, int, int]:
+    """Remove user IDs from a block of JSONL lines.
+
+    Args:
+        lines: The JSONL lines of the block.
+        compression_level: If not None, the output block is gzip-compressed
+            with this level.
+
+    Returns:
+        The redacted block (as an independent gzip member if compressed),
+        the number of lines and the size of the uncompressed input.
+    """
+    input_size = 0
+    output_lines = []
+    for line in lines:
+        input_size += len(line)
+        output_lines.append(strip_product_json_from_user_ids(line.rstrip(b"\r\n")))
+    output_lines.append(b"")
+    output = b"\n".join(output_lines)
+    if compression_level is not None:
+        output = gzip.compress(output, compresslevel=compression_level, mtime=0)
+    return output, len(lines), input_size
+
+
+def redact_jsonl_dump(
+    input_path: Path,
+    output_path: Path,
+    num_processes: int | None = None,
+    block_size: int = 1000,
+    compression_level: int = 6,
+) -> int:
+    """Remove user IDs from every product of a JSONL dump.
+
+    Blocks of lines are redacted (and compressed, if the output is gzipped)
+    in a process pool, and written in the input order. A gzipped output is a
+    valid multi-member gzip file, with one member per block.
+
+    Args:
+        input_path: The input JSONL file (plain or gzipped).
+        output_path: The output JSONL file, gzipped if it ends with `.gz`.
+        num_processes: The number of worker processes, defaults to the number
+            of CPUs.
+        block_size: The number of lines per block, defaults to 1000.
+        compression_level: The gzip compression level of the output, defaults
+            to 6.
+
+    Returns:
+        The number of products written.
+    """
+    num_processes = num_processes or os.cpu_count() or 1
+    output_compression_level = (
+        compression_level if output_path.suffix == ".gz" else None
+    )
+    logger.info(
+        "Redacting %s to %s with %d processes", input_path, output_path, num_processes
+    )
+    start_time = time.monotonic()
+    count = 0
+    input_size = 0
+    tmp_output_path = output_path.with_name(f"{output_path.name}.tmp")
+
+    try:
+        with (
+            open_dataset(input_path) as input_fp,
+            tmp_output_path.open("wb") as output_fp,
+        ):
+            for output, block_count, block_input_size in imap_ordered(
+                redact_block,
+                (
+                    (block, output_compression_level)
+                    for block in _iter_blocks(input_fp, block_size)
+                ),
+                num_processes,
+            ):
+                output_fp.write(output)
+                count += block_count
+                input_size += block_input_size
+                if count % 1_000_000 < block_count:
+                    logger.info("%d products processed", count)
+    except BaseException:
+        tmp_output_path.unlink(missing_ok=True)
+        raise
+    tmp_output_path.replace(output_path)
+    elapsed = time.monotonic() - start_time
+    logger.info(
+        "%d products redacted in %.1fs (%.0f products/s, %.1f MB/s uncompressed)",
+        count,
+        elapsed,
+        count / elapsed if elapsed else 0.0,
+        input_size / 1_000_000 / elapsed if elapsed else 0.0,
+    )
+    return count
@@ -0,0 +1,461 @@
+"""Local index of the product revisions stored on S3.
+
+Finding which revisions of a product exist requires listing S3 prefixes. The
+revision index is a local file, memory-mapped, that answers these questions
+without network calls:
+
+- does revision `rev` of product `barcode` exist (and what is its size and
+  content hash)?
+- what are all the revisions of a product?
+- what is the latest revision of a product?
+
+The index file is made of a header followed by fixed-width records, sorted by
+(barcode, rev)::
+
+    barcode (32 bytes, NUL-padded) | rev (uint32) | size (uint32) | md5 (16 bytes)
+
+All integers are big-endian, so that records sort as raw bytes. Records added
+with `add` (ex: by `upload_revision`) go to an append-only journal file
+(`{path}.journal`), kept in memory, until they are merged into the sorted file
+with `merge`. The update listener enqueues a `merge_revision_index` job once
+the journal is large enough, so that the merge, that rewrites the whole index
+file, runs in a worker.
+
+Writes (`add`, `merge` and `build_revision_index`) hold an exclusive lock on
+`{path}.lock`. Before writing, an index reopens the files if another process
+replaced the index or changed the journal (ex: the update listener, after a
+rebuild of the index with the `build-revision-index` command).
+"""
+
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, NamedTuple
+
+from minio import Minio
+from openfoodfacts import APIVersion
+
+from openfoodfacts_exports import settings
+from openfoodfacts_exports.tasks.revision_store import parse_revision_file_name
+
+logger = logging.getLogger(__name__)
+
+INDEX_MAGIC = b"OFFRIDX1"
+MAX_BARCODE_LENGTH = 32
+RECORD_STRUCT = struct.Struct(f">{MAX_BARCODE_LENGTH}sII16s")
+RECORD_SIZE = RECORD_STRUCT.size
+# Records are sorted by their first KEY_SIZE bytes (barcode, rev)
+KEY_SIZE = MAX_BARCODE_LENGTH + 4
+
+
+class RevisionIndexEntry(NamedTuple):
+    barcode: str
+    rev_id: int
+    size: int
+    # MD5 of the revision content (the S3 ETag for single-part uploads)
+    md5: bytes
+
+
+def encode_barcode(barcode: str) -> bytes:
+    encoded = barcode.encode("utf-8")
+    if len(encoded) > MAX_BARCODE_LENGTH:
+        raise ValueError(f"Barcode too long for the revision index: {barcode}")
+    return encoded.ljust(MAX_BARCODE_LENGTH, b"\0")
+
+
+def encode_record(entry: RevisionIndexEntry) -> bytes:
+    return RECORD_STRUCT.pack(
+        encode_barcode(entry.barcode), entry.rev_id, entry.size, entry.md5
+    )
+
+
+def decode_record(record: bytes) -> RevisionIndexEntry:
+    barcode, rev_id, size, md5 = RECORD_STRUCT.unpack(record)
+    return RevisionIndexEntry(barcode.rstrip(b"\0").decode("utf-8"), rev_id, size, md5)
+
+
+class _RecordKeys:
+    """Sequence of the record keys of a memory-mapped index, for `bisect`."""
+
+    def __init__(self, data: mmap.mmap | bytes, count: int):
+        self.data = data
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        start = len(INDEX_MAGIC) + i * RECORD_SIZE
+        return self.data[start : start + KEY_SIZE]
+
+
+@contextlib.contextmanager
+def lock_index(path: Path) -> Iterator[None]:
+    """Hold the exclusive write lock of the index at `path`."""
+    with path.with_name(f"{path.name}.lock").open("a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _get_file_id(path: Path) -> tuple[int, int] | None:
+    """Return the (inode, size) of a file, or None if it does not exist."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size
+
+
+class RevisionIndex:
+    """Memory-mapped index of product revisions."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.journal_path = path.with_name(f"{path.name}.journal")
+        self._file: BinaryIO | None = None
+        self._data: mmap.mmap | bytes = b""
+        self._count = 0
+        # barcode -> rev -> entry, for the records of the journal
+        self._journal: dict[str, dict[int, RevisionIndexEntry]] = {}
+        self._journal_count = 0
+        # (inode, size) of the index file and of the journal when they were
+        # last read, to detect the changes made by other processes
+        self._index_id: tuple[int, int] | None = None
+        self._journal_id: tuple[int, int] | None = None
+        self._open()
+
+    def _open(self) -> None:
+        self.close()
+        self._index_id = _get_file_id(self.path)
+        if self._index_id is not None and self._index_id[1] > len(INDEX_MAGIC):
+            self._file = fp = self.path.open("rb")
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._data[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError(f"Invalid revision index file: {self.path}")
+            self._count = (len(self._data) - len(INDEX_MAGIC)) // RECORD_SIZE
+        self._journal = {}
+        self._journal_count = 0
+        self._journal_id = None
+        if self.journal_path.is_file():
+            with self.journal_path.open("rb") as jp:
+                content = jp.read()
+                self._journal_id = (os.fstat(jp.fileno()).st_ino, len(content))
+            # Ignore an incomplete trailing record
+            for start in range(0, len(content) - RECORD_SIZE + 1, RECORD_SIZE):
+                entry = decode_record(content[start : start + RECORD_SIZE])
+                self._journal.setdefault(entry.barcode, {})[entry.rev_id] = entry
+                self._journal_count += 1
+
+    def _refresh(self) -> None:
+        """Reopen the files if they were changed by another process (the
+        write lock must be held)."""
+        if (
+            _get_file_id(self.path) != self._index_id
+            or _get_file_id(self.journal_path) != self._journal_id
+        ):
+            logger.info("Revision index %s changed, reopening it", self.path)
+            self._open()
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._data = b""
+        self._count = 0
+
+    @property
+    def journal_count(self) -> int:
+        """Number of records in the journal, as of the last `add` or
+        `merge`."""
+        return self._journal_count
+
+    def __len__(self) -> int:
+        """Number of indexed revisions (a revision present both in the
+        sorted file and in the journal is counted twice)."""
+        return self._count + sum(len(revisions) for revisions in self._journal.values())
+
+    def _get_record(self, i: int) -> RevisionIndexEntry:
+        start = len(INDEX_MAGIC) + i * RECORD_SIZE
+        return decode_record(self._data[start : start + RECORD_SIZE])
+
+    def _bisect(self, key: bytes) -> int:
+        return bisect.bisect_left(_RecordKeys(self._data, self._count), key)
+
+    def lookup(self, barcode: str, rev_id: int) -> RevisionIndexEntry | None:
+        """Return the index entry of a revision, or None if it is not
+        indexed."""
+        journal_revisions = self._journal.get(barcode)
+        if journal_revisions is not None and rev_id in journal_revisions:
+            return journal_revisions[rev_id]
+        key = RECORD_STRUCT.pack(encode_barcode(barcode), rev_id, 0, b"")[:KEY_SIZE]
+        i = self._bisect(key)
+        if i < self._count and _RecordKeys(self._data, self._count)[i] == key:
+            return self._get_record(i)
+        return None
+
+    def get_revisions(self, barcode: str) -> list[RevisionIndexEntry]:
+        """Return the index entries of all the revisions of a product,
+        sorted by revision ID."""
+        encoded_barcode = encode_barcode(barcode)
+        entries = {}
+        i = self._bisect(encoded_barcode)
+        while i < self._count:
+            start = len(INDEX_MAGIC) + i * RECORD_SIZE
+            if self._data[start : start + MAX_BARCODE_LENGTH] != encoded_barcode:
+                break
+            entry = self._get_record(i)
+            entries[entry.rev_id] = entry
+            i += 1
+        entries.update(self._journal.get(barcode, {}))
+        return [entries[rev_id] for rev_id in sorted(entries)]
+
+    def get_latest(self, barcode: str) -> RevisionIndexEntry | None:
+        """Return the index entry of the latest revision of a product."""
+        revisions = self.get_revisions(barcode)
+        return revisions[-1] if revisions else None
+
+    def _iter_indexed_products(self) -> Iterator[tuple[str, list[int]]]:
+        current_barcode = None
+        rev_ids: list[int] = []
+        for i in range(self._count):
+            entry = self._get_record(i)
+            if entry.barcode != current_barcode:
+                if current_barcode is not None:
+                    yield current_barcode, rev_ids
+                current_barcode = entry.barcode
+                rev_ids = []
+            rev_ids.append(entry.rev_id)
+        if current_barcode is not None:
+            yield current_barcode, rev_ids
+
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        """Iterate over the indexed products (journal records included), as
+        (barcode, revision IDs) tuples, in the order of the index file (see
+        `RevisionStore.iter_products`)."""
+        journal_barcodes = sorted(self._journal, key=encode_barcode)
+        j = 0
+        for barcode, rev_ids in self._iter_indexed_products():
+            encoded_barcode = encode_barcode(barcode)
+            while (
+                j < len(journal_barcodes)
+                and encode_barcode(journal_barcodes[j]) < encoded_barcode
+            ):
+                yield journal_barcodes[j], sorted(self._journal[journal_barcodes[j]])
+                j += 1
+            if j < len(journal_barcodes) and journal_barcodes[j] == barcode:
+                yield barcode, sorted({*rev_ids, *self._journal[barcode]})
+                j += 1
+            else:
+                yield barcode, rev_ids
+        for barcode in journal_barcodes[j:]:
+            yield barcode, sorted(self._journal[barcode])
+
+    def add(self, barcode: str, rev_id: int, content: bytes) -> None:
+        """Add a revision to the index (in the journal)."""
+        entry = RevisionIndexEntry(
+            barcode, rev_id, len(content), hashlib.md5(content).digest()
+        )
+        record = encode_record(entry)
+        with lock_index(self.path):
+            self._refresh()
+            with self.journal_path.open("ab") as fp:
+                fp.write(record)
+                fp.flush()
+                self._journal_id = (os.fstat(fp.fileno()).st_ino, fp.tell())
+            self._journal.setdefault(barcode, {})[rev_id] = entry
+            self._journal_count += 1
+
+    def merge(self) -> None:
+        """Merge the journal into the sorted index file."""
+        with lock_index(self.path):
+            self._refresh()
+            self._merge()
+
+    def _merge(self) -> None:
+        if not self._journal:
+            return
+        journal_records = sorted(
+            encode_record(entry)
+            for revisions in self._journal.values()
+            for entry in revisions.values()
+        )
+        logger.info(
+            "Merging %d journal records into revision index %s",
+            len(journal_records),
+            self.path,
+        )
+        write_index_file(self.path, self._iter_merged_chunks(journal_records))
+        self.journal_path.unlink(missing_ok=True)
+        self._open()
+
+    def _iter_merged_chunks(self, journal_records: list[bytes]) -> Iterator[bytes]:
+        """Yield the content of the sorted file with the (sorted) journal
+        records inserted, copying the runs of records between two journal
+        records in a single slice."""
+        keys = _RecordKeys(self._data, self._count)
+        i = 0
+        for record in journal_records:
+            key = record[:KEY_SIZE]
+            j = bisect.bisect_left(keys, key, lo=i)
+            if j > i:
+                yield self._data[
+                    len(INDEX_MAGIC) + i * RECORD_SIZE : len(INDEX_MAGIC)
+                    + j * RECORD_SIZE
+                ]
+            yield record
+            # The journal record replaces the indexed one
+            i = j + 1 if j < self._count and keys[j] == key else j
+        if i < self._count:
+            yield self._data[len(INDEX_MAGIC) + i * RECORD_SIZE :]
+
+
+def merge_revision_index(path: Path) -> None:
+    """Merge the journal of a revision index into the index file.
+
+    This is run as a rq job, enqueued by the update listener.
+    """
+    index = RevisionIndex(path)
+    try:
+        index.merge()
+    finally:
+        index.close()
+
+
+def write_index_file(path: Path, records: Iterable[bytes]) -> None:
+    """Write sorted records (or chunks of sorted records) to an index file,
+    atomically."""
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("wb") as fp:
+        fp.write(INDEX_MAGIC)
+        for record in records:
+            fp.write(record)
+    tmp_path.replace(path)
+
+
+def iter_listing_records(
+    objects: Iterable[tuple[str, int, str]], late_records: list[bytes]
+) -> Iterator[bytes]:
+    """Convert a bucket listing of revisions into sorted index records.
+
+    S3 lists products in the order of their padded barcodes, except for
+    barcodes with characters sorting before `/` (ex: `123-1` is listed before
+    `123`). The records of such products are not yielded but added to
+    `late_records`, to be merged afterwards.
+
+    Args:
+        objects: (object name, size, ETag) tuples of `{api_version}/{barcode}/
+            {rev}.json` objects, in lexicographic order (as listed by S3).
+        late_records: The list where out-of-order records are added.
+
+    Yields:
+        The index records, sorted.
+    """
+    last_key = b""
+    current_barcode = None
+    records: list[bytes] = []
+
+    def flush_records() -> Iterator[bytes]:
+        nonlocal last_key
+        # Revisions are listed in lexicographic order (10 < 2)
+        records.sort()
+        if records and records[0][:KEY_SIZE] <= last_key:
+            late_records.extend(records)
+        elif records:
+            last_key = records[-1][:KEY_SIZE]
+            yield from records
+
+    for object_name, size, etag in objects:
+        _, barcode, file_name = object_name.split("/", maxsplit=2)
+        if barcode != current_barcode:
+            yield from flush_records()
+            current_barcode = barcode
+            records = []
+        rev_id = parse_revision_file_name(file_name)
+        if rev_id is None:
+            continue
+        etag = etag.strip('"')
+        try:
+            records.append(
+                encode_record(
+                    RevisionIndexEntry(
+                        barcode,
+                        rev_id,
+                        size,
+                        # Multipart ETags are not MD5 digests
+                        bytes.fromhex(etag) if len(etag) == 32 else b"",
+                    )
+                )
+            )
+        except ValueError as e:
+            logger.warning("Skipping %s: %s", object_name, e)
+    yield from flush_records()
+
+
+def build_revision_index(
+    path: Path,
+    objects: Iterable[tuple[str, int, str]],
+) -> RevisionIndex:
+    """Build a revision index from a bucket listing, replacing the existing
+    index.
+
+    The journal is kept and merged into the new index, as the revisions
+    added while the bucket was listed may be missing from the listing.
+
+    Args:
+        path: The path of the index file.
+        objects: (object name, size, ETag) tuples of the revisions, in
+            lexicographic order (as listed by S3).
+
+    Returns:
+        The new index.
+    """
+    late_records: list[bytes] = []
+    new_path = path.with_name(f"{path.name}.new")
+    write_index_file(new_path, iter_listing_records(objects, late_records))
+    with lock_index(path):
+        new_path.replace(path)
+        index = RevisionIndex(path)
+        if late_records:
+            # Journal records are written last, to take precedence over the
+            # listing
+            journal_records = [
+                encode_record(entry)
+                for revisions in index._journal.values()
+                for entry in revisions.values()
+            ]
+            index.close()
+            index.journal_path.write_bytes(b"".join(late_records + journal_records))
+            index = RevisionIndex(path)
+        index._merge()
+    logger.info("Revision index %s built with %d revisions", path, len(index))
+    return index
+
+
+def build_revision_index_from_bucket(
+    path: Path,
+    minio_client: Minio,
+    bucket_name: str = settings.AWS_S3_REVISION_BUCKET,
+    api_version: APIVersion = APIVersion.v2,
+) -> RevisionIndex:
+    """Rebuild the revision index from a listing of the revision bucket."""
+    return build_revision_index(
+        path,
+        (
+            (obj.object_name, obj.size or 0, obj.etag or "")
+            for obj in minio_client.list_objects(
+                bucket_name, prefix=f"{api_version.value}/", recursive=True
+            )
+            if obj.object_name is not None
+        ),
+    )
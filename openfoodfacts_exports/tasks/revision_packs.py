@@ -0,0 +1,628 @@
+"""Packed archives of product revisions.
+
+`upload_revision` stores each revision as an individual object, which is
+what the live path needs, but makes bulk reads (analytics, backfills) very
+request-heavy. The archival job (`pack_revisions`) periodically packs the
+revisions into one file per barcode-prefix shard::
+
+    packs/{api_version}/{shard}.pack  # shard: first 3 chars of the barcode
+
+Packs are written to a local directory (with the same layout as the revision
+bucket) and can be uploaded to the revision bucket, where they are read with
+ranged GET requests.
+
+A pack file is append-only. Each archival run appends the new revisions (each
+compressed independently with zlib, for random access), followed by an index
+of all the revisions of the pack and a fixed-size trailer::
+
+    magic | revisions | index | trailer | new revisions | index | trailer | ...
+
+The index is made of fixed-width records sorted by (barcode, rev)::
+
+    barcode (32 bytes, NUL-padded) | rev (uint32) | offset (uint64) | length (uint32)
+
+and the trailer gives its position: index offset (uint64) | record count
+(uint64) | magic. A revision can be read with three ranged reads (trailer,
+index, revision), and a whole pack with a few large sequential reads.
+
+Only the last index is used. If a run is interrupted before its trailer is
+written (ex: the process is killed), the pack ends with revisions that are
+not indexed: the writer truncates the pack after its last valid trailer when
+it is opened, and the revisions are packed again. As every run appends a
+full index, the writer rewrites the pack with a single index (see
+`compact_pack`) once the indexes of previous runs take too much space.
+"""
+
+import abc
+import bisect
+import logging
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Iterator, NamedTuple
+
+import orjson
+from minio import Minio
+from openfoodfacts import APIVersion
+from openfoodfacts.types import JSONType
+from pydantic import BaseModel
+
+from openfoodfacts_exports import settings
+from openfoodfacts_exports.tasks.revision_index import (
+    MAX_BARCODE_LENGTH,
+    encode_barcode,
+)
+from openfoodfacts_exports.tasks.revision_store import RevisionStore
+from openfoodfacts_exports.utils import get_minio_client
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b"OFFPACK1"
+ENTRY_STRUCT = struct.Struct(f">{MAX_BARCODE_LENGTH}sIQI")
+ENTRY_SIZE = ENTRY_STRUCT.size
+# Index records are sorted by their first KEY_SIZE bytes (barcode, rev)
+KEY_SIZE = MAX_BARCODE_LENGTH + 4
+TRAILER_STRUCT = struct.Struct(f">QQ{len(PACK_MAGIC)}s")
+TRAILER_SIZE = TRAILER_STRUCT.size
+DEFAULT_SHARD_PREFIX_LENGTH = 3
+# Size of the reads of sequential scans
+DEFAULT_SCAN_CHUNK_SIZE = 8 * 1024 * 1024
+# A pack is compacted once the indexes and trailers of previous runs take
+# more than this fraction of the pack
+DEFAULT_MAX_STALE_RATIO = 0.25
+
+
+class PackEntry(NamedTuple):
+    barcode: str
+    rev_id: int
+    # Position of the compressed revision in the pack file
+    offset: int
+    length: int
+
+
+def encode_entry(entry: PackEntry) -> bytes:
+    return ENTRY_STRUCT.pack(
+        encode_barcode(entry.barcode), entry.rev_id, entry.offset, entry.length
+    )
+
+
+def decode_entry(record: bytes) -> PackEntry:
+    barcode, rev_id, offset, length = ENTRY_STRUCT.unpack(record)
+    return PackEntry(barcode.rstrip(b"\0").decode("utf-8"), rev_id, offset, length)
+
+
+def is_valid_trailer(trailer: bytes, trailer_offset: int) -> bool:
+    """Check that a trailer (found at `trailer_offset` in the pack) has the
+    pack magic and points to an index that ends right before it."""
+    index_offset, count, magic = TRAILER_STRUCT.unpack(trailer)
+    return (
+        magic == PACK_MAGIC
+        and index_offset >= len(PACK_MAGIC)
+        and index_offset + count * ENTRY_SIZE == trailer_offset
+    )
+
+
+def find_pack_end(data: bytes | mmap.mmap) -> int:
+    """Return the end of the last valid trailer of a pack (the size of the
+    magic if no trailer is valid): what follows was written by an
+    interrupted run."""
+    end = len(data)
+    while True:
+        # The magic at the start of the pack is not a trailer
+        pos = data.rfind(PACK_MAGIC, len(PACK_MAGIC), end)
+        if pos == -1:
+            return len(PACK_MAGIC)
+        trailer_end = pos + len(PACK_MAGIC)
+        trailer_offset = trailer_end - TRAILER_SIZE
+        if trailer_offset >= len(PACK_MAGIC) and is_valid_trailer(
+            data[trailer_offset:trailer_end], trailer_offset
+        ):
+            return trailer_end
+        end = trailer_end - 1
+
+
+def recover_pack(path: Path) -> int:
+    """Truncate a local pack after its last valid trailer.
+
+    Returns:
+        The size of the pack.
+    """
+    with path.open("r+b") as fp:
+        fd = fp.fileno()
+        size = os.fstat(fd).st_size
+        if os.pread(fd, len(PACK_MAGIC), 0) != PACK_MAGIC:
+            raise ValueError(f"Not a revision pack: {path}")
+        trailer_offset = size - TRAILER_SIZE
+        if trailer_offset >= len(PACK_MAGIC) and is_valid_trailer(
+            os.pread(fd, TRAILER_SIZE, trailer_offset), trailer_offset
+        ):
+            return size
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = find_pack_end(data)
+        if end == size:
+            return size
+        logger.warning(
+            "Revision pack %s ends with %d bytes written by an interrupted run, "
+            "truncating it",
+            path,
+            size - end,
+        )
+        fp.truncate(end)
+        return end
+
+
+def get_shard(
+    barcode: str, shard_prefix_length: int = DEFAULT_SHARD_PREFIX_LENGTH
+) -> str:
+    """Return the shard of a product, the prefix of its barcode."""
+    return barcode[:shard_prefix_length]
+
+
+def generate_pack_path(api_version: APIVersion, shard: str) -> str:
+    """Generate the path of a pack, relative to the pack directory (or to the
+    revision bucket)."""
+    return f"packs/{api_version.value}/{shard}.pack"
+
+
+class PackSource(abc.ABC):
+    """Random access to the content of a pack file."""
+
+    @abc.abstractmethod
+    def size(self) -> int:
+        """Return the size of the pack file."""
+
+    @abc.abstractmethod
+    def read(self, offset: int, length: int) -> bytes:
+        """Read `length` bytes of the pack file, starting at `offset`."""
+
+
+class LocalPackSource(PackSource):
+    def __init__(self, path: Path):
+        self.path = path
+
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+    def read(self, offset: int, length: int) -> bytes:
+        with self.path.open("rb") as fp:
+            return os.pread(fp.fileno(), length, offset)
+
+
+class S3PackSource(PackSource):
+    """Pack stored in a S3 bucket, read with ranged GET requests."""
+
+    def __init__(
+        self,
+        object_name: str,
+        bucket_name: str = settings.AWS_S3_REVISION_BUCKET,
+        minio_client: Minio | None = None,
+    ):
+        self.object_name = object_name
+        self.bucket_name = bucket_name
+        self.minio_client = minio_client or get_minio_client()
+
+    def size(self) -> int:
+        stat = self.minio_client.stat_object(self.bucket_name, self.object_name)
+        return stat.size or 0
+
+    def read(self, offset: int, length: int) -> bytes:
+        response = self.minio_client.get_object(
+            self.bucket_name, self.object_name, offset=offset, length=length
+        )
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+
+class _IndexKeys:
+    """Sequence of the keys of the records of a pack index, for `bisect`."""
+
+    def __init__(self, index: bytes):
+        self.index = index
+
+    def __len__(self) -> int:
+        return len(self.index) // ENTRY_SIZE
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.index[i * ENTRY_SIZE : i * ENTRY_SIZE + KEY_SIZE]
+
+
+class RevisionPackReader:
+    """Read the revisions of a pack.
+
+    The index of the pack is loaded on first access (two reads) and kept in
+    memory.
+    """
+
+    def __init__(self, source: PackSource):
+        self.source = source
+        self._index: bytes | None = None
+
+    @property
+    def index(self) -> bytes:
+        if self._index is None:
+            size = self.source.size()
+            if size < len(PACK_MAGIC) + TRAILER_SIZE:
+                raise ValueError(f"Invalid revision pack: {self.source}")
+            trailer = self.source.read(size - TRAILER_SIZE, TRAILER_SIZE)
+            if not is_valid_trailer(trailer, size - TRAILER_SIZE):
+                # The local pack is truncated by the next archival run
+                raise ValueError(f"Invalid revision pack trailer: {self.source}")
+            index_offset, count, _ = TRAILER_STRUCT.unpack(trailer)
+            self._index = (
+                self.source.read(index_offset, count * ENTRY_SIZE) if count else b""
+            )
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.index) // ENTRY_SIZE
+
+    def iter_entries(self) -> Iterator[PackEntry]:
+        """Iterate over the index entries, sorted by (barcode, rev)."""
+        index = self.index
+        for start in range(0, len(index), ENTRY_SIZE):
+            yield decode_entry(index[start : start + ENTRY_SIZE])
+
+    def lookup(self, barcode: str, rev_id: int) -> PackEntry | None:
+        """Return the index entry of a revision, or None if it is not in the
+        pack."""
+        index = self.index
+        key = encode_barcode(barcode) + rev_id.to_bytes(4, "big")
+        i = bisect.bisect_left(_IndexKeys(index), key)
+        start = i * ENTRY_SIZE
+        if start < len(index) and index[start : start + KEY_SIZE] == key:
+            return decode_entry(index[start : start + ENTRY_SIZE])
+        return None
+
+    def get_revision(self, barcode: str, rev_id: int) -> JSONType | None:
+        """Return a revision (with a single ranged read once the index is
+        loaded), or None if it is not in the pack."""
+        entry = self.lookup(barcode, rev_id)
+        if entry is None:
+            return None
+        return orjson.loads(
+            zlib.decompress(self.source.read(entry.offset, entry.length))
+        )
+
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        """Iterate over the products of the pack, as (barcode, revision IDs)
+        tuples (see `RevisionStore.iter_products`)."""
+        current_barcode = None
+        rev_ids: list[int] = []
+        for entry in self.iter_entries():
+            if entry.barcode != current_barcode:
+                if current_barcode is not None:
+                    yield current_barcode, rev_ids
+                current_barcode = entry.barcode
+                rev_ids = []
+            rev_ids.append(entry.rev_id)
+        if current_barcode is not None:
+            yield current_barcode, rev_ids
+
+    def iter_revisions(
+        self, chunk_size: int = DEFAULT_SCAN_CHUNK_SIZE
+    ) -> Iterator[tuple[str, int, JSONType]]:
+        """Scan all the revisions of the pack, in file order.
+
+        Consecutive revisions are fetched with reads of about `chunk_size`
+        bytes.
+
+        Yields:
+            (barcode, revision ID, revision) tuples.
+        """
+        entries = sorted(self.iter_entries(), key=lambda entry: entry.offset)
+        i = 0
+        while i < len(entries):
+            # Group the revisions contiguous in the file, up to chunk_size
+            j = i + 1
+            while (
+                j < len(entries)
+                and entries[j].offset == entries[j - 1].offset + entries[j - 1].length
+                and entries[j].offset + entries[j].length - entries[i].offset
+                <= chunk_size
+            ):
+                j += 1
+            chunk_offset = entries[i].offset
+            chunk = self.source.read(
+                chunk_offset,
+                entries[j - 1].offset + entries[j - 1].length - chunk_offset,
+            )
+            for entry in entries[i:j]:
+                start = entry.offset - chunk_offset
+                yield (
+                    entry.barcode,
+                    entry.rev_id,
+                    orjson.loads(zlib.decompress(chunk[start : start + entry.length])),
+                )
+            i = j
+
+
+class RevisionPackWriter:
+    """Append revisions to a pack file.
+
+    The new index and trailer are written by `close`. If an error occurs
+    before, the pack is truncated back to its previous content.
+
+    Args:
+        path: The path of the pack, created if it does not exist.
+        compression_level: The zlib compression level of the revisions.
+        max_stale_ratio: `close` compacts the pack if the indexes and
+            trailers of previous runs take more than this fraction of the
+            pack (never if None).
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        compression_level: int = 6,
+        max_stale_ratio: float | None = DEFAULT_MAX_STALE_RATIO,
+    ):
+        self.path = path
+        self.compression_level = compression_level
+        self.max_stale_ratio = max_stale_ratio
+        # (barcode, rev) -> index record, for existing and new revisions
+        self._records: dict[tuple[str, int], bytes] = {}
+        # Total size of the (compressed) revisions of the pack
+        self._revisions_size = 0
+        if path.is_file():
+            # Nothing is indexed if the first run was interrupted
+            if recover_pack(path) > len(PACK_MAGIC):
+                for entry in RevisionPackReader(LocalPackSource(path)).iter_entries():
+                    self._records[(entry.barcode, entry.rev_id)] = encode_entry(entry)
+                    self._revisions_size += entry.length
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(PACK_MAGIC)
+        self._fp: BinaryIO = path.open("ab")
+        self._initial_size = self._offset = self._fp.tell()
+        self.new_revisions = 0
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return key in self._records
+
+    def append(self, barcode: str, rev_id: int, content: bytes) -> bool:
+        """Append a revision (serialized as JSON) to the pack.
+
+        Returns:
+            False if the revision was already in the pack or can't be packed
+            (barcode too long), True otherwise.
+        """
+        if (barcode, rev_id) in self._records:
+            return False
+        try:
+            # Check the barcode before writing anything
+            encode_barcode(barcode)
+        except ValueError as e:
+            logger.warning("Skipping revision %s of %s: %s", rev_id, barcode, e)
+            return False
+        compressed = zlib.compress(content, self.compression_level)
+        self._fp.write(compressed)
+        self._records[(barcode, rev_id)] = encode_entry(
+            PackEntry(barcode, rev_id, self._offset, len(compressed))
+        )
+        self._offset += len(compressed)
+        self._revisions_size += len(compressed)
+        self.new_revisions += 1
+        return True
+
+    @property
+    def stale_size(self) -> int:
+        """Size of the indexes and trailers written by previous runs (all
+        stale once `close` writes the new index)."""
+        return self._offset - len(PACK_MAGIC) - self._revisions_size
+
+    def close(self) -> None:
+        """Write the index and the trailer of the pack, if revisions were
+        appended, and compact the pack if needed."""
+        if self._fp.closed:
+            return
+        if not self.new_revisions:
+            # Nothing to write, and an empty new pack is removed
+            self.abort()
+            return
+        # Big-endian records sort by (barcode, rev) as raw bytes
+        records = sorted(self._records.values())
+        with self._fp:
+            self._fp.write(b"".join(records))
+            self._fp.write(TRAILER_STRUCT.pack(self._offset, len(records), PACK_MAGIC))
+        size = self._offset + len(records) * ENTRY_SIZE + TRAILER_SIZE
+        if (
+            self.max_stale_ratio is not None
+            and self.stale_size > self.max_stale_ratio * size
+        ):
+            compact_pack(self.path)
+
+    def abort(self) -> None:
+        """Discard the revisions appended since the pack was opened (no-op
+        once the pack is closed)."""
+        if self._fp.closed:
+            return
+        self._fp.close()
+        os.truncate(self.path, self._initial_size)
+        if self._initial_size == len(PACK_MAGIC):
+            self.path.unlink()
+
+    def __enter__(self) -> "RevisionPackWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def compact_pack(path: Path) -> None:
+    """Rewrite a local pack with a single index, dropping the indexes and
+    trailers of previous runs (and the tail of an interrupted run).
+
+    The revisions are copied without being decompressed, in (barcode, rev)
+    order. The pack is replaced atomically.
+    """
+    recover_pack(path)
+    entries = list(RevisionPackReader(LocalPackSource(path)).iter_entries())
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    try:
+        with path.open("rb") as src, tmp_path.open("wb") as fp:
+            fp.write(PACK_MAGIC)
+            offset = len(PACK_MAGIC)
+            records = []
+            for entry in entries:
+                fp.write(os.pread(src.fileno(), entry.length, entry.offset))
+                records.append(encode_entry(entry._replace(offset=offset)))
+                offset += entry.length
+            fp.write(b"".join(records))
+            fp.write(TRAILER_STRUCT.pack(offset, len(records), PACK_MAGIC))
+        tmp_path.replace(path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    logger.info(
+        "Revision pack %s compacted (%d revisions, %d bytes)",
+        path,
+        len(entries),
+        path.stat().st_size,
+    )
+
+
+class PackedRevisionStore(RevisionStore):
+    """Revisions stored in local pack files."""
+
+    def __init__(
+        self,
+        pack_dir: Path,
+        api_version: APIVersion = APIVersion.v2,
+        shard_prefix_length: int = DEFAULT_SHARD_PREFIX_LENGTH,
+    ):
+        super().__init__(api_version)
+        self.pack_dir = pack_dir
+        self.shard_prefix_length = shard_prefix_length
+        self._readers: dict[str, RevisionPackReader | None] = {}
+
+    def get_reader(self, shard: str) -> RevisionPackReader | None:
+        if shard not in self._readers:
+            path = self.pack_dir / generate_pack_path(self.api_version, shard)
+            self._readers[shard] = (
+                RevisionPackReader(LocalPackSource(path)) if path.is_file() else None
+            )
+        return self._readers[shard]
+
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        api_dir = self.pack_dir / "packs" / self.api_version.value
+        if not api_dir.is_dir():
+            return
+        for path in sorted(api_dir.glob("*.pack")):
+            yield from RevisionPackReader(LocalPackSource(path)).iter_products()
+
+    def get_revision(self, barcode: str, rev_id: int | str) -> JSONType | None:
+        reader = self.get_reader(get_shard(barcode, self.shard_prefix_length))
+        if reader is None:
+            return None
+        return reader.get_revision(barcode, int(rev_id))
+
+
+class PackingStats(BaseModel):
+    """Result of an archival run."""
+
+    products: int = 0
+    packed_revisions: int = 0
+    missing_revisions: int = 0
+    # Shards where revisions were appended
+    updated_shards: list[str] = []
+
+
+def pack_revisions(
+    store: RevisionStore,
+    pack_dir: Path,
+    shard_prefix_length: int = DEFAULT_SHARD_PREFIX_LENGTH,
+    compression_level: int = 6,
+    num_threads: int = 8,
+) -> PackingStats:
+    """Append the revisions of the store that are not packed yet to the
+    pack files.
+
+    Args:
+        store: The revision store to archive.
+        pack_dir: The directory of the pack files.
+        shard_prefix_length: The length of the barcode prefix used as shard
+            key, defaults to 3.
+        compression_level: The zlib compression level, defaults to 6.
+        num_threads: The number of threads fetching revisions from the
+            store, defaults to 8.
+
+    Returns:
+        Statistics about the run.
+    """
+    stats = PackingStats()
+    writer: RevisionPackWriter | None = None
+    current_shard = None
+
+    def fetch_revision(key: tuple[str, int]) -> bytes | None:
+        product = store.get_revision(*key)
+        return None if product is None else orjson.dumps(product)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for barcode, rev_ids in store.iter_products():
+                stats.products += 1
+                shard = get_shard(barcode, shard_prefix_length)
+                if writer is None or shard != current_shard:
+                    if writer is not None:
+                        writer.close()
+                    current_shard = shard
+                    writer = RevisionPackWriter(
+                        pack_dir / generate_pack_path(store.api_version, shard),
+                        compression_level,
+                    )
+                keys = [
+                    (barcode, rev_id)
+                    for rev_id in rev_ids
+                    if (barcode, rev_id) not in writer
+                ]
+                for (_, rev_id), content in zip(
+                    keys, executor.map(fetch_revision, keys)
+                ):
+                    if content is None:
+                        stats.missing_revisions += 1
+                        continue
+                    if not writer.append(barcode, rev_id, content):
+                        continue
+                    stats.packed_revisions += 1
+                    if shard not in stats.updated_shards:
+                        stats.updated_shards.append(shard)
+        if writer is not None:
+            writer.close()
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    logger.info(
+        "%d revisions packed in %d shards (%d products, %d missing revisions)",
+        stats.packed_revisions,
+        len(stats.updated_shards),
+        stats.products,
+        stats.missing_revisions,
+    )
+    return stats
+
+
+def upload_packs(
+    pack_dir: Path,
+    shards: list[str],
+    api_version: APIVersion = APIVersion.v2,
+    bucket_name: str = settings.AWS_S3_REVISION_BUCKET,
+    minio_client: Minio | None = None,
+) -> None:
+    """Upload pack files to the revision bucket, replacing the previous
+    version of the packs."""
+    minio_client = minio_client or get_minio_client()
+    for shard in shards:
+        object_name = generate_pack_path(api_version, shard)
+        minio_client.fput_object(bucket_name, object_name, str(pack_dir / object_name))
+        logger.debug("Pack %s uploaded", object_name)
@@ -0,0 +1,167 @@
+"""Read access to the product revisions uploaded by `upload_revision`.
+
+Revisions are stored as `{api_version}/{barcode}/{rev}.json`, either in the
+S3 revision bucket or in a local directory with the same layout (ex: a copy
+of the bucket).
+"""
+
+import abc
+import os
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+import orjson
+from minio import Minio
+from minio.error import S3Error
+from openfoodfacts import APIVersion
+from openfoodfacts.types import JSONType
+
+from openfoodfacts_exports import settings
+from openfoodfacts_exports.tasks.revisions import generate_revision_path
+from openfoodfacts_exports.utils import get_minio_client
+
+if TYPE_CHECKING:
+    from openfoodfacts_exports.tasks.revision_index import RevisionIndex
+
+
+def parse_revision_file_name(file_name: str) -> int | None:
+    """Return the revision ID from a revision file name (`{rev}.json`), or
+    None if the file is not a numbered revision (ex: `latest.json`)."""
+    rev_id, _, extension = file_name.partition(".")
+    if extension != "json" or not rev_id.isdigit():
+        return None
+    return int(rev_id)
+
+
+class RevisionStore(abc.ABC):
+    """A store of product revisions."""
+
+    def __init__(self, api_version: APIVersion = APIVersion.v2):
+        self.api_version = api_version
+
+    @abc.abstractmethod
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        """Iterate over the products of the store.
+
+        Yields:
+            (barcode, revision IDs) tuples, revision IDs being sorted in
+            increasing order. `latest.json` is not included.
+        """
+
+    @abc.abstractmethod
+    def get_revision(self, barcode: str, rev_id: int | str) -> JSONType | None:
+        """Return a product revision, or None if it does not exist."""
+
+
+class LocalRevisionStore(RevisionStore):
+    """Revisions stored in a local directory."""
+
+    def __init__(self, root: Path, api_version: APIVersion = APIVersion.v2):
+        super().__init__(api_version)
+        self.root = root
+
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        api_dir = self.root / self.api_version.value
+        with os.scandir(api_dir) as barcode_entries:
+            barcodes = sorted(entry.name for entry in barcode_entries if entry.is_dir())
+        for barcode in barcodes:
+            with os.scandir(api_dir / barcode) as entries:
+                rev_ids = sorted(
+                    rev_id
+                    for entry in entries
+                    if (rev_id := parse_revision_file_name(entry.name)) is not None
+                )
+            if rev_ids:
+                yield barcode, rev_ids
+
+    def get_revision(self, barcode: str, rev_id: int | str) -> JSONType | None:
+        path = self.root / generate_revision_path(self.api_version, barcode, rev_id)
+        try:
+            return orjson.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+
+
+class S3RevisionStore(RevisionStore):
+    """Revisions stored in the S3 revision bucket.
+
+    The Minio client is created lazily, so that the store can be sent to
+    worker processes. If a local revision index is provided, products are
+    listed from the index instead of the bucket (the index is reopened from
+    its path in worker processes).
+    """
+
+    def __init__(
+        self,
+        bucket_name: str = settings.AWS_S3_REVISION_BUCKET,
+        api_version: APIVersion = APIVersion.v2,
+        minio_client: Minio | None = None,
+        revision_index: "RevisionIndex | None" = None,
+    ):
+        super().__init__(api_version)
+        self.bucket_name = bucket_name
+        self._minio_client = minio_client
+        self._revision_index = revision_index
+        self.revision_index_path = (
+            revision_index.path if revision_index is not None else None
+        )
+
+    @property
+    def minio_client(self) -> Minio:
+        if self._minio_client is None:
+            self._minio_client = get_minio_client()
+        return self._minio_client
+
+    @property
+    def revision_index(self) -> "RevisionIndex | None":
+        if self._revision_index is None and self.revision_index_path is not None:
+            from openfoodfacts_exports.tasks.revision_index import RevisionIndex
+
+            self._revision_index = RevisionIndex(self.revision_index_path)
+        return self._revision_index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_minio_client"] = None
+        # The index holds an open memory-mapped file
+        state["_revision_index"] = None
+        return state
+
+    def iter_products(self) -> Iterator[tuple[str, list[int]]]:
+        if self.revision_index is not None:
+            yield from self.revision_index.iter_products()
+            return
+        # Objects are listed in lexicographic order, so all the revisions of
+        # a product are contiguous
+        current_barcode = None
+        rev_ids: list[int] = []
+        for obj in self.minio_client.list_objects(
+            self.bucket_name, prefix=f"{self.api_version.value}/", recursive=True
+        ):
+            if obj.object_name is None:
+                continue
+            _, barcode, file_name = obj.object_name.split("/", maxsplit=2)
+            if barcode != current_barcode:
+                if current_barcode is not None and rev_ids:
+                    yield current_barcode, sorted(rev_ids)
+                current_barcode = barcode
+                rev_ids = []
+            rev_id = parse_revision_file_name(file_name)
+            if rev_id is not None:
+                rev_ids.append(rev_id)
+        if current_barcode is not None and rev_ids:
+            yield current_barcode, sorted(rev_ids)
+
+    def get_revision(self, barcode: str, rev_id: int | str) -> JSONType | None:
+        path = generate_revision_path(self.api_version, barcode, rev_id)
+        try:
+            response = self.minio_client.get_object(self.bucket_name, path)
+        except S3Error as e:
+            if e.code == "NoSuchKey":
+                return None
+            raise
+        try:
+            return orjson.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
@@ -1,65 +1,214 @@
 import io
 import logging
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 
 import orjson
 from minio import Minio
+from minio.error import S3Error
 from openfoodfacts import APIVersion, Environment, Flavor
 from openfoodfacts.api import API
 from openfoodfacts.types import JSONType
 
 from openfoodfacts_exports import settings
+from openfoodfacts_exports.tasks.deletion import BatchDeleter
 from openfoodfacts_exports.utils import get_minio_client
 
+if TYPE_CHECKING:
+    from openfoodfacts_exports.tasks.revision_index import RevisionIndex
+
 logger = logging.getLogger(__name__)
 
 
+# Paths of the fields containing user IDs, that are removed from product
+# revisions. `*` matches any key of a dict.
+USER_ID_FIELD_PATHS: tuple[tuple[str, ...], ...] = (
+    ("checkers_tags",),
+    ("correctors_tags",),
+    ("creator",),
+    ("editors_tags",),
+    ("informers_tags",),
+    ("last_checker",),
+    ("last_editor",),
+    ("last_modified_by",),
+    ("photographers_tags",),
+    # Legacy image schema, with image IDs as keys
+    ("images", "*", "uploader"),
+    # New image schema, with `uploaded` and `selected` fields
+    ("images", "uploaded", "*", "uploader"),
+)
+
+# Marker of a trie leaf: the field must be removed
+_REMOVE = None
+
+# A redaction trie maps a key (or `*`) to a sub-trie, or to `_REMOVE`
+RedactionTrie = dict[str, "RedactionTrie | None"]
+
+
+def _merge_tries(
+    first: RedactionTrie | None, second: RedactionTrie | None
+) -> RedactionTrie | None:
+    """Merge two redaction tries, field removal takes precedence."""
+    if first is None or second is None:
+        return _REMOVE
+    merged = dict(first)
+    for key, sub_trie in second.items():
+        merged[key] = _merge_tries(merged[key], sub_trie) if key in merged else sub_trie
+    return merged
+
+
+def compile_redaction_trie(paths: Iterable[tuple[str, ...]]) -> RedactionTrie:
+    """Compile field paths into a redaction trie.
+
+    The sub-trie of the `*` wildcard is merged into the sub-trie of every
+    explicit key of the same level, so that a key only needs to be looked up
+    once during redaction.
+
+    Args:
+        paths: The paths of the fields to remove.
+
+    Returns:
+        The redaction trie.
+    """
+    trie: RedactionTrie = {}
+    for path in paths:
+        path_trie: RedactionTrie | None = _REMOVE
+        for part in reversed(path):
+            path_trie = {part: path_trie}
+        trie = _merge_tries(trie, path_trie) or {}
+
+    def merge_wildcard(trie: RedactionTrie | None) -> RedactionTrie | None:
+        if trie is None:
+            return _REMOVE
+        wildcard = trie.get("*", {})
+        return {
+            key: merge_wildcard(
+                sub_trie if key == "*" else _merge_tries(sub_trie, wildcard)
+            )
+            for key, sub_trie in trie.items()
+        }
+
+    return merge_wildcard(trie) or {}
+
+
+def compile_redactor(trie: RedactionTrie) -> Callable[[Any], Any]:
+    """Compile a redaction trie into a function removing the fields described
+    by the trie from a JSON value.
+
+    The returned function never modifies its input: a new dict is only
+    created along the paths where a field is removed, all other
+    sub-structures are shared with the input. If nothing is removed, the
+    input itself is returned.
+
+    Args:
+        trie: The redaction trie, see `compile_redaction_trie`.
+
+    Returns:
+        The redaction function.
+    """
+    wildcard_trie = trie.get("*")
+    wildcard = None if wildcard_trie is None else compile_redactor(wildcard_trie)
+    # key -> redaction function of the child, or None to remove the child
+    children = {
+        key: None if sub_trie is None else compile_redactor(sub_trie)
+        for key, sub_trie in trie.items()
+        if key != "*"
+    }
+
+    if wildcard is None and all(child is None for child in children.values()):
+        # Most common case: remove some keys of a dict
+        removed_keys = tuple(children)
+
+        if len(removed_keys) == 1:
+            (removed_key,) = removed_keys
+
+            def remove_key(value: Any) -> Any:
+                if type(value) is not dict or removed_key not in value:
+                    return value
+                value = value.copy()
+                del value[removed_key]
+                return value
+
+            return remove_key
+
+        def remove_keys(value: Any) -> Any:
+            if type(value) is not dict:
+                return value
+            present_keys = [key for key in removed_keys if key in value]
+            if not present_keys:
+                return value
+            value = value.copy()
+            for key in present_keys:
+                del value[key]
+            return value
+
+        return remove_keys
+
+    def redact(value: Any) -> Any:
+        if type(value) is not dict:
+            return value
+        copy: dict | None = None
+        items: Iterable[tuple[str, Any]]
+        if wildcard is not None:
+            items = value.items()
+        else:
+            # Only look up the keys of the trie, products have hundreds of fields
+            items = [(key, value[key]) for key in children if key in value]
+
+        for key, child in items:
+            redact_child = children.get(key, wildcard)
+            if redact_child is None:
+                if copy is None:
+                    copy = value.copy()
+                del copy[key]
+            else:
+                new_child = redact_child(child)
+                if new_child is not child:
+                    if copy is None:
+                        copy = value.copy()
+                    copy[key] = new_child
+        return value if copy is None else copy
+
+    return redact
+
+
+_strip_user_ids = compile_redactor(compile_redaction_trie(USER_ID_FIELD_PATHS))
+
+# Byte patterns of the redacted field names, used to skip parsing of JSON
+# documents that don't contain any of them
+_USER_ID_FIELD_NAME_PATTERNS = tuple(
+    {f'"{path[-1]}"'.encode("utf-8") for path in USER_ID_FIELD_PATHS}
+)
+
+
 def strip_product_from_user_ids(product: JSONType) -> JSONType:
     """Strip the product from any user ID, so that we respect the right of the user to
     be forgotten. This function is intended to be used when saving historical data, so
-    that we don't have to modify these files when a user ask for account deletion."""
-    product = product.copy()
-    for field_name in list(
-        k
-        for k in product.keys()
-        if k
-        in {
-            "checkers_tags",
-            "correctors_tags",
-            "creator",
-            "editors_tags",
-            "informers_tags",
-            "last_checker",
-            "last_editor",
-            "last_modified_by",
-            "photographers_tags",
-        }
-    ):
-        product.pop(field_name)
-
-    images = product.get("images", {})
-
-    if "uploaded" in images:
-        # New images schema, with `uploaded` and `selected` fields
-        uploaded = images["uploaded"]
-        for image_key, image_data in uploaded.items():
-            if "uploader" in image_data:
-                image_data = image_data.copy()
-                image_data.pop("uploader")
-                uploaded[image_key] = image_data
-    else:
-        # Legacy image schema, with image ID as keys
-        for image_key, image_data in images.items():
-            if "uploader" in image_data:
-                image_data = image_data.copy()
-                image_data.pop("uploader")
-                images[image_key] = image_data
-    return product
+    that we don't have to modify these files when a user ask for account deletion.
+
+    The input product is not modified, unchanged sub-structures are shared
+    between the input and the output."""
+    return _strip_user_ids(product)
+
+
+def strip_product_json_from_user_ids(product_json: bytes) -> bytes:
+    """Same as `strip_product_from_user_ids`, but for a serialized JSON
+    product.
+
+    The JSON is only parsed if it contains one of the fields to remove,
+    otherwise it is returned as is.
+    """
+    if not any(pattern in product_json for pattern in _USER_ID_FIELD_NAME_PATTERNS):
+        return product_json
+    return orjson.dumps(strip_product_from_user_ids(orjson.loads(product_json)))
 
 
 def sync_product_revision(
-    barcode: str, environment: Environment, flavor: Flavor
-) -> None:
+    barcode: str,
+    environment: Environment,
+    flavor: Flavor,
+    revision_index: "RevisionIndex | None" = None,
+) -> JSONType | None:
     """Synchronize a product revision to S3.
 
     This function retrieves the product data from the Open Food Facts API and uploads it
@@ -69,6 +218,12 @@ def sync_product_revision(
         barcode: The barcode of the product.
         environment: The environment to use.
         flavor: The flavor to use.
+        revision_index: If provided, the uploaded revision is added to this
+            local revision index.
+
+    Returns:
+        The uploaded revision (without user IDs), or None if the product could
+        not be fetched.
     """
     api_version = APIVersion.v2
     api = API(
@@ -82,10 +237,10 @@ def sync_product_revision(
         product = api.product.get(code=barcode)
     except Exception as e:
         logger.error("Failed to sync product revision for barcode %s: %s", barcode, e)
-        return
+        return None
     if product is None:
         # Product does not exist
-        return
+        return None
     else:
         product = strip_product_from_user_ids(product)
         # Product found
@@ -95,32 +250,65 @@ def sync_product_revision(
             barcode=barcode,
             product=product,
             set_as_latest=True,
+            revision_index=revision_index,
         )
+        return product
+
 
+def delete_product_from_s3(
+    barcode: str,
+    deleter: BatchDeleter | None = None,
+    purge_revisions: bool = False,
+) -> None:
+    """Remove a deleted product from S3.
+
+    By default, only the latest revision (`latest.json`) is removed, so that
+    the product history is kept.
 
-def delete_product_from_s3(barcode: str) -> None:
+    The objects are deleted immediately, even with a buffering deleter: a
+    buffered deletion could remove the `latest.json` uploaded by a later
+    update of the product.
+
+    Args:
+        barcode: The barcode of the product.
+        deleter: The deleter used to send the deletions, defaults to a new
+            deleter.
+        purge_revisions: Whether to also remove all the revisions of the
+            product, listed by prefix.
+    """
     client = get_minio_client()
-    remove_latest_revision(
-        client,
-        APIVersion.v2,
-        barcode,
-    )
+    if deleter is None:
+        deleter = BatchDeleter(client)
 
+    object_names = [generate_revision_path(APIVersion.v2, barcode, "latest")]
+    if purge_revisions:
+        object_names += list_revision_paths(client, APIVersion.v2, barcode)
+    logger.info("Removing %d revision(s) for barcode %s", len(object_names), barcode)
+    deleter.delete(settings.AWS_S3_REVISION_BUCKET, object_names)
 
-def remove_latest_revision(minio_client: Minio, api_version: APIVersion, barcode: str):
-    """Remove the latest revision for a product from S3.
+
+def list_revision_paths(
+    minio_client: Minio, api_version: APIVersion, barcode: str
+) -> list[str]:
+    """List the paths of all the revisions of a product stored on S3
+    (including `latest.json`).
 
     Args:
         minio_client: The Minio client.
         api_version: The API version we used when calling the Open Food Facts API.
         barcode: The barcode of the product.
+
+    Returns:
+        The list of revision paths.
     """
-    revision_path = generate_revision_path(api_version, barcode, "latest")
-    logger.info("Removing latest revision for barcode %s at %s", barcode, revision_path)
-    minio_client.remove_object(
-        bucket_name=settings.AWS_S3_REVISION_BUCKET,
-        object_name=revision_path,
-    )
+    prefix = f"{api_version.value}/{barcode}/"
+    return [
+        obj.object_name
+        for obj in minio_client.list_objects(
+            settings.AWS_S3_REVISION_BUCKET, prefix=prefix, recursive=True
+        )
+        if obj.object_name is not None
+    ]
 
 
 def upload_revision(
@@ -129,6 +317,7 @@ def upload_revision(
     barcode: str,
     product: JSONType,
     set_as_latest: bool = False,
+    revision_index: "RevisionIndex | None" = None,
 ) -> None:
     """Upload a product revision to S3.
 
@@ -139,6 +328,8 @@ def upload_revision(
         product: The product data.
         set_as_latest: Whether to upload a revision named "latest.json" alongside the
             regular revision with the same content.
+        revision_index: If provided, the revision is added to this local
+            revision index once uploaded.
     """
     rev = product["rev"]
     revision_path = generate_revision_path(api_version, barcode, rev)
@@ -171,6 +362,41 @@ def upload_revision(
             length=len(product_bytes),
             content_type="application/json",
         )
+    if revision_index is not None:
+        # The index is a local cache of the bucket: failing to update it must
+        # not fail the upload
+        try:
+            revision_index.add(barcode, rev, product_bytes)
+        except Exception:
+            logger.exception(
+                "Failed to add revision %s of %s to the revision index", rev, barcode
+            )
+
+
+def revision_exists(
+    minio_client: Minio,
+    api_version: APIVersion,
+    barcode: str,
+    rev_id: int | str,
+) -> bool:
+    """Return True if a product revision is stored on S3.
+
+    Args:
+        minio_client: The Minio client.
+        api_version: The API version we used when calling the Open Food Facts API.
+        barcode: The barcode of the product.
+        rev_id: The revision ID (or "latest").
+    """
+    try:
+        minio_client.stat_object(
+            settings.AWS_S3_REVISION_BUCKET,
+            generate_revision_path(api_version, barcode, rev_id),
+        )
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            return False
+        raise
+    return True
 
 
 def generate_revision_path(
@@ -1,5 +1,7 @@
 import logging
+import signal
 import time
+from pathlib import Path
 
 import backoff
 from openfoodfacts import Environment, Flavor
@@ -7,16 +9,30 @@ from openfoodfacts.redis import ProductUpdateEvent
 from openfoodfacts.redis import UpdateListener as BaseUpdateListener
 from redis import Redis
 from redis.exceptions import ConnectionError
+from rq.exceptions import InvalidJobOperation
+from rq.job import Job, JobStatus
 
 from openfoodfacts_exports import settings
+from openfoodfacts_exports.exports.historical_events_store import (
+    HistoricalEventStore,
+)
+from openfoodfacts_exports.tasks.deletion import BatchDeleter
+from openfoodfacts_exports.tasks.event_capture import LiveEventCapture
 from openfoodfacts_exports.tasks.images import (
     delete_image_from_s3,
     upload_new_image_to_s3,
 )
+from openfoodfacts_exports.tasks.revision_index import (
+    RevisionIndex,
+    merge_revision_index,
+)
+from openfoodfacts_exports.tasks.revision_store import S3RevisionStore
 from openfoodfacts_exports.tasks.revisions import (
     delete_product_from_s3,
     sync_product_revision,
 )
+from openfoodfacts_exports.utils import get_minio_client
+from openfoodfacts_exports.workers.queues import low_queue
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +47,81 @@ def get_redis_client():
 
 
 class UpdateListener(BaseUpdateListener):
+    def __init__(
+        self,
+        *args,
+        deleter: BatchDeleter | None = None,
+        event_capture: LiveEventCapture | None = None,
+        revision_index: RevisionIndex | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        # Deleter used to aggregate S3 deletions across events, deletions are
+        # performed immediately if not provided
+        self.deleter = deleter
+        # If provided, historical events are generated for every product
+        # update
+        self.event_capture = event_capture
+        # If provided, uploaded revisions are added to the local revision
+        # index
+        self.revision_index = revision_index
+        # Last job enqueued to merge the journal of the revision index
+        self._merge_job: Job | None = None
+        # Set when SIGTERM or SIGINT is received while an event is processed
+        self._processing = False
+        self._stop_requested = False
+
+    def handle_stop_signal(self, signum: int, frame) -> None:
+        """Stop the listener on SIGTERM or SIGINT: immediately if it waits
+        for updates, after the current event otherwise."""
+        logger.info("Received signal %d, stopping the update listener", signum)
+        if not self._processing:
+            raise SystemExit(0)
+        self._stop_requested = True
+
+    def flush(self) -> None:
+        """Send the buffered S3 deletions and write the buffered historical
+        events."""
+        if self.deleter is not None:
+            self.deleter.flush()
+        if self.event_capture is not None:
+            self.event_capture.flush()
+
+    def listen(self) -> None:
+        """Process the updates until SIGTERM or SIGINT is received, then
+        flush the buffered deletions and events.
+
+        The latest processed ID is saved after each event, so buffered data
+        must be flushed before exiting: the stream is not replayed on
+        restart. If the signal is received while an event is processed, the
+        event is processed again on restart.
+        """
+        previous_handlers = {
+            signum: signal.signal(signum, self.handle_stop_signal)
+            for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        if self.event_capture is not None:
+            # Events must not stay buffered while no update is received
+            self.event_capture.start_flush_thread()
+        try:
+            self.run()
+        finally:
+            if self.event_capture is not None:
+                self.event_capture.stop_flush_thread()
+            self.flush()
+            for signum, handler in previous_handlers.items():
+                signal.signal(signum, handler)
+
     def process_redis_update(self, event: ProductUpdateEvent):
+        self._processing = True
+        try:
+            self._process_redis_update(event)
+        finally:
+            self._processing = False
+        if self._stop_requested:
+            raise SystemExit(0)
+
+    def _process_redis_update(self, event: ProductUpdateEvent):
         logger.debug("New update: %s", event)
 
         if not event.code:
@@ -45,7 +135,11 @@ class UpdateListener(BaseUpdateListener):
         flavor = Flavor[event.flavor]
         if action == "deleted":
             logger.info("Product %s has been deleted", event.code)
-            delete_product_from_s3(barcode=event.code)
+            delete_product_from_s3(
+                barcode=event.code,
+                deleter=self.deleter,
+                purge_revisions=bool(settings.PURGE_REVISIONS_ON_DELETION),
+            )
         elif action == "updated":
             logger.info("Product %s has been updated", event.code)
             # The redis event is sometimes published before Product Opener finishes
@@ -70,8 +164,54 @@ class UpdateListener(BaseUpdateListener):
             flavor,
             environment,
         )
-        sync_product_revision(
-            barcode=event.code, environment=environment, flavor=flavor
+        product = sync_product_revision(
+            barcode=event.code,
+            environment=environment,
+            flavor=flavor,
+            revision_index=self.revision_index,
+        )
+        if product is not None and self.event_capture is not None:
+            try:
+                self.event_capture.capture(event, product)
+            except Exception as e:
+                logger.error(
+                    "Failed to capture historical events for barcode %s: %s",
+                    event.code,
+                    e,
+                    exc_info=True,
+                )
+        if self.revision_index is not None:
+            self.schedule_revision_index_merge(self.revision_index)
+
+    def schedule_revision_index_merge(self, revision_index: RevisionIndex) -> None:
+        """Enqueue a job merging the journal of the revision index into the
+        index file if the journal is large enough.
+
+        The merge rewrites the whole index file, so it runs in a worker
+        rather than in the event loop. No job is enqueued while the previous
+        one is pending.
+        """
+        if revision_index.journal_count < settings.REVISION_INDEX_MERGE_THRESHOLD:
+            return
+        if self._merge_job is not None:
+            try:
+                status = self._merge_job.get_status(refresh=True)
+            except InvalidJobOperation:
+                # The job expired from Redis
+                status = None
+            if status in (
+                JobStatus.QUEUED,
+                JobStatus.STARTED,
+                JobStatus.DEFERRED,
+                JobStatus.SCHEDULED,
+            ):
+                return
+        logger.info(
+            "Revision index journal has %d records, enqueuing a merge",
+            revision_index.journal_count,
+        )
+        self._merge_job = low_queue.enqueue(
+            merge_revision_index, revision_index.path, job_timeout="1h"
         )
 
     def process_image_upload(
@@ -95,7 +235,9 @@ class UpdateListener(BaseUpdateListener):
             image_id,
             event.code,
         )
-        delete_image_from_s3(image_id=image_id, barcode=event.code)
+        delete_image_from_s3(
+            image_id=image_id, barcode=event.code, deleter=self.deleter
+        )
 
 
 @backoff.on_exception(
@@ -120,6 +262,26 @@ def run_update_listener():
     product updates and triggers appropriate actions.
     """
     logger.info("Starting Redis update listener...")
+    minio_client = get_minio_client()
+    # Buffered deletions are saved in Redis, next to the latest processed ID:
+    # the stream is not replayed if the listener is killed before sending them
+    deleter = BatchDeleter(
+        minio_client,
+        window=settings.S3_DELETION_WINDOW,
+        redis_client=get_redis_client(),
+    )
+    deleter.recover()
+    revision_index = None
+    if settings.REVISION_INDEX_PATH:
+        revision_index = RevisionIndex(Path(settings.REVISION_INDEX_PATH))
+    event_capture = None
+    if settings.ENABLE_HISTORICAL_EVENT_CAPTURE:
+        event_capture = LiveEventCapture(
+            event_store=HistoricalEventStore(settings.HISTORICAL_EVENT_STORE_DIR),
+            revision_store=S3RevisionStore(minio_client=minio_client),
+            cache_size=settings.HISTORICAL_EVENT_CACHE_SIZE_MB * 1024 * 1024,
+            flush_interval=settings.HISTORICAL_EVENT_FLUSH_INTERVAL,
+        )
     while True:
         try:
             redis_client = get_redis_client()
@@ -127,8 +289,11 @@ def run_update_listener():
                 redis_client=redis_client,
                 redis_latest_id_key=settings.REDIS_LATEST_ID_KEY,
                 product_updates_stream_name=settings.PRODUCT_UPDATE_STREAM_NAME,
+                deleter=deleter,
+                event_capture=event_capture,
+                revision_index=revision_index,
             )
-            update_listener.run()
+            update_listener.listen()
         except Exception as e:
             logger.critical(
                 "Unexpected error in update listener: %s", str(e), exc_info=True
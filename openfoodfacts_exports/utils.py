@@ -1,6 +1,16 @@
+import collections
+import gzip
+import hashlib
 import logging
+import multiprocessing
+import resource
+import threading
 import time
+from multiprocessing.pool import AsyncResult
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, TypeVar
 
+import pyarrow.parquet as pq
 import sentry_sdk
 import toml
 from minio import Minio
@@ -12,6 +22,8 @@ from openfoodfacts_exports import settings
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def init_sentry(integrations: list[Integration] | None = None):
     if settings.SENTRY_DSN:
@@ -37,9 +49,74 @@ def get_package_version() -> str:
     return toml.load(str(settings.PROJECT_DIR / "pyproject.toml"))["project"]["version"]
 
 
+def open_dataset(dataset_path: Path) -> BinaryIO:
+    """Open a JSONL (plain or gzipped) dataset in binary mode."""
+    if dataset_path.suffix == ".gz":
+        return gzip.open(dataset_path, "rb")  # type: ignore[return-value]
+    return dataset_path.open("rb")
+
+
 def get_minio_client() -> Minio:
     """Return a Minio client with AWS credentials from environment."""
-    return Minio("s3.amazonaws.com", credentials=EnvAWSProvider())
+    return Minio(
+        settings.AWS_S3_ENDPOINT,
+        credentials=EnvAWSProvider(),
+        secure=settings.AWS_S3_SECURE,
+    )
+
+
+def get_file_sha256(path: Path) -> str:
+    """Return the SHA-256 of a file (hex digest), read by chunks of 1 MiB."""
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_parquet_columns_sha256(path: Path, columns: list[str]) -> str:
+    """Return the SHA-256 of the column chunks of some columns of a Parquet
+    file.
+
+    Only the column chunks are read (not decoded), in row group order. The
+    checksum only changes if the values of the columns (or the row group
+    boundaries) change.
+
+    Args:
+        path: The path of the Parquet file.
+        columns: The names of the (top-level) columns, nested columns
+            include all their leaf columns.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            sha256.update(str(row_group.num_rows).encode("utf-8"))
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                if column.path_in_schema.split(".")[0] not in columns:
+                    continue
+                start = column.data_page_offset
+                if column.has_dictionary_page and column.dictionary_page_offset:
+                    start = min(start, column.dictionary_page_offset)
+                f.seek(start)
+                sha256.update(column.path_in_schema.encode("utf-8"))
+                sha256.update(f.read(column.total_compressed_size))
+    return sha256.hexdigest()
+
+
+def get_peak_rss_mb() -> float:
+    """Return the peak resident set size of the process (or of its largest
+    terminated child), in MB."""
+    # ru_maxrss is in KB on Linux
+    return (
+        max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+        / 1024
+    )
 
 
 def timer(func):
@@ -51,3 +128,63 @@ def timer(func):
         return output
 
     return wrapper
+
+
+class RateLimiter:
+    """Thread-safe rate limiter, allowing at most `rate` calls to `wait` per
+    second."""
+
+    def __init__(self, rate: float):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.interval = 1.0 / rate
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until the next call is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_time - now
+            self._next_time = max(self._next_time, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def imap_ordered(
+    func: Callable[..., T],
+    tasks: Iterable[tuple],
+    num_processes: int,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple[Any, ...] = (),
+) -> Iterator[T]:
+    """Call `func(*args)` for each `args` of `tasks` in a process pool, and
+    yield the results in the order of `tasks`.
+
+    Unlike `Pool.imap`, that submits the tasks as fast as it can read them,
+    at most `2 * num_processes` results are pending, so that the memory usage
+    does not depend on the number of tasks. The caller (ex: the writer of the
+    output file) consumes the results in a single thread.
+
+    The pool is started with forkserver, as the current process may be
+    multi-threaded, and is terminated when the iterator is closed.
+
+    Args:
+        func: The function called in the worker processes.
+        tasks: The arguments of the calls.
+        num_processes: The number of worker processes.
+        initializer: If provided, called with `initargs` in each worker
+            process when it starts.
+        initargs: The arguments of `initializer`.
+    """
+    with multiprocessing.get_context("forkserver").Pool(
+        num_processes, initializer=initializer, initargs=initargs
+    ) as pool:
+        pending: collections.deque[AsyncResult[T]] = collections.deque()
+        max_pending = num_processes * 2
+        for args in tasks:
+            pending.append(pool.apply_async(func, args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,310 @@
+"""Memory-aware admission control of export jobs.
+
+Several workers can start large exports at the same time (ex: the nightly
+off and obf Parquet conversions and the price export), and together exceed
+the memory available. To prevent this:
+
+- export jobs are enqueued with `enqueue_with_budget`, that attaches an
+  estimated memory/CPU budget to the job meta. The budget is derived from the
+  size of the input files and from the resource usage of the past runs of the
+  same function (stored in Redis by the workers).
+- before starting a job with a budget, workers reserve it on a semaphore
+  shared through Redis. If the budget does not fit in the remaining capacity,
+  the job is scheduled again later, with exponential backoff.
+
+A job is always admitted if no other job holds a reservation, so that a job
+whose budget exceeds the capacity can still run (alone). Reservations expire
+after the job timeout, in case a worker dies without releasing them.
+"""
+
+import datetime
+import logging
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from pydantic import BaseModel
+from redis import Redis
+from redis.exceptions import WatchError
+from rq.job import Job
+from rq.queue import Queue
+
+from openfoodfacts_exports import settings
+
+logger = logging.getLogger(__name__)
+
+RESERVATIONS_KEY = "openfoodfacts_exports:admission:reservations"
+JOB_RUNS_KEY_PREFIX = "openfoodfacts_exports:admission:job_runs:"
+# Number of past runs kept per job function
+MAX_RECORDED_RUNS = 10
+# Safety margin applied to the memory used by past runs
+BUDGET_MARGIN = 1.2
+# Delay before the first retry of a job that was not admitted, doubled at
+# every attempt
+RETRY_BASE_DELAY = 30.0
+RETRY_MAX_DELAY = 15 * 60.0
+
+
+class JobBudget(BaseModel):
+    """Estimated resource usage of a job."""
+
+    memory_mb: int
+    cpus: float = 1.0
+
+
+class JobRun(BaseModel):
+    """Resource usage of a past run of a job."""
+
+    input_size: int
+    peak_rss_mb: float
+    cpu_time: float
+    wall_time: float
+
+
+class Reservation(BaseModel):
+    budget: JobBudget
+    expires_at: float
+
+
+def get_job_runs(connection: Redis, func_name: str) -> list[JobRun]:
+    """Return the recorded runs of a job function, most recent first."""
+    return [
+        JobRun.model_validate_json(item)
+        for item in connection.lrange(
+            f"{JOB_RUNS_KEY_PREFIX}{func_name}", 0, MAX_RECORDED_RUNS - 1
+        )  # type: ignore
+    ]
+
+
+def record_job_run(connection: Redis, func_name: str, run: JobRun) -> None:
+    """Record the resource usage of a job run, to estimate the budget of the
+    next runs."""
+    key = f"{JOB_RUNS_KEY_PREFIX}{func_name}"
+    with connection.pipeline() as pipeline:
+        pipeline.lpush(key, run.model_dump_json())
+        pipeline.ltrim(key, 0, MAX_RECORDED_RUNS - 1)
+        pipeline.execute()
+
+
+def estimate_budget(
+    connection: Redis,
+    func_name: str,
+    input_size: int,
+    default_memory_mb: int = settings.CPU_JOB_MEMORY_MB,
+) -> JobBudget:
+    """Estimate the budget of a job.
+
+    The memory budget is the largest peak RSS of the past runs, scaled by
+    the ratio of input sizes, with a safety margin. The CPU budget is the
+    largest average number of cores used by the past runs. Without past
+    runs, `default_memory_mb` and 1 CPU are used.
+
+    Args:
+        connection: The Redis connection.
+        func_name: The name of the job function.
+        input_size: The total size of the input files of the job, in bytes.
+        default_memory_mb: The memory budget used without past runs.
+    """
+    runs = get_job_runs(connection, func_name)
+    if not runs:
+        return JobBudget(memory_mb=default_memory_mb, cpus=1.0)
+    memory_mb = BUDGET_MARGIN * max(
+        run.peak_rss_mb
+        * (input_size / run.input_size if input_size and run.input_size else 1.0)
+        for run in runs
+    )
+    cpus = max(
+        (run.cpu_time / run.wall_time for run in runs if run.wall_time > 0),
+        default=1.0,
+    )
+    return JobBudget(
+        memory_mb=max(1, round(memory_mb)),
+        cpus=round(max(cpus, 0.1), 1),
+    )
+
+
+def enqueue_with_budget(
+    queue: Queue,
+    func: Callable,
+    *args: Any,
+    input_paths: list[Path],
+    **kwargs: Any,
+) -> Job:
+    """Enqueue a job with an estimated budget, see `estimate_budget`.
+
+    Args:
+        queue: The queue.
+        func: The job function.
+        input_paths: The input files of the job, used to estimate its
+            budget (missing files are ignored).
+        *args, **kwargs: The arguments passed to `queue.enqueue`.
+    """
+    input_size = sum(path.stat().st_size for path in input_paths if path.is_file())
+    budget = estimate_budget(
+        queue.connection, f"{func.__module__}.{func.__qualname__}", input_size
+    )
+    meta = kwargs.pop("meta", None) or {}
+    meta.update({"budget": budget.model_dump(), "input_size": input_size})
+    logger.info(
+        "Enqueuing %s with a budget of %d MB and %.1f CPUs",
+        func.__qualname__,
+        budget.memory_mb,
+        budget.cpus,
+    )
+    return queue.enqueue(func, *args, meta=meta, **kwargs)
+
+
+def _parse_reservations(items: Any) -> dict[str, Reservation]:
+    reservations = {}
+    for key, item in items.items():
+        job_id = key.decode() if isinstance(key, bytes) else key
+        reservations[job_id] = Reservation.model_validate_json(item)
+    return reservations
+
+
+class ResourceSemaphore:
+    """Counting semaphore on memory and CPUs, shared through Redis."""
+
+    def __init__(
+        self,
+        connection: Redis,
+        memory_mb: int = settings.ADMISSION_MEMORY_MB,
+        cpus: float = settings.ADMISSION_CPUS,
+        key: str = RESERVATIONS_KEY,
+    ):
+        self.connection = connection
+        self.memory_mb = memory_mb
+        self.cpus = cpus
+        self.key = key
+
+    def get_reservations(self) -> dict[str, Reservation]:
+        """Return the active reservations, by job ID."""
+        now = time.time()
+        reservations = _parse_reservations(self.connection.hgetall(self.key))
+        return {
+            job_id: reservation
+            for job_id, reservation in reservations.items()
+            if reservation.expires_at > now
+        }
+
+    def get_usage(self) -> JobBudget:
+        """Return the resources reserved by the active reservations."""
+        reservations = self.get_reservations().values()
+        return JobBudget(
+            memory_mb=sum(r.budget.memory_mb for r in reservations),
+            cpus=sum(r.budget.cpus for r in reservations),
+        )
+
+    def try_acquire(self, job_id: str, budget: JobBudget, ttl: float) -> bool:
+        """Reserve a budget for a job if it fits in the remaining capacity
+        (or if no other job holds a reservation).
+
+        Args:
+            job_id: The ID of the job.
+            budget: The budget to reserve.
+            ttl: The number of seconds after which the reservation expires.
+
+        Returns:
+            True if the budget was reserved, False otherwise.
+        """
+        with self.connection.pipeline() as pipeline:
+            while True:
+                try:
+                    pipeline.watch(self.key)
+                    now = time.time()
+                    reservations = _parse_reservations(pipeline.hgetall(self.key))
+                    # Expired reservations, and a previous reservation of the
+                    # same job, are removed
+                    stale = [
+                        key
+                        for key, reservation in reservations.items()
+                        if reservation.expires_at <= now or key == job_id
+                    ]
+                    active = [
+                        reservation
+                        for key, reservation in reservations.items()
+                        if key not in stale
+                    ]
+                    fits = not active or (
+                        sum(r.budget.memory_mb for r in active) + budget.memory_mb
+                        <= self.memory_mb
+                        and sum(r.budget.cpus for r in active) + budget.cpus
+                        <= self.cpus
+                    )
+                    pipeline.multi()
+                    if stale:
+                        pipeline.hdel(self.key, *stale)
+                    if fits:
+                        pipeline.hset(
+                            self.key,
+                            job_id,
+                            Reservation(
+                                budget=budget, expires_at=now + ttl
+                            ).model_dump_json(),
+                        )
+                    pipeline.execute()
+                    return fits
+                except WatchError:
+                    # Another worker updated the reservations, retry
+                    continue
+
+    def release(self, job_id: str) -> None:
+        self.connection.hdel(self.key, job_id)
+
+
+def get_job_budget(job: Job) -> JobBudget | None:
+    """Return the budget attached to a job by `enqueue_with_budget`, if
+    any."""
+    budget = job.meta.get("budget")
+    return None if budget is None else JobBudget.model_validate(budget)
+
+
+class AdmissionController:
+    """Worker-side admission control of the jobs with a budget."""
+
+    def __init__(self, semaphore: ResourceSemaphore):
+        self.semaphore = semaphore
+
+    def admit(self, job: Job, queue: Queue) -> bool:
+        """Reserve the budget of a dequeued job.
+
+        If the budget does not fit, the job is scheduled again with
+        exponential backoff: the worker must not execute it.
+
+        Returns:
+            True if the job can be executed.
+        """
+        budget = get_job_budget(job)
+        if budget is None:
+            return True
+        ttl = (job.timeout or queue.DEFAULT_TIMEOUT) + 60
+        if self.semaphore.try_acquire(job.id, budget, ttl):
+            return True
+
+        attempts = job.meta.get("admission_attempts", 0)
+        delay = min(RETRY_BASE_DELAY * 2**attempts, RETRY_MAX_DELAY)
+        job.meta["admission_attempts"] = attempts + 1
+        logger.info(
+            "Not enough resources to start job %s (%d MB, %.1f CPUs), "
+            "retrying in %.0fs",
+            job.id,
+            budget.memory_mb,
+            budget.cpus,
+            delay,
+        )
+        with self.semaphore.connection.pipeline() as pipeline:
+            # The job was moved to the intermediate queue by the dequeue
+            pipeline.lrem(queue.intermediate_queue_key, 1, job.id)
+            queue.schedule_job(
+                job,
+                datetime.datetime.now(datetime.timezone.utc)
+                + datetime.timedelta(seconds=delay),
+                pipeline=pipeline,
+            )
+            pipeline.execute()
+        return False
+
+    def release(self, job: Job) -> None:
+        """Release the budget of a finished job."""
+        if get_job_budget(job) is not None:
+            self.semaphore.release(job.id)
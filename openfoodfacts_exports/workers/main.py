@@ -1,14 +1,14 @@
 import sys
 
-from rq import Worker
-
+from .pool import AdmissionControlledWorker
 from .redis import redis_conn
 
 
 def run(queues: list[str], burst: bool = False):
     try:
-        w = Worker(queues=queues, connection=redis_conn)
-        w.work(logging_level="INFO", burst=burst)
+        w = AdmissionControlledWorker(queues=queues, connection=redis_conn)
+        # The scheduler requeues the jobs deferred by admission control
+        w.work(logging_level="INFO", burst=burst, with_scheduler=True)
     except ConnectionError as e:
         print(e)
         sys.exit(1)
@@ -0,0 +1,281 @@
+"""Worker mode with separate pools for CPU-heavy and light jobs.
+
+A plain rq worker runs one job at a time, so a CPU-bound export blocks the
+worker for hours while light jobs (downloads, uploads, job scheduling) queue
+behind it. In pool mode, jobs are split by class:
+
+- CPU-heavy jobs (enqueued in `cpu_queue`) run in a pool of forking workers,
+  sized by the number of available cores and the memory budget of a job.
+- Light jobs (enqueued in `high_queue` and `low_queue`) run in a separate
+  process, in a pool of threads.
+
+Every worker records the CPU time (`cpu_time`, in seconds) and the peak RSS
+(`peak_rss_mb`) of each job in the job meta.
+"""
+
+import logging
+import os
+import resource
+import signal
+import threading
+from multiprocessing import get_context
+from pathlib import Path
+
+from redis import Redis
+from rq import SimpleWorker, Worker
+from rq.job import Job
+from rq.queue import Queue
+from rq.timeouts import TimerDeathPenalty
+from rq.worker_pool import WorkerPool
+
+from openfoodfacts_exports import settings
+from openfoodfacts_exports.utils import get_peak_rss_mb
+from openfoodfacts_exports.workers.admission import (
+    AdmissionController,
+    JobRun,
+    ResourceSemaphore,
+    record_job_run,
+)
+from openfoodfacts_exports.workers.queues import cpu_queue, high_queue, low_queue
+from openfoodfacts_exports.workers.redis import redis_conn
+
+logger = logging.getLogger(__name__)
+
+CPU_JOB_QUEUES = [cpu_queue.name]
+LIGHT_JOB_QUEUES = [high_queue.name, low_queue.name]
+
+
+def get_cpu_time(thread: bool = False) -> float:
+    """Return the CPU time (user + system) used so far, in seconds.
+
+    Args:
+        thread: If True, only count the CPU time of the current thread,
+            otherwise count the CPU time of the process and of its
+            terminated children.
+    """
+    if thread:
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+def save_job_resources(job: Job, cpu_time: float) -> None:
+    """Save the CPU time and the peak RSS of a job in its meta.
+
+    For jobs enqueued with a budget (see `workers/admission.py`), the run is
+    also recorded to estimate the budget of the next runs.
+    """
+    try:
+        # The job may have updated its meta itself
+        meta = job.get_meta(refresh=True)
+        meta["cpu_time"] = round(cpu_time, 3)
+        meta["peak_rss_mb"] = round(get_peak_rss_mb(), 1)
+        job.save_meta()
+        if "input_size" in meta and job.func_name and job.started_at and job.ended_at:
+            record_job_run(
+                job.connection,
+                job.func_name,
+                JobRun(
+                    input_size=meta["input_size"],
+                    peak_rss_mb=meta["peak_rss_mb"],
+                    cpu_time=meta["cpu_time"],
+                    wall_time=(job.ended_at - job.started_at).total_seconds(),
+                ),
+            )
+    except Exception as e:
+        logger.warning("Failed to save the resource usage of job %s: %s", job.id, e)
+
+
+def get_available_memory_mb() -> int:
+    """Return the memory available to the container (cgroup limit), or the
+    physical memory of the host if there is no limit, in MB."""
+    for limit_path in (
+        # cgroup v2
+        Path("/sys/fs/cgroup/memory.max"),
+        # cgroup v1
+        Path("/sys/fs/cgroup/memory/memory.limit_in_bytes"),
+    ):
+        try:
+            limit = limit_path.read_text().strip()
+        except OSError:
+            continue
+        # Without limit, cgroup v1 reports a huge number
+        if limit.isdigit() and int(limit) < 2**60:
+            return int(limit) // (1024 * 1024)
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+
+
+def get_cpu_pool_size(memory_per_job_mb: int = settings.CPU_JOB_MEMORY_MB) -> int:
+    """Return the number of CPU-heavy jobs that can run concurrently, given
+    the available cores and memory.
+
+    Args:
+        memory_per_job_mb: The memory budget of a CPU-heavy job, in MB.
+    """
+    num_cpus = len(os.sched_getaffinity(0))
+    return max(1, min(num_cpus, get_available_memory_mb() // memory_per_job_mb))
+
+
+class ResourceTrackingWorker(Worker):
+    """Forking worker recording the resource usage of jobs in their meta."""
+
+    def perform_job(self, job: Job, queue: Queue) -> bool:
+        # Called in the work horse, forked for this job
+        self._job_start_cpu_time = get_cpu_time()
+        return super().perform_job(job, queue)
+
+    def handle_execution_ended(self, job: Job, queue: Queue, heartbeat_ttl: int):
+        super().handle_execution_ended(job, queue, heartbeat_ttl)
+        # Saved before the job is finalized, as the job is deleted on
+        # success if its result TTL is 0
+        save_job_resources(job, get_cpu_time() - self._job_start_cpu_time)
+
+
+class AdmissionMixin:
+    """Mixin for rq workers, starting jobs with a budget only if it fits in
+    the shared capacity, see `workers/admission.py`.
+
+    Jobs that are not admitted are scheduled again: the worker must run
+    with the scheduler (`with_scheduler=True`).
+    """
+
+    connection: Redis
+
+    def get_semaphore(self) -> ResourceSemaphore:
+        """Return the semaphore of the shared capacity."""
+        return ResourceSemaphore(self.connection)
+
+    @property
+    def admission(self) -> AdmissionController:
+        if getattr(self, "_admission", None) is None:
+            self._admission = AdmissionController(self.get_semaphore())
+        return self._admission
+
+    def execute_job(self, job: Job, queue: Queue):
+        if not self.admission.admit(job, queue):
+            return
+        try:
+            super().execute_job(job, queue)  # type: ignore[misc]
+        finally:
+            self.admission.release(job)
+
+
+class AdmissionControlledWorker(AdmissionMixin, ResourceTrackingWorker):
+    """Forking worker with admission control, see `AdmissionMixin`."""
+
+
+class ThreadWorker(SimpleWorker):
+    """Worker running jobs in its own thread, several of them running in
+    the same process.
+
+    Signals can only be handled by the main thread: workers are stopped by
+    setting `_stop_requested`, and job timeouts use a timer thread. The peak
+    RSS recorded for a job is the one of the whole process.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    @property
+    def dequeue_timeout(self) -> int:
+        # Poll regularly, so that stop requests are noticed
+        return 5
+
+    def _install_signal_handlers(self):
+        pass
+
+    def perform_job(self, job: Job, queue: Queue) -> bool:
+        self._job_start_cpu_time = get_cpu_time(thread=True)
+        return super().perform_job(job, queue)
+
+    def handle_execution_ended(self, job: Job, queue: Queue, heartbeat_ttl: int):
+        super().handle_execution_ended(job, queue, heartbeat_ttl)
+        save_job_resources(job, get_cpu_time(thread=True) - self._job_start_cpu_time)
+
+
+def run_thread_workers(
+    queue_names: list[str],
+    num_threads: int = settings.LIGHT_JOB_THREADS,
+    burst: bool = False,
+    connection: Redis = redis_conn,
+) -> None:
+    """Run `num_threads` thread workers on the given queues, until SIGTERM
+    or SIGINT is received (or until the queues are empty in burst mode)."""
+    workers = [
+        ThreadWorker(queues=queue_names, connection=connection)
+        for _ in range(num_threads)
+    ]
+
+    def request_stop(signum, frame):
+        logger.info("Stopping thread workers after their current job...")
+        for worker in workers:
+            worker._stop_requested = True
+
+    previous_handlers = {}
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, request_stop)
+
+    threads = [
+        threading.Thread(
+            target=worker.work,
+            kwargs={"burst": burst, "logging_level": "INFO"},
+            name=f"rq-thread-worker-{i}",
+        )
+        for i, worker in enumerate(workers)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+
+def run_pool(
+    num_cpu_workers: int | None = None,
+    num_threads: int = settings.LIGHT_JOB_THREADS,
+    burst: bool = False,
+) -> None:
+    """Run the CPU-heavy job pool, and the light job threads in a child
+    process.
+
+    Args:
+        num_cpu_workers: The number of CPU-heavy jobs run concurrently,
+            defaults to the value given by `get_cpu_pool_size`.
+        num_threads: The number of light jobs run concurrently.
+        burst: If True, stop once the queues are empty.
+    """
+    if num_cpu_workers is None:
+        num_cpu_workers = get_cpu_pool_size()
+    logger.info(
+        "Starting worker pool: %d CPU-heavy job workers, %d light job threads",
+        num_cpu_workers,
+        num_threads,
+    )
+    # Started before the pool, while this process has no other thread
+    light_job_process = get_context("fork").Process(
+        target=run_thread_workers,
+        args=(LIGHT_JOB_QUEUES, num_threads, burst),
+        name="rq-light-jobs",
+    )
+    light_job_process.start()
+    try:
+        pool = WorkerPool(
+            CPU_JOB_QUEUES,
+            connection=redis_conn,
+            num_workers=num_cpu_workers,
+            worker_class=AdmissionControlledWorker,
+        )
+        pool.start(burst=burst, logging_level="INFO")
+    finally:
+        if not burst and light_job_process.is_alive():
+            light_job_process.terminate()
+        light_job_process.join()
@@ -9,3 +9,6 @@ logger = logging.getLogger(__name__)
 
 high_queue = Queue("off-exports-high", connection=redis_conn)
 low_queue = Queue("off-exports-low", connection=redis_conn)
+# CPU-heavy jobs (Parquet exports, mobile dump generation), run by a dedicated
+# pool of workers in pool mode (see `workers/pool.py`)
+cpu_queue = Queue("off-exports-cpu", connection=redis_conn)
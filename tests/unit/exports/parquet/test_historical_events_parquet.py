@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import pyarrow.parquet as pq
+
+from openfoodfacts_exports.exports.parquet.historical_events import (
+    HISTORICAL_EVENT_SCHEMA,
+    write_events_parquet,
+)
+
+
+def make_event(rev_id: int, timestamp: int, previous, current) -> dict:
+    return {
+        "id": f"123_{rev_id}",
+        "code": "123",
+        "rev_id": rev_id,
+        "timestamp": timestamp,
+        "product_type": "food",
+        "comment": None,
+        "field": "brands",
+        "previous": previous,
+        "current": current,
+        "action": "change",
+    }
+
+
+def test_write_events_parquet(tmp_path: Path):
+    events = [
+        # 2024-01-31 and 2024-02-01
+        make_event(1, 1706659200, None, "Nestlé"),
+        make_event(2, 1706745600, 1.5, 2),
+        make_event(3, 1706745601, True, ["a", "b"]),
+    ]
+
+    row_counts = write_events_parquet(events, tmp_path, batch_size=1)
+
+    assert row_counts == {"2024-01": 1, "2024-02": 2}
+    table = pq.read_table(tmp_path / "month=2024-02" / "events.parquet")
+    assert table.schema == HISTORICAL_EVENT_SCHEMA
+    rows = table.to_pylist()
+    assert [row["rev_id"] for row in rows] == [2, 3]
+    assert rows[0]["timestamp"].timestamp() == 1706745600
+    assert (rows[0]["previous"], rows[0]["previous_num"], rows[0]["previous_str"]) == (
+        "1.5",
+        1.5,
+        None,
+    )
+    assert (rows[0]["current"], rows[0]["current_num"]) == ("2", 2.0)
+    # Booleans and lists are only stored as JSON
+    assert (rows[1]["previous"], rows[1]["previous_num"]) == ("true", None)
+    assert (rows[1]["current"], rows[1]["current_str"]) == ('["a","b"]', None)
+
+    row = pq.read_table(tmp_path / "month=2024-01" / "events.parquet").to_pylist()[0]
+    assert (row["previous"], row["previous_str"]) == (None, None)
+    assert (row["current"], row["current_str"]) == ('"Nestlé"', "Nestlé")
+    assert (row["field"], row["action"], row["product_type"]) == (
+        "brands",
+        "change",
+        "food",
+    )
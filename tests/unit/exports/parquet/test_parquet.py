@@ -1,5 +1,8 @@
+import gzip
 from pathlib import Path
 
+import orjson
+import pyarrow.parquet as pq
 import pytest
 
 from openfoodfacts_exports.exports.parquet import convert_jsonl_to_parquet
@@ -23,6 +26,69 @@ class TestConvertJSONLToParquet:
                 dtype_map=BEAUTY_DTYPE_MAP,
             )
 
+    def test_convert_jsonl_to_parquet_resume_after_kill(self, tmp_path: Path):
+        dataset_path = tmp_path / "products.jsonl.gz"
+        with gzip.open(dataset_path, "wb") as f:
+            for i in range(100):
+                item = {"code": str(i), "product_name": f"Product {i}", "lang": "fr"}
+                f.write(orjson.dumps(item) + b"\n")
+
+        class Killed(BaseException):
+            pass
+
+        parsed_codes = []
+        kill_codes = {"70"}
+
+        class KilledBeautyProduct(BeautyProduct):
+            def __init__(self, **data):
+                if data["code"] in kill_codes:
+                    raise Killed()
+                parsed_codes.append(data["code"])
+                super().__init__(**data)
+
+        kwargs = dict(
+            dataset_path=dataset_path,
+            schema=BEAUTY_PRODUCT_SCHEMA,
+            dtype_map=BEAUTY_DTYPE_MAP,
+            batch_size=8,
+        )
+        reference_path = tmp_path / "reference.parquet"
+        convert_jsonl_to_parquet(
+            output_file_path=reference_path, pydantic_cls=BeautyProduct, **kwargs
+        )
+
+        checkpoint_dir = tmp_path / "checkpoint"
+        output_path = tmp_path / "output.parquet"
+        with pytest.raises(Killed):
+            convert_jsonl_to_parquet(
+                output_file_path=output_path,
+                pydantic_cls=KilledBeautyProduct,
+                checkpoint_dir=checkpoint_dir,
+                checkpoint_interval=3,
+                **kwargs,
+            )
+        assert not output_path.exists()
+        # 2 parts of 3 batches of 8 items were completed, the third part is
+        # incomplete
+        assert len(list(checkpoint_dir.glob("part-*.parquet"))) == 3
+
+        parsed_codes.clear()
+        kill_codes.clear()
+        row_counts = convert_jsonl_to_parquet(
+            output_file_path=output_path,
+            pydantic_cls=KilledBeautyProduct,
+            checkpoint_dir=checkpoint_dir,
+            checkpoint_interval=3,
+            **kwargs,
+        )
+        # The conversion resumed after the last checkpoint
+        assert parsed_codes[0] == "48"
+        assert not checkpoint_dir.exists()
+        assert output_path.read_bytes() == reference_path.read_bytes()
+        assert pq.ParquetFile(output_path).num_row_groups == 13
+        # The counts include the rows converted before the kill
+        assert (row_counts.rows_in, row_counts.rows_out) == (100, 100)
+
 
 PARSED_IMAGES_WITH_LEGACY_SCHEMA = [
     {
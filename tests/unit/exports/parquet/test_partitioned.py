@@ -0,0 +1,125 @@
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from openfoodfacts_exports.exports.parquet import partitioned
+from openfoodfacts_exports.exports.parquet.partitioned import (
+    MANIFEST_FILE_NAME,
+    load_manifest,
+    push_partitioned_dataset_to_hf,
+    read_partitioned_dataset,
+    write_partitioned_dataset,
+)
+
+LANGS = ["en", "fr", None, "de", ""]
+
+
+def write_products(path: Path, codes: list[str]) -> None:
+    table = pa.table(
+        {
+            "code": codes,
+            "lang": [LANGS[int(code) % len(LANGS)] for code in codes],
+            "product_name": [f"Product {code}" for code in codes],
+        }
+    )
+    pq.write_table(table, path, row_group_size=100)
+
+
+def test_write_partitioned_dataset(tmp_path: Path):
+    codes = [str(i) for i in range(1000)]
+    write_products(tmp_path / "food.parquet", codes)
+    manifest = write_partitioned_dataset(
+        tmp_path / "food.parquet", tmp_path / "food", row_group_size=64
+    )
+
+    assert manifest.row_count == 1000
+    # Products with an empty lang are in the partition without lang
+    assert [(file.lang, file.row_count) for file in manifest.files] == [
+        (None, 400),
+        ("de", 200),
+        ("en", 200),
+        ("fr", 200),
+    ]
+    assert manifest.files[0].path == "lang=__HIVE_DEFAULT_PARTITION__/products.parquet"
+    assert load_manifest(tmp_path / "food") == manifest
+    assert not (tmp_path / "food.tmp").exists()
+    for file in manifest.files:
+        parquet_file = pq.ParquetFile(tmp_path / "food" / file.path)
+        # The partition key is only in the directory names
+        assert parquet_file.schema_arrow.names == ["code", "product_name"]
+        assert parquet_file.metadata.row_group(0).num_rows == 64
+
+    # All the products are read, in the order of the input in each partition
+    table = read_partitioned_dataset(tmp_path / "food")
+    assert sorted(table["code"].to_pylist(), key=int) == codes
+    assert table.column_names == ["code", "product_name", "lang"]
+
+    table = read_partitioned_dataset(
+        tmp_path / "food",
+        langs=["fr"],
+        columns=["code", "lang"],
+        filter=pc.field("code").isin(["1", "12", "13"]),
+    )
+    assert table.to_pylist() == [{"code": "1", "lang": "fr"}]
+    table = read_partitioned_dataset(tmp_path / "food", langs=[None])
+    assert set(table["lang"].to_pylist()) == {None}
+    assert read_partitioned_dataset(tmp_path / "food", langs=[]).num_rows == 0
+
+
+def test_unchanged_partitions_are_identical(tmp_path: Path):
+    codes = [str(i) for i in range(3000)]
+    write_products(tmp_path / "food.parquet", codes)
+    old_manifest = write_partitioned_dataset(
+        tmp_path / "food.parquet", tmp_path / "food", row_group_size=64
+    )
+    # A new French product is added, in the middle of the input
+    write_products(tmp_path / "food.parquet", codes[:1500] + ["3001"] + codes[1500:])
+    new_manifest = write_partitioned_dataset(
+        tmp_path / "food.parquet", tmp_path / "food", row_group_size=64
+    )
+
+    assert [
+        new.lang
+        for old, new in zip(old_manifest.files, new_manifest.files)
+        if old.sha256 != new.sha256
+    ] == ["fr"]
+
+
+def test_push_partitioned_dataset_to_hf(tmp_path: Path, mocker):
+    codes = [str(i) for i in range(1000)]
+    write_products(tmp_path / "food.parquet", codes)
+    write_partitioned_dataset(tmp_path / "food.parquet", tmp_path / "food")
+    remote_manifest_path = tmp_path / "remote_manifest.json"
+    remote_manifest = load_manifest(tmp_path / "food")
+    remote_manifest.files[1].sha256 = "0" * 64
+    remote_manifest.files[2].path = "lang=it/products.parquet"
+    remote_manifest_path.write_text(remote_manifest.model_dump_json())
+    hf_api = mocker.patch.object(partitioned, "HfApi").return_value
+    hf_api.hf_hub_download.return_value = str(remote_manifest_path)
+
+    push_partitioned_dataset_to_hf(tmp_path / "food", "org/repo", "food")
+
+    hf_api.hf_hub_download.assert_called_once_with(
+        repo_id="org/repo",
+        filename=f"food/{MANIFEST_FILE_NAME}",
+        repo_type="dataset",
+        revision="main",
+    )
+    hf_api.create_commit.assert_called_once()
+    operations = hf_api.create_commit.call_args.kwargs["operations"]
+    assert [
+        (type(operation).__name__, operation.path_in_repo) for operation in operations
+    ] == [
+        ("CommitOperationAdd", "food/lang=de/products.parquet"),
+        ("CommitOperationAdd", "food/lang=en/products.parquet"),
+        ("CommitOperationDelete", "food/lang=it/products.parquet"),
+        ("CommitOperationAdd", f"food/{MANIFEST_FILE_NAME}"),
+    ]
+
+    # Nothing is pushed if no partition changed
+    hf_api.reset_mock()
+    remote_manifest_path.write_text(load_manifest(tmp_path / "food").model_dump_json())
+    push_partitioned_dataset_to_hf(tmp_path / "food", "org/repo", "food")
+    hf_api.create_commit.assert_not_called()
@@ -0,0 +1,158 @@
+import gzip
+import random
+from pathlib import Path
+
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from openfoodfacts_exports.exports.parquet.price import (
+    LOCATION_KEYS,
+    LocationModel,
+    LookupTable,
+    convert_jsonl_to_parquet,
+    convert_jsonl_to_parquet_parallel,
+    write_lookup_table,
+)
+
+
+def write_jsonl(path: Path, items: list[dict]) -> None:
+    with gzip.open(path, "wb") as f:
+        for item in items:
+            f.write(orjson.dumps(item) + b"\n")
+
+
+def write_price_dataset(tmp_path: Path, num_prices: int) -> dict[str, Path]:
+    rng = random.Random(0)
+    # IDs have gaps, as some proofs and locations were deleted
+    proofs = [
+        {
+            "id": proof_id,
+            "type": "RECEIPT",
+            "file_path": f"0001/{proof_id}.webp",
+            "date": "2024-11-02",
+            "receipt_price_total": "12.345",
+            "owner": f"user{proof_id % 7}",
+            "created": "2024-11-02T10:00:00+00:00",
+        }
+        for proof_id in range(1, 60)
+        if proof_id % 5
+    ]
+    locations = [
+        {
+            "id": location_id,
+            "type": "OSM",
+            "osm_id": 1000 + location_id,
+            "osm_address_city": f"City {location_id}",
+            "osm_lat": 45.5 + location_id,
+        }
+        for location_id in range(1, 30)
+        if location_id % 4
+    ]
+    prices = [
+        {
+            "id": price_id,
+            "type": "PRODUCT",
+            "product_code": str(3000000000000 + price_id),
+            "labels_tags": ["en:organic"] if price_id % 3 else None,
+            "price": f"{rng.randint(1, 9999) / 100}",
+            "currency": "EUR",
+            "date": "2024-11-02",
+            "proof_id": rng.choice(proofs)["id"] if price_id % 10 else None,
+            "location_id": rng.choice(locations)["id"] if price_id % 9 else None,
+            "owner": f"user{price_id % 13}",
+            "created": "2024-11-02T10:00:00+00:00",
+        }
+        for price_id in range(1, num_prices + 1)
+    ]
+    paths = {
+        "price": tmp_path / "prices.jsonl.gz",
+        "proof": tmp_path / "proofs.jsonl.gz",
+        "location": tmp_path / "locations.jsonl.gz",
+    }
+    write_jsonl(paths["price"], prices)
+    write_jsonl(paths["proof"], proofs)
+    write_jsonl(paths["location"], locations)
+    return paths
+
+
+def test_convert_jsonl_to_parquet_parallel(tmp_path: Path):
+    paths = write_price_dataset(tmp_path, 1000)
+    convert_jsonl_to_parquet(
+        output_file_path=tmp_path / "reference.parquet",
+        dataset_price_path=paths["price"],
+        dataset_proof_path=paths["proof"],
+        dataset_location_path=paths["location"],
+        batch_size=64,
+    )
+    row_counts = convert_jsonl_to_parquet_parallel(
+        output_file_path=tmp_path / "prices.parquet",
+        dataset_price_path=paths["price"],
+        dataset_proof_path=paths["proof"],
+        dataset_location_path=paths["location"],
+        batch_size=64,
+        num_processes=2,
+        batches_per_shard=3,
+    )
+
+    assert (row_counts.rows_in, row_counts.rows_out) == (1000, 1000)
+    reference = pq.ParquetFile(tmp_path / "reference.parquet")
+    output = pq.ParquetFile(tmp_path / "prices.parquet")
+    assert output.schema_arrow == reference.schema_arrow
+    assert output.read().equals(reference.read())
+    assert output.metadata.num_row_groups == reference.metadata.num_row_groups
+    for row in output.read(columns=["proof_id", "proof_file_path"]).to_pylist():
+        assert row["proof_file_path"] == (
+            None if row["proof_id"] is None else f"0001/{row['proof_id']}.webp"
+        )
+
+
+def test_convert_jsonl_to_parquet_parallel_missing_proof(tmp_path: Path):
+    paths = write_price_dataset(tmp_path, 10)
+    write_jsonl(
+        paths["price"],
+        [{"id": 1, "type": "PRODUCT", "proof_id": 5}],
+    )
+    with pytest.raises(KeyError):
+        convert_jsonl_to_parquet(
+            output_file_path=tmp_path / "prices.parquet",
+            dataset_price_path=paths["price"],
+            dataset_proof_path=paths["proof"],
+            dataset_location_path=paths["location"],
+        )
+    with pytest.raises(KeyError):
+        convert_jsonl_to_parquet_parallel(
+            output_file_path=tmp_path / "prices.parquet",
+            dataset_price_path=paths["price"],
+            dataset_proof_path=paths["proof"],
+            dataset_location_path=paths["location"],
+            num_processes=1,
+        )
+
+
+def test_lookup_table(tmp_path: Path):
+    locations = [
+        {"id": location_id, "type": "OSM", "osm_address_city": f"City {location_id}"}
+        for location_id in (9, 2, 5, 3)
+    ]
+    # Duplicated ID, the last item wins
+    locations.append({"id": 5, "type": "OSM", "osm_address_city": "Updated"})
+    path = tmp_path / "locations.arrow"
+    write_lookup_table(
+        path, locations, LocationModel, LOCATION_KEYS, "location", batch_size=2
+    )
+
+    table = LookupTable(path)
+    assert table.table.num_rows == 10
+    rows = table.take(pa.array([3, None, 5, 9], type=pa.int64()))
+    assert "id" not in rows.column_names
+    assert rows["location_osm_address_city"].to_pylist() == [
+        "City 3",
+        None,
+        "Updated",
+        "City 9",
+    ]
+    for missing_id in (4, 10):
+        with pytest.raises(KeyError):
+            table.take(pa.array([2, missing_id], type=pa.int64()))
@@ -0,0 +1,41 @@
+import pyarrow as pa
+
+from openfoodfacts_exports.exports.parquet.price import PriceModel
+from openfoodfacts_exports.exports.parquet.pseudonymize import OwnerPseudonymizer
+
+
+def test_pseudonymize_unkeyed():
+    pseudonymizer = OwnerPseudonymizer()
+    # Same pseudonyms as the previous exports: sha256(owner)[:8]
+    assert pseudonymizer.pseudonymize("user1") == "0a041b94"
+    assert pseudonymizer.pseudonymize(None) is None
+    assert PriceModel(type="PRODUCT", owner="user1").model_dump()["owner"] == (
+        "0a041b94"
+    )
+
+
+def test_pseudonymize_keyed():
+    assert OwnerPseudonymizer("secret").pseudonymize("user1") == "59072360"
+    assert OwnerPseudonymizer("other").pseudonymize("user1") != "59072360"
+
+
+def test_pseudonymize_cache():
+    pseudonymizer = OwnerPseudonymizer(cache_size=2)
+    for owner in ["user1", "user2", "user1", "user3", "user4", "user1"]:
+        pseudonymizer.pseudonymize(owner)
+    cache_info = pseudonymizer.cache_info()
+    assert (cache_info.hits, cache_info.currsize) == (1, 2)
+
+
+def test_pseudonymize_array():
+    pseudonymizer = OwnerPseudonymizer("secret")
+    owners = ["user1", None, "user2", "user1", "user3", None]
+    expected = [pseudonymizer.pseudonymize(owner) for owner in owners]
+
+    assert pseudonymizer.pseudonymize_array(pa.array(owners)).to_pylist() == expected
+    assert (
+        pseudonymizer.pseudonymize_array(
+            pa.chunked_array([owners[:3], owners[3:]])
+        ).to_pylist()
+        == expected
+    )
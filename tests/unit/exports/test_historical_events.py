@@ -5,8 +5,11 @@ import orjson
 from openfoodfacts_exports.exports.historical_events import (
     ChangeAction,
     FieldChange,
+    RawFieldChange,
     RevisionInfo,
+    compute_revision_diffs,
     flatten_diffs,
+    flatten_diffs_raw,
     generate_events,
     resolve_field_value,
     write_events_jsonl_gz,
@@ -54,6 +57,24 @@ class TestFlattenDiffs:
             FieldChange(field="brands", action=ChangeAction.CHANGE)
         ]
 
+    def test_raw_fast_path(self):
+        """The fast path returns the same changes as plain named tuples."""
+        diffs = {
+            "fields": {"add": ["labels"], "change": ["brands"], "unknown": ["x"]},
+            "nutriments": {"change": ["brands", "energy"]},
+        }
+        changes = flatten_diffs_raw(diffs)
+        assert changes == [
+            RawFieldChange("labels", ChangeAction.ADD),
+            RawFieldChange("brands", ChangeAction.CHANGE),
+            RawFieldChange("energy", ChangeAction.CHANGE),
+        ]
+        assert changes[0].action is ChangeAction.ADD
+        assert [
+            FieldChange(field=change.field, action=change.action) for change in changes
+        ] == flatten_diffs(diffs)
+        assert flatten_diffs_raw(None) == []
+
 
 class TestResolveFieldValue:
     def test_top_level_field(self):
@@ -166,3 +187,50 @@ class TestWriteEventsJsonlGz:
         with gzip.open(output_path, "rb") as fp:
             lines = fp.read().splitlines()
         assert [orjson.loads(line) for line in lines] == events
+
+
+class TestComputeRevisionDiffs:
+    def test_fields_and_nested_fields(self):
+        previous = {
+            "rev": 1,
+            "last_modified_t": 1,
+            "brands": "Nestlé",
+            "url": "https://example.com",
+            "nutriments": {"energy_100g": 100, "fat_100g": 1},
+        }
+        current = {
+            "rev": 2,
+            "last_modified_t": 2,
+            "brands": "Nestlé,Nescafé",
+            "labels": "en:organic",
+            "nutriments": {"energy_100g": 110, "fat_100g": 1, "salt_100g": 0.5},
+        }
+        assert compute_revision_diffs(previous, current) == {
+            "fields": {"change": ["brands"], "add": ["labels"], "delete": ["url"]},
+            "nutriments": {
+                "change": ["nutriments.energy_100g"],
+                "add": ["nutriments.salt_100g"],
+            },
+        }
+
+    def test_no_change(self):
+        """Bookkeeping fields alone don't make a diff."""
+        assert (
+            compute_revision_diffs(
+                {"rev": 1, "brands": "Nestlé"}, {"rev": 2, "brands": "Nestlé"}
+            )
+            == {}
+        )
+
+    def test_values_are_resolved_by_generate_events(self):
+        previous = {"nutriments": {"energy_100g": 100}}
+        current = {"nutriments": {"energy_100g": 110}}
+        events = generate_events(
+            RevisionInfo(code="123", rev_id=2, timestamp=0),
+            compute_revision_diffs(previous, current),
+            previous,
+            current,
+        )
+        assert [(e["field"], e["previous"], e["current"]) for e in events] == [
+            ("nutriments.energy_100g", 100, 110)
+        ]
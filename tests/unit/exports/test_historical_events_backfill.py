@@ -0,0 +1,71 @@
+import gzip
+from pathlib import Path
+
+import orjson
+
+from openfoodfacts_exports.exports.historical_events_backfill import (
+    build_historical_events,
+    iter_product_events,
+)
+from openfoodfacts_exports.tasks.revision_store import LocalRevisionStore
+
+
+def write_revisions(root: Path, barcode: str, revisions: list[dict]) -> None:
+    product_dir = root / "v2" / barcode
+    product_dir.mkdir(parents=True)
+    for revision in revisions:
+        (product_dir / f"{revision['rev']}.json").write_bytes(orjson.dumps(revision))
+    (product_dir / "latest.json").write_bytes(orjson.dumps(revisions[-1]))
+
+
+def test_iter_product_events(tmp_path: Path):
+    write_revisions(
+        tmp_path,
+        "123",
+        [
+            {"rev": 1, "last_modified_t": 10, "brands": "A"},
+            {"rev": 2, "last_modified_t": 20, "brands": "B", "product_type": "food"},
+            # Revision 3 is missing from the store
+            {"rev": 4, "last_modified_t": 40, "product_type": "food"},
+        ],
+    )
+    store = LocalRevisionStore(tmp_path)
+    assert list(store.iter_products()) == [("123", [1, 2, 4])]
+
+    events = list(iter_product_events(store, "123", [1, 2, 4]))
+    assert [
+        (e["id"], e["timestamp"], e["field"], e["action"], e["previous"], e["current"])
+        for e in events
+    ] == [
+        ("123_2", 20, "brands", "change", "A", "B"),
+        ("123_2", 20, "product_type", "add", None, "food"),
+        ("123_4", 40, "brands", "delete", "B", None),
+    ]
+
+
+def test_build_historical_events(tmp_path: Path):
+    revision_dir = tmp_path / "revisions"
+    for i in range(10):
+        write_revisions(
+            revision_dir,
+            f"{i:013d}",
+            [
+                {"code": f"{i:013d}", "rev": rev, "last_modified_t": rev, "brands": rev}
+                for rev in range(1, i + 2)
+            ],
+        )
+    store = LocalRevisionStore(revision_dir)
+    output_path = tmp_path / "off_historical_events.jsonl.gz"
+
+    count = build_historical_events(store, output_path, num_processes=2, block_size=3)
+
+    events = [
+        orjson.loads(line)
+        for line in gzip.decompress(output_path.read_bytes()).splitlines()
+    ]
+    # One event per revision, except for the first revision of each product
+    assert count == len(events) == sum(range(10))
+    assert [e["id"] for e in events] == [
+        f"{i:013d}_{rev}" for i in range(10) for rev in range(2, i + 2)
+    ]
+    assert not (tmp_path / "off_historical_events.jsonl.gz.tmp").exists()
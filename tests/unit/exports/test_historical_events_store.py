@@ -0,0 +1,108 @@
+import gzip
+from pathlib import Path
+
+import orjson
+
+from openfoodfacts_exports.exports.historical_events import (
+    RevisionInfo,
+    generate_events,
+)
+from openfoodfacts_exports.exports.historical_events_store import (
+    EVENTS_FILE_NAME,
+    INDEX_FILE_NAME,
+    HistoricalEventStore,
+)
+
+# 2024-01-15 and 2024-02-15
+JANUARY = 1705276800
+FEBRUARY = 1707955200
+
+
+def make_events(code: str, rev_id: int, timestamp: int) -> list[dict]:
+    return generate_events(
+        RevisionInfo(code=code, rev_id=rev_id, timestamp=timestamp),
+        {"fields": {"change": ["brands", "labels"]}},
+        {"brands": "A", "labels": "B"},
+        {"brands": "C", "labels": "D"},
+    )
+
+
+def read_events(store: HistoricalEventStore, partition: str) -> list[dict]:
+    return list(store.iter_events(partition))
+
+
+def test_append_is_idempotent(tmp_path: Path):
+    store = HistoricalEventStore(tmp_path)
+    events = make_events("123", 1, JANUARY) + make_events("123", 2, FEBRUARY)
+
+    assert store.append(events) == 4
+    # Replays are skipped, also with a new store instance (index on disk)
+    assert store.append(events) == 0
+    assert HistoricalEventStore(tmp_path).append(events) == 0
+    # A revision delivered twice in the same batch is only written once
+    new_events = make_events("456", 1, JANUARY)
+    assert store.append(new_events + new_events) == 2
+
+    assert store.list_partitions() == ["2024-01", "2024-02"]
+    assert [e["id"] for e in read_events(store, "2024-01")] == [
+        "123_1",
+        "123_1",
+        "456_1",
+        "456_1",
+    ]
+    assert [e["id"] for e in read_events(store, "2024-02")] == ["123_2", "123_2"]
+    assert store.contains("123", 2, FEBRUARY)
+    assert not store.contains("123", 3, FEBRUARY)
+
+
+def test_compact(tmp_path: Path):
+    store = HistoricalEventStore(tmp_path)
+    store.append(make_events("456", 1, JANUARY + 1))
+    store.append(make_events("123", 1, JANUARY))
+    # Simulate an append interrupted before the index was updated
+    events_path = tmp_path / "month=2024-01" / EVENTS_FILE_NAME
+    with events_path.open("ab") as fp:
+        fp.write(
+            gzip.compress(
+                b"".join(
+                    orjson.dumps(event) + b"\n"
+                    for event in make_events("123", 1, JANUARY)
+                )
+            )
+        )
+    assert len(read_events(store, "2024-01")) == 6
+
+    stats = store.compact("2024-01")
+
+    assert (stats.events_before, stats.events_after, stats.revisions) == (6, 4, 2)
+    # Events are sorted by timestamp
+    assert [e["id"] for e in read_events(store, "2024-01")] == [
+        "123_1",
+        "123_1",
+        "456_1",
+        "456_1",
+    ]
+    store = HistoricalEventStore(tmp_path)
+    assert store.contains("456", 1, JANUARY)
+    assert store.append(make_events("456", 1, JANUARY + 1)) == 0
+
+
+def test_interrupted_append_is_truncated(tmp_path: Path):
+    store = HistoricalEventStore(tmp_path)
+    store.append(make_events("123", 1, JANUARY))
+    partition_dir = tmp_path / "month=2024-01"
+    # Simulate a process killed while it was writing an append
+    member = gzip.compress(
+        b"".join(orjson.dumps(e) + b"\n" for e in make_events("456", 1, JANUARY))
+    )
+    with (partition_dir / EVENTS_FILE_NAME).open("ab") as fp:
+        fp.write(member[: len(member) // 2])
+    with (partition_dir / INDEX_FILE_NAME).open("ab") as fp:
+        fp.write(b"\x01\x02\x03")
+
+    store = HistoricalEventStore(tmp_path)
+    assert [e["id"] for e in read_events(store, "2024-01")] == ["123_1", "123_1"]
+    assert not store.contains("456", 1, JANUARY)
+    assert store.append(make_events("456", 1, JANUARY)) == 2
+    assert store.compact("2024-01").events_after == 4
+    assert len(read_events(HistoricalEventStore(tmp_path), "2024-01")) == 4
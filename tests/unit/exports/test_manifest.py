@@ -0,0 +1,86 @@
+import datetime
+from pathlib import Path
+
+import fakeredis
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from openfoodfacts_exports.exports import manifest as manifest_module
+from openfoodfacts_exports.exports.manifest import (
+    ExportManifest,
+    ExportRecorder,
+    RowCounts,
+    diff_manifests,
+    format_diff,
+    get_history,
+)
+
+
+def test_export_recorder(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(manifest_module, "MANIFEST_HISTORY_SIZE", 3)
+    connection = fakeredis.FakeRedis()
+    input_path = tmp_path / "products.jsonl.gz"
+    input_path.write_bytes(b"input")
+    output_path = tmp_path / "products.parquet"
+
+    for i in range(5):
+        recorder = ExportRecorder("parquet-off")
+        recorder.add_input(input_path)
+        with recorder.stage("convert"):
+            table = pa.table({"code": [str(j) for j in range(250 + i)]})
+            pq.write_table(table, output_path, row_group_size=100)
+        recorder.set_row_counts(RowCounts(rows_in=252 + i, rows_out=250 + i))
+        recorder.add_artifact(output_path)
+        manifest = recorder.finish(connection=connection)
+
+    assert manifest.rows_rejected == 2
+    assert set(manifest.stages) == {"convert"}
+    assert manifest.inputs[0].size == 5
+    artifact = manifest.artifacts[0]
+    assert artifact.row_count == 254
+    assert artifact.row_groups is not None
+    assert (artifact.row_groups.num_row_groups, artifact.row_groups.max_rows) == (
+        3,
+        100,
+    )
+    assert artifact.row_groups.min_rows == 54
+    manifest_path = tmp_path / "products.parquet.manifest.json"
+    assert ExportManifest.model_validate_json(manifest_path.read_bytes()) == manifest
+
+    # Only the last runs are kept, most recent first
+    history = get_history(connection, "parquet-off")
+    assert [item.rows_out for item in history] == [254, 253, 252]
+    assert history[0] == manifest
+
+
+def test_diff_manifests():
+    old = ExportManifest(
+        export_name="parquet-off",
+        started_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+        duration=100.0,
+        rows_in=1000,
+        rows_out=1000,
+        rows_rejected=0,
+        stages={"convert": 80.0, "push": 20.0},
+        process_peak_rss_mb=500.0,
+    )
+    new = old.model_copy(
+        update={
+            "duration": 150.0,
+            "rows_in": 1010,
+            "rows_out": 1005,
+            "rows_rejected": 5,
+            "stages": {"convert": 130.0, "push": 20.0},
+            "process_peak_rss_mb": 2000.0,
+        }
+    )
+    diffs = {diff.name: diff for diff in diff_manifests(old, new)}
+    assert diffs["duration"].relative_change == 0.5
+    assert diffs["stages.push"].relative_change == 0.0
+    assert diffs["rows_rejected"].relative_change is None
+    # The peak RSS of the process is not comparable run over run
+    assert "process_peak_rss_mb" not in diffs
+
+    lines = format_diff(list(diffs.values()), threshold=0.1).splitlines()
+    flagged = {line.split()[1] for line in lines[1:] if line.startswith("!")}
+    assert flagged == {"duration", "stages.convert", "rows_rejected"}
@@ -0,0 +1,147 @@
+import gzip
+from pathlib import Path
+from typing import cast
+
+import orjson
+from minio import Minio
+from minio.error import S3Error
+
+from openfoodfacts_exports.tasks.backfill import (
+    BackfillCheckpoint,
+    backfill_revisions,
+    get_default_checkpoint_path,
+    save_checkpoint,
+)
+
+
+class NoSuchKeyError(S3Error):
+    # The S3Error constructor signature changes across minio versions
+    code = "NoSuchKey"
+
+    def __init__(self):
+        Exception.__init__(self, self.code)
+
+
+class InMemoryMinioClient:
+    """Minimal in-memory stand-in for the Minio client."""
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.put_count = 0
+
+    def put_object(self, bucket_name, object_name, data, length, **kwargs):
+        self.put_count += 1
+        self.objects[object_name] = data.read(length)
+
+    def stat_object(self, bucket_name, object_name):
+        if object_name not in self.objects:
+            raise NoSuchKeyError()
+
+
+def write_dataset(path: Path, products: list[dict]) -> None:
+    with gzip.open(path, "wb") as fp:
+        for product in products:
+            fp.write(orjson.dumps(product) + b"\n")
+
+
+PRODUCTS: list[dict] = [
+    {"code": "1", "rev": 3, "creator": "user", "product_name": "A"},
+    {"code": "2", "rev": 1, "product_name": "B"},
+    {"code": "3", "product_name": "no revision"},
+    {"code": "4", "rev": 7, "product_name": "D"},
+]
+
+
+class TestBackfillRevisions:
+    def test_backfill(self, tmp_path: Path):
+        dataset_path = tmp_path / "products.jsonl.gz"
+        write_dataset(dataset_path, PRODUCTS)
+        client = InMemoryMinioClient()
+
+        checkpoint = backfill_revisions(
+            dataset_path, num_workers=2, minio_client=cast(Minio, client)
+        )
+
+        assert sorted(client.objects) == [
+            "v2/1/3.json",
+            "v2/1/latest.json",
+            "v2/2/1.json",
+            "v2/2/latest.json",
+            "v2/4/7.json",
+            "v2/4/latest.json",
+        ]
+        # User IDs are stripped
+        assert orjson.loads(client.objects["v2/1/3.json"]) == {
+            "code": "1",
+            "rev": 3,
+            "product_name": "A",
+        }
+        assert checkpoint.products == 4
+        assert checkpoint.uploaded_objects == 6
+        assert checkpoint.skipped == 1
+        assert checkpoint.failed == 0
+        assert checkpoint.offset == len(gzip.decompress(dataset_path.read_bytes()))
+        assert get_default_checkpoint_path(dataset_path).is_file()
+
+    def test_skip_existing_and_keep_latest(self, tmp_path: Path):
+        dataset_path = tmp_path / "products.jsonl.gz"
+        write_dataset(dataset_path, PRODUCTS)
+        client = InMemoryMinioClient()
+        # Revision already uploaded
+        client.objects["v2/1/3.json"] = b"{}"
+        # More recent revision uploaded by the update listener
+        client.objects["v2/2/latest.json"] = b'{"rev": 2}'
+
+        checkpoint = backfill_revisions(
+            dataset_path, num_workers=2, minio_client=cast(Minio, client)
+        )
+
+        assert client.objects["v2/1/3.json"] == b"{}"
+        assert "v2/1/latest.json" not in client.objects
+        assert "v2/2/1.json" in client.objects
+        assert client.objects["v2/2/latest.json"] == b'{"rev": 2}'
+        assert checkpoint.skipped == 2
+        assert checkpoint.uploaded_objects == 3
+
+    def test_resume_from_checkpoint(self, tmp_path: Path):
+        dataset_path = tmp_path / "products.jsonl"
+        dataset_path.write_bytes(
+            b"".join(orjson.dumps(product) + b"\n" for product in PRODUCTS)
+        )
+        first_line_length = len(orjson.dumps(PRODUCTS[0])) + 1
+        checkpoint_path = tmp_path / "checkpoint.json"
+        save_checkpoint(
+            BackfillCheckpoint(
+                dataset_path=str(dataset_path), offset=first_line_length, products=1
+            ),
+            checkpoint_path,
+        )
+        client = InMemoryMinioClient()
+
+        checkpoint = backfill_revisions(
+            dataset_path,
+            checkpoint_path=checkpoint_path,
+            num_workers=2,
+            minio_client=cast(Minio, client),
+        )
+
+        # The first product was processed during the previous run
+        assert not any(name.startswith("v2/1/") for name in client.objects)
+        assert checkpoint.products == 4
+        assert checkpoint.offset == dataset_path.stat().st_size
+
+    def test_checkpoint_discarded_if_dataset_changed(self, tmp_path: Path):
+        dataset_path = tmp_path / "products.jsonl.gz"
+        write_dataset(dataset_path, PRODUCTS)
+        checkpoint_path = get_default_checkpoint_path(dataset_path)
+        save_checkpoint(
+            BackfillCheckpoint(
+                dataset_path=str(dataset_path), dataset_etag="old", offset=10
+            ),
+            checkpoint_path,
+        )
+        client = InMemoryMinioClient()
+
+        checkpoint = backfill_revisions(dataset_path, minio_client=cast(Minio, client))
+        assert checkpoint.products == 4
+        assert client.put_count == 6
@@ -0,0 +1,115 @@
+from unittest.mock import MagicMock
+
+import fakeredis
+from minio.deleteobjects import DeleteError
+
+from openfoodfacts_exports.tasks.deletion import PENDING_DELETIONS_KEY, BatchDeleter
+
+
+class FakeMinioClient:
+    """Minio stand-in recording `remove_objects` calls. `failures` maps an
+    object name to the number of times its deletion should fail."""
+
+    def __init__(self, failures: dict[str, int] | None = None):
+        self.failures = dict(failures or {})
+        self.calls: list[tuple[str, list[str]]] = []
+
+    def remove_objects(self, bucket_name, delete_object_list):
+        names = [obj.name for obj in delete_object_list]
+        self.calls.append((bucket_name, names))
+        for name in names:
+            if self.failures.get(name, 0) > 0:
+                self.failures[name] -= 1
+                yield DeleteError("InternalError", "error", name, None)
+
+
+class TestBatchDeleter:
+    def test_no_window_flushes_immediately(self):
+        client = FakeMinioClient()
+        deleter = BatchDeleter(client)
+        deleter.add("bucket", ["a.jpg", "a.400.jpg", "a.json.gz"])
+        assert client.calls == [("bucket", ["a.400.jpg", "a.jpg", "a.json.gz"])]
+        assert deleter.request_count == 1
+        assert deleter.deleted_count == 3
+
+    def test_aggregates_deletions_until_flush(self):
+        client = FakeMinioClient()
+        deleter = BatchDeleter(client, window=60)
+        deleter.add("bucket", ["a.jpg", "a.400.jpg"])
+        deleter.add("bucket", ["b.jpg", "a.jpg"])
+        deleter.add("other-bucket", ["latest.json"])
+        assert client.calls == []
+        assert deleter.pending_count == 4
+
+        deleter.flush()
+        assert client.calls == [
+            ("bucket", ["a.400.jpg", "a.jpg", "b.jpg"]),
+            ("other-bucket", ["latest.json"]),
+        ]
+        assert deleter.pending_count == 0
+
+    def test_flushes_when_batch_is_full(self):
+        client = FakeMinioClient()
+        deleter = BatchDeleter(client, window=60, max_batch_size=3)
+        deleter.add("bucket", ["1", "2"])
+        assert client.calls == []
+        deleter.add("bucket", ["3", "4", "5", "6", "7"])
+        assert client.calls == [
+            ("bucket", ["1", "2", "3"]),
+            ("bucket", ["4", "5", "6"]),
+            ("bucket", ["7"]),
+        ]
+
+    def test_retries_partial_failures(self, mocker):
+        mocker.patch("openfoodfacts_exports.tasks.deletion.time.sleep")
+        client = FakeMinioClient(failures={"b": 2})
+        deleter = BatchDeleter(client)
+        deleter.add("bucket", ["a", "b", "c"])
+        # Only the failed object is retried
+        assert client.calls == [
+            ("bucket", ["a", "b", "c"]),
+            ("bucket", ["b"]),
+            ("bucket", ["b"]),
+        ]
+        assert deleter.deleted_count == 3
+        assert deleter.failed_count == 0
+
+    def test_gives_up_after_max_retries(self, mocker):
+        mocker.patch("openfoodfacts_exports.tasks.deletion.time.sleep")
+        client = FakeMinioClient(failures={"b": 10})
+        deleter = BatchDeleter(client, max_retries=2)
+        deleter.add("bucket", ["a", "b"])
+        assert len(client.calls) == 3
+        assert deleter.deleted_count == 1
+        assert deleter.failed_count == 1
+
+    def test_retries_on_request_error(self, mocker):
+        mocker.patch("openfoodfacts_exports.tasks.deletion.time.sleep")
+        client = MagicMock()
+        client.remove_objects.side_effect = [ConnectionError(), iter([])]
+        deleter = BatchDeleter(client)
+        deleter.add("bucket", ["a"])
+        assert client.remove_objects.call_count == 2
+        assert deleter.deleted_count == 1
+
+    def test_delete_is_not_buffered(self):
+        client = FakeMinioClient()
+        deleter = BatchDeleter(client, window=60)
+        deleter.add("bucket", ["a.jpg"])
+        deleter.delete("other-bucket", ["latest.json"])
+        assert client.calls == [("other-bucket", ["latest.json"])]
+        assert deleter.pending_count == 1
+
+    def test_recovers_pending_deletions(self):
+        redis_client = fakeredis.FakeRedis(decode_responses=True)
+        deleter = BatchDeleter(FakeMinioClient(), window=60, redis_client=redis_client)
+        deleter.add("bucket", ["a.jpg", "b/c.jpg"])
+        deleter.add("other-bucket", ["d.jpg"])
+        deleter.flush()
+        deleter.add("bucket", ["e.jpg", "f.jpg"])
+        # The process is killed before the end of the window: the next one
+        # sends the deletions that were not sent
+        client = FakeMinioClient()
+        BatchDeleter(client, window=60, redis_client=redis_client).recover()
+        assert client.calls == [("bucket", ["e.jpg", "f.jpg"])]
+        assert redis_client.smembers(PENDING_DELETIONS_KEY) == set()
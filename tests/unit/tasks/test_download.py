@@ -0,0 +1,263 @@
+import gzip
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import orjson
+import pyarrow.parquet as pq
+import pytest
+import requests
+
+from openfoodfacts_exports.exports.parquet import convert_jsonl_stream_to_parquet
+from openfoodfacts_exports.exports.parquet.beauty import (
+    BEAUTY_DTYPE_MAP,
+    BEAUTY_PRODUCT_SCHEMA,
+    BeautyProduct,
+)
+from openfoodfacts_exports.tasks import download
+from openfoodfacts_exports.tasks.download import (
+    DatasetChangedError,
+    download_file_parallel,
+    get_metadata_path,
+    open_streaming_download,
+)
+
+
+class RangeServer(ThreadingHTTPServer):
+    """HTTP server serving a single file, with support of range requests.
+
+    `failures` maps the start offset of a range (0 for the full file) to the
+    number of times the response should be interrupted after half of the
+    range.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, content: bytes, etag: str = '"v1"', accept_ranges=True):
+        super().__init__(("127.0.0.1", 0), RangeRequestHandler)
+        self.content = content
+        self.etag = etag
+        self.accept_ranges = accept_ranges
+        self.failures: dict[int, int] = {}
+        self.requests: list[str | None] = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/products.jsonl.gz"
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    server: RangeServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_file_headers(self, status: int, length: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", self.server.etag)
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+
+    def do_HEAD(self):
+        self.send_file_headers(200, len(self.server.content))
+        self.end_headers()
+
+    def do_GET(self):
+        content = self.server.content
+        range_header = self.headers.get("Range")
+        with self.server.lock:
+            self.server.requests.append(range_header)
+        if (
+            range_header is None
+            or not self.server.accept_ranges
+            or self.headers.get("If-Range") != self.server.etag
+        ):
+            start, body = 0, content
+            self.send_file_headers(200, len(body))
+        else:
+            start, end = map(int, range_header.removeprefix("bytes=").split("-"))
+            body = content[start : end + 1]
+            self.send_file_headers(206, len(body))
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+        self.end_headers()
+        with self.server.lock:
+            fail = self.server.failures.get(start, 0) > 0
+            if fail:
+                self.server.failures[start] -= 1
+        if fail:
+            # The connection is closed before the end of the response
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(content: bytes, **kwargs) -> RangeServer:
+        server = RangeServer(content, **kwargs)
+        threading.Thread(
+            target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+        ).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+CONTENT = os.urandom(1_000_000)
+CHUNK_SIZE = 64 * 1024
+
+
+def test_download_file_parallel(tmp_path: Path, server, monkeypatch):
+    monkeypatch.setattr(download, "RETRY_DELAY", 0)
+    monkeypatch.setattr(download, "READ_BLOCK_SIZE", 4096)
+    range_server = server(CONTENT)
+    # A chunk is interrupted, it is resumed from the last byte received
+    range_server.failures[3 * CHUNK_SIZE] = 1
+    output_path = tmp_path / "products.jsonl.gz"
+
+    download_file_parallel(
+        range_server.url, output_path, num_connections=4, chunk_size=CHUNK_SIZE
+    )
+
+    assert output_path.read_bytes() == CONTENT
+    assert json.loads(get_metadata_path(output_path).read_text())["etag"] == "v1"
+    assert not (tmp_path / "products.jsonl.gz.part").exists()
+    assert not (tmp_path / "products.jsonl.gz.part.json").exists()
+    # 16 chunks, and a retry
+    assert len(range_server.requests) == 17
+    chunk_starts = sorted(
+        int(request.removeprefix("bytes=").split("-")[0])
+        for request in range_server.requests
+        if request is not None and request.endswith(f"-{4 * CHUNK_SIZE - 1}")
+    )
+    assert chunk_starts[0] == 3 * CHUNK_SIZE
+    assert 3 * CHUNK_SIZE < chunk_starts[1] < 4 * CHUNK_SIZE
+
+
+def test_download_file_parallel_resume(tmp_path: Path, server, monkeypatch):
+    monkeypatch.setattr(download, "RETRY_DELAY", 0)
+    range_server = server(CONTENT)
+    range_server.failures[5 * CHUNK_SIZE] = download.MAX_CHUNK_ATTEMPTS
+    output_path = tmp_path / "products.jsonl.gz"
+
+    with pytest.raises(requests.exceptions.RequestException):
+        download_file_parallel(
+            range_server.url, output_path, num_connections=2, chunk_size=CHUNK_SIZE
+        )
+    assert not output_path.exists()
+    state = download.DownloadState.model_validate_json(
+        (tmp_path / "products.jsonl.gz.part.json").read_bytes()
+    )
+    assert 5 not in state.done_chunks
+
+    # Only the missing chunks are downloaded
+    range_server.requests.clear()
+    download_file_parallel(
+        range_server.url, output_path, num_connections=2, chunk_size=CHUNK_SIZE
+    )
+    assert output_path.read_bytes() == CONTENT
+    assert len(range_server.requests) == 16 - len(state.done_chunks)
+
+
+def test_download_file_parallel_changed(tmp_path: Path, server, monkeypatch):
+    range_server = server(CONTENT)
+    output_path = tmp_path / "products.jsonl.gz"
+    original_download_chunk = download.download_chunk
+
+    def download_chunk(*args):
+        # The file is updated during the download
+        range_server.etag = '"v2"'
+        original_download_chunk(*args)
+
+    monkeypatch.setattr(download, "download_chunk", download_chunk)
+    with pytest.raises(DatasetChangedError):
+        download_file_parallel(
+            range_server.url, output_path, num_connections=2, chunk_size=CHUNK_SIZE
+        )
+    assert not (tmp_path / "products.jsonl.gz.part").exists()
+    assert not (tmp_path / "products.jsonl.gz.part.json").exists()
+
+
+def test_download_file_without_range_support(tmp_path: Path, server):
+    range_server = server(CONTENT, accept_ranges=False)
+    output_path = tmp_path / "products.jsonl.gz"
+
+    download_file_parallel(
+        range_server.url, output_path, num_connections=4, chunk_size=CHUNK_SIZE
+    )
+
+    assert output_path.read_bytes() == CONTENT
+    assert range_server.requests == [None]
+    assert json.loads(get_metadata_path(output_path).read_text())["etag"] == "v1"
+
+
+def convert_streaming_download(url: str, dataset_path: Path, output_path: Path):
+    with (
+        open_streaming_download(url, dataset_path) as stream,
+        gzip.GzipFile(fileobj=stream) as f,
+    ):
+        return convert_jsonl_stream_to_parquet(
+            output_file_path=output_path,
+            stream=f,
+            pydantic_cls=BeautyProduct,
+            schema=BEAUTY_PRODUCT_SCHEMA,
+            dtype_map=BEAUTY_DTYPE_MAP,
+            batch_size=100,
+        )
+
+
+def make_dump(num_items: int) -> bytes:
+    return gzip.compress(
+        b"".join(
+            orjson.dumps({"code": str(i), "product_name": os.urandom(16).hex()}) + b"\n"
+            for i in range(num_items)
+        )
+    )
+
+
+def test_convert_streaming_download(tmp_path: Path, server):
+    dump = make_dump(1000)
+    range_server = server(dump)
+    dataset_path = tmp_path / "products.jsonl.gz"
+    output_path = tmp_path / "beauty.parquet"
+
+    row_counts = convert_streaming_download(range_server.url, dataset_path, output_path)
+
+    assert (row_counts.rows_in, row_counts.rows_out) == (1000, 1000)
+    assert pq.read_table(output_path)["code"].to_pylist() == [
+        str(i) for i in range(1000)
+    ]
+    # The dump is cached, with its ETag
+    assert dataset_path.read_bytes() == dump
+    assert json.loads(get_metadata_path(dataset_path).read_text())["etag"] == "v1"
+    assert range_server.requests == [None]
+
+
+def test_convert_streaming_download_failure(tmp_path: Path, server, monkeypatch):
+    monkeypatch.setattr(download, "READ_BLOCK_SIZE", 64 * 1024)
+    # Large enough to convert batches before the failure
+    range_server = server(make_dump(20_000))
+    range_server.failures[0] = 1
+    dataset_path = tmp_path / "products.jsonl.gz"
+
+    output_path = tmp_path / "beauty.parquet"
+
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        convert_streaming_download(range_server.url, dataset_path, output_path)
+
+    # Batches were converted before the failure
+    assert output_path.exists()
+    assert not dataset_path.exists()
+    assert not (tmp_path / "products.jsonl.gz.streaming").exists()
@@ -0,0 +1,184 @@
+import datetime
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+
+import fakeredis
+import orjson
+import pytest
+from openfoodfacts.redis import ProductUpdateEvent
+
+from openfoodfacts_exports.exports.historical_events_store import (
+    HistoricalEventStore,
+)
+from openfoodfacts_exports.tasks.event_capture import LiveEventCapture, RevisionCache
+from openfoodfacts_exports.tasks.revision_store import RevisionStore
+from openfoodfacts_exports.update_listener import UpdateListener
+
+
+class InMemoryRevisionStore(RevisionStore):
+    def __init__(self, revisions: dict[tuple[str, int], dict]):
+        super().__init__()
+        self.revisions = revisions
+        self.requests = 0
+
+    def iter_products(self):
+        raise NotImplementedError
+
+    def get_revision(self, barcode, rev_id):
+        self.requests += 1
+        return self.revisions.get((barcode, rev_id))
+
+
+def make_update_event(code: str, diffs: dict) -> ProductUpdateEvent:
+    return ProductUpdateEvent(
+        id="1-0",
+        stream="product_updates",
+        timestamp=datetime.datetime(2024, 1, 15, tzinfo=datetime.timezone.utc),
+        code=code,
+        flavor="off",
+        user_id="user",
+        action="updated",
+        comment="Edit",
+        product_type="food",
+        diffs=orjson.dumps(diffs).decode(),
+    )
+
+
+def test_revision_cache():
+    product = {"code": "1", "brands": "A"}
+    size = len(orjson.dumps(product))
+    cache = RevisionCache(max_size=2 * size)
+    cache.put("1", 1, product)
+    cache.put("2", 1, product)
+    assert cache.get("1", 1) == product
+    # Only the cached revision is returned
+    assert cache.get("1", 2) is None
+    # "2" is the least recently used product
+    cache.put("3", 1, product)
+    assert cache.get("2", 1) is None
+    assert cache.get("3", 1) == product
+    assert (cache.hits, cache.misses, len(cache), cache.size) == (2, 2, 2, 2 * size)
+    # Revisions larger than the budget are not cached
+    cache.put("1", 2, {"brands": "A" * 2 * size})
+    assert cache.get("1", 2) is None
+    assert cache.size == size
+
+
+def test_live_event_capture(tmp_path: Path):
+    revision_store = InMemoryRevisionStore({("123", 1): {"rev": 1, "brands": "A"}})
+    event_store = HistoricalEventStore(tmp_path)
+    capture = LiveEventCapture(event_store, revision_store, batch_size=3)
+    diffs = {"fields": {"change": ["brands"]}}
+
+    # The previous revision is not in cache, it is fetched from the store
+    capture.capture(make_update_event("123", diffs), {"rev": 2, "brands": "B"})
+    assert revision_store.requests == 1
+    # Events are buffered until the batch size is reached
+    assert event_store.list_partitions() == []
+    capture.capture(make_update_event("123", diffs), {"rev": 3, "brands": "C"})
+    assert revision_store.requests == 1
+    assert capture.cache.hit_rate == 0.5
+    # Redelivered update
+    capture.capture(make_update_event("123", diffs), {"rev": 3, "brands": "C"})
+    capture.flush()
+
+    events = list(event_store.iter_events("2024-01"))
+    assert [(e["id"], e["previous"], e["current"]) for e in events] == [
+        ("123_2", "A", "B"),
+        ("123_3", "B", "C"),
+    ]
+    assert events[0]["comment"] == "Edit"
+    assert events[0]["timestamp"] == 1705276800
+
+
+def test_live_event_capture_skips_later_revision(tmp_path: Path):
+    revision_store = InMemoryRevisionStore({("123", 1): {"rev": 1, "brands": "A"}})
+    event_store = HistoricalEventStore(tmp_path)
+    capture = LiveEventCapture(event_store, revision_store)
+    diffs = {"fields": {"change": ["brands"]}}
+    event_time = 1705276800
+
+    # Revision 3 was saved before the API call made for the event of rev 2
+    capture.capture(
+        make_update_event("123", diffs),
+        {"rev": 3, "brands": "C", "last_modified_t": event_time + 5},
+    )
+    assert capture.skipped_count == 1
+    capture.capture(
+        make_update_event("123", diffs),
+        {"rev": 3, "brands": "C", "last_modified_t": event_time},
+    )
+    capture.flush()
+
+    events = list(event_store.iter_events("2024-01"))
+    assert [(e["id"], e["current"]) for e in events] == [("123_3", "C")]
+
+
+def test_live_event_capture_flush_thread(tmp_path: Path):
+    """Buffered events are written while no update is captured."""
+    event_store = HistoricalEventStore(tmp_path)
+    capture = LiveEventCapture(
+        event_store, InMemoryRevisionStore({}), flush_interval=0.1
+    )
+    capture.capture(
+        make_update_event("123", {"fields": {"add": ["brands"]}}),
+        {"rev": 1, "brands": "A"},
+    )
+    capture.start_flush_thread()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and not event_store.list_partitions():
+            time.sleep(0.05)
+    finally:
+        capture.stop_flush_thread()
+    assert [event["id"] for event in event_store.iter_events("2024-01")] == ["123_1"]
+
+
+def wait_for_updates(*args, **kwargs):
+    # No update is published: the listener waits until it is stopped
+    while True:
+        time.sleep(0.01)
+        yield from ()
+
+
+def test_listener_flushes_events_on_sigterm(mocker, tmp_path: Path):
+    mocker.patch("openfoodfacts.redis.get_new_updates_multistream", wait_for_updates)
+    event_store = HistoricalEventStore(tmp_path)
+    event_capture = LiveEventCapture(
+        event_store, InMemoryRevisionStore({}), flush_interval=3600
+    )
+    event_capture.capture(
+        make_update_event("123", {"fields": {"add": ["brands"]}}),
+        {"rev": 1, "brands": "A"},
+    )
+    listener = UpdateListener(
+        redis_client=fakeredis.FakeRedis(decode_responses=True),
+        redis_latest_id_key="latest_id",
+        event_capture=event_capture,
+    )
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+
+    with pytest.raises(SystemExit):
+        listener.listen()
+
+    timer.join()
+    assert [event["id"] for event in event_store.iter_events("2024-01")] == ["123_1"]
+    assert signal.getsignal(signal.SIGTERM) == previous_handler
+
+
+def test_listener_stops_after_the_current_event():
+    listener = UpdateListener(
+        redis_client=fakeredis.FakeRedis(decode_responses=True),
+        redis_latest_id_key="latest_id",
+    )
+    listener._processing = True
+    listener.handle_stop_signal(signal.SIGTERM, None)
+    listener._processing = False
+    with pytest.raises(SystemExit):
+        # An event with an empty code is skipped
+        listener.process_redis_update(make_update_event("", {}))
@@ -0,0 +1,139 @@
+import json
+from pathlib import Path
+
+import fakeredis
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from openfoodfacts import Flavor
+from rq import Queue
+
+from openfoodfacts_exports import tasks
+from openfoodfacts_exports.exports.csv import mobile
+from openfoodfacts_exports.exports.export_state import (
+    SKIPPED_EXPORTS_KEY,
+    save_fingerprint,
+)
+from openfoodfacts_exports.types import ExportFlavor
+
+
+class FakeDownloader:
+    """Stand-in of `get_product_dataset`, "downloading" the dataset (with its ETag
+    metadata file) when its ETag changed."""
+
+    def __init__(self, dataset_path: Path, etag: str):
+        self.dataset_path = dataset_path
+        self.etag = etag
+        self.downloads = 0
+
+    def __call__(self, flavor, download_newer):
+        metadata_path = self.dataset_path.with_name("products_jsonl_gz.json")
+        if metadata_path.is_file() and (
+            json.loads(metadata_path.read_text())["etag"] == self.etag
+        ):
+            return self.dataset_path
+        self.downloads += 1
+        self.dataset_path.write_bytes(f"dump {self.etag}".encode())
+        metadata_path.write_text(json.dumps({"etag": self.etag}))
+        return self.dataset_path
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = fakeredis.FakeRedis()
+    monkeypatch.setattr(tasks, "redis_conn", connection)
+    monkeypatch.setattr(mobile, "redis_conn", connection)
+    monkeypatch.setattr("openfoodfacts_exports.workers.redis.redis_conn", connection)
+    monkeypatch.setattr(tasks, "cpu_queue", Queue("cpu", connection=connection))
+    monkeypatch.setattr(tasks, "high_queue", Queue("high", connection=connection))
+    return connection
+
+
+def run_save_fingerprint_job(connection) -> None:
+    """Run the job saving the fingerprint, as if the exports succeeded."""
+    (job,) = tasks.high_queue.deferred_job_registry.get_job_ids()
+    save_job = tasks.high_queue.fetch_job(job)
+    assert save_job is not None
+    assert save_job.func is save_fingerprint
+    save_fingerprint(*save_job.args, connection=connection)
+    save_job.delete()
+
+
+def test_export_job_skipped_if_dataset_unchanged(
+    tmp_path: Path, connection, monkeypatch
+):
+    downloader = FakeDownloader(tmp_path / "products.jsonl.gz", etag="v1")
+    parquet_path = tmp_path / "food.parquet"
+    mobile_dump_path = tmp_path / "mobile-dump.tsv.gz"
+    monkeypatch.setattr(tasks, "get_product_dataset", downloader)
+    monkeypatch.setattr(tasks, "PARQUET_DATASET_PATH", {Flavor.off: parquet_path})
+    monkeypatch.setattr(tasks, "MOBILE_APP_DUMP_DATASET_PATH", mobile_dump_path)
+
+    tasks.export_job(ExportFlavor.off)
+    # The Parquet export, and the mobile dump that depends on it
+    assert tasks.cpu_queue.count == 1
+    assert len(tasks.cpu_queue.deferred_job_registry) == 1
+    run_save_fingerprint_job(connection)
+    parquet_path.touch()
+    mobile_dump_path.touch()
+
+    # Same ETag: nothing is enqueued
+    tasks.export_job(ExportFlavor.off)
+    assert tasks.cpu_queue.count == 1
+    assert connection.hget(SKIPPED_EXPORTS_KEY, "parquet-off") == b"1"
+    assert downloader.downloads == 1
+
+    # The export is run again if forced, or if an output is missing
+    tasks.export_job(ExportFlavor.off, force=True)
+    assert tasks.cpu_queue.count == 2
+    mobile_dump_path.unlink()
+    tasks.export_job(ExportFlavor.off)
+    assert tasks.cpu_queue.count == 3
+    mobile_dump_path.touch()
+
+    # New dump
+    downloader.etag = "v2"
+    tasks.export_job(ExportFlavor.off)
+    assert tasks.cpu_queue.count == 4
+    assert downloader.downloads == 2
+    assert connection.hget(SKIPPED_EXPORTS_KEY, "parquet-off") == b"1"
+
+
+def write_products(path: Path, product_names: list[str], categories: list[str]):
+    table = pa.table(
+        {
+            "code": [str(i) for i in range(len(product_names))],
+            "product_name": product_names,
+            "quantity": ["1 kg"] * len(product_names),
+            "brands": ["Brand"] * len(product_names),
+            "nutriscore_grade": ["a"] * len(product_names),
+            "nova_group": [1] * len(product_names),
+            "environmental_score_grade": ["b"] * len(product_names),
+            # Not in the mobile dump
+            "categories": categories,
+        }
+    )
+    pq.write_table(table, path, row_group_size=2)
+
+
+def test_mobile_app_dump_skipped_if_columns_unchanged(
+    tmp_path: Path, connection, monkeypatch, mocker
+):
+    parquet_path = tmp_path / "food.parquet"
+    monkeypatch.setattr(
+        mobile, "MOBILE_APP_DUMP_DATASET_PATH", tmp_path / "mobile-dump.tsv.gz"
+    )
+    generate = mocker.spy(mobile, "generate_mobile_app_dump")
+
+    write_products(parquet_path, ["Apple", "Pear", "Plum"], ["fruits"] * 3)
+    mobile.generate_push_mobile_app_dump(parquet_path)
+    assert generate.call_count == 1
+
+    write_products(parquet_path, ["Apple", "Pear", "Plum"], ["a", "b", "c"])
+    mobile.generate_push_mobile_app_dump(parquet_path)
+    assert generate.call_count == 1
+    assert connection.hget(SKIPPED_EXPORTS_KEY, "mobile-dump") == b"1"
+
+    write_products(parquet_path, ["Apple", "Pear", "Plums"], ["a", "b", "c"])
+    mobile.generate_push_mobile_app_dump(parquet_path)
+    assert generate.call_count == 2
@@ -1,12 +1,76 @@
 import gzip
 from unittest.mock import MagicMock, patch
 
+import requests
 from openfoodfacts import Environment, Flavor
-from openfoodfacts.utils import AssetDownloadItem
 
 from openfoodfacts_exports.tasks import images
 
 
+class FakeResponse:
+    """Minimal streamed `requests.Response` stand-in."""
+
+    def __init__(self, status_code: int, content: bytes = b""):
+        self.status_code = status_code
+        self.content = content
+
+    def iter_content(self, chunk_size: int = 1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def mock_session(mocker, get_response):
+    """Patch `requests.Session` so that `session.get(url)` returns
+    `get_response(url)`."""
+    session = MagicMock()
+    session.get.side_effect = lambda url, **kwargs: get_response(url)
+    mocker.patch(
+        "openfoodfacts_exports.tasks.images.requests.Session", return_value=session
+    )
+    return session
+
+
+def mock_minio_client(mocker) -> tuple[MagicMock, dict[str, bytes]]:
+    """Patch the Minio client, the uploaded data is read and stored in the
+    returned dict (object name -> content)."""
+    uploaded: dict[str, bytes] = {}
+    mock_client = MagicMock()
+
+    def fake_put_object(bucket_name, object_name, data, length, **kwargs):
+        uploaded[object_name] = data.read()
+
+    mock_client.put_object.side_effect = fake_put_object
+    mocker.patch(
+        "openfoodfacts_exports.tasks.images.get_minio_client",
+        return_value=mock_client,
+    )
+    return mock_client, uploaded
+
+
+class TestStreamingReader:
+    def test_read_chunks(self):
+        reader = images.StreamingReader(iter([b"abc", b"de", b"fghij"]))
+        assert reader.read(4) == b"abcd"
+        assert reader.read(2) == b"ef"
+        assert reader.read() == b"ghij"
+        assert reader.read(10) == b""
+
+    def test_gzip_compress(self):
+        content = b'{"ocr": "data"}' * 1000
+        chunks = iter([content[i : i + 100] for i in range(0, len(content), 100)])
+        reader = images.StreamingReader(chunks, gzip_compress=True)
+        compressed = b""
+        while data := reader.read(64):
+            compressed += data
+        assert gzip.decompress(compressed) == content
+
+
 class TestUploadNewImageToS3:
     @patch("openfoodfacts_exports.tasks.images.settings.ENABLE_S3_PUSH", False)
     def test_upload_new_image_to_s3_disabled(self, mocker):
@@ -14,12 +78,12 @@ class TestUploadNewImageToS3:
         mock_client = mocker.patch(
             "openfoodfacts_exports.tasks.images.get_minio_client"
         )
-        mock_asset = mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_asset_from_url"
+        mock_session_cls = mocker.patch(
+            "openfoodfacts_exports.tasks.images.requests.Session"
         )
         images.upload_new_image_to_s3("img1", "123", Flavor.off, Environment.org)
         mock_client.assert_not_called()
-        mock_asset.assert_not_called()
+        mock_session_cls.assert_not_called()
 
     @patch("openfoodfacts_exports.tasks.images.settings.ENABLE_S3_PUSH", True)
     def test_upload_new_image_to_s3_success(self, mocker):
@@ -27,22 +91,12 @@ class TestUploadNewImageToS3:
         image_content = ("x" * 200).encode("utf-8")
         ocr_content = '{"ocr": "data"}'.encode("utf-8")
 
-        def fake_get_asset_from_url(asset_url, **kwargs):
+        def fake_get(asset_url):
             is_ocr = asset_url.endswith(".json")
-            content = ocr_content if is_ocr else image_content
-            return AssetDownloadItem(
-                url=asset_url, response=MagicMock(status_code=200, content=content)
-            )
-
-        mock_client = mocker.MagicMock()
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_minio_client",
-            return_value=mock_client,
-        )
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_asset_from_url",
-            fake_get_asset_from_url,
-        )
+            return FakeResponse(200, ocr_content if is_ocr else image_content)
+
+        mock_session(mocker, fake_get)
+        mock_client, uploaded = mock_minio_client(mocker)
         images.upload_new_image_to_s3(
             image_id="1",
             barcode="3270160396337",
@@ -55,42 +109,32 @@ class TestUploadNewImageToS3:
         calls = mock_client.put_object.call_args_list
         buckets = [c.kwargs["bucket_name"] for c in calls]
         assert all(b == "openfoodfacts-images" for b in buckets)
+        # Data is streamed, so the length is unknown upfront
+        assert all(c.kwargs["length"] == -1 for c in calls)
+        assert all(c.kwargs["part_size"] == images.UPLOAD_PART_SIZE for c in calls)
 
-        object_names = [c.kwargs["object_name"] for c in calls]
-        assert object_names == [
+        assert set(uploaded) == {
             "data/327/016/039/6337/1.jpg",
             "data/327/016/039/6337/1.400.jpg",
             "data/327/016/039/6337/1.json.gz",
-        ]
-
-        lengths = [c.kwargs["length"] for c in calls]
-        assert lengths == [200, 200, len(gzip.compress(ocr_content))]
+        }
+        assert uploaded["data/327/016/039/6337/1.jpg"] == image_content
+        assert uploaded["data/327/016/039/6337/1.400.jpg"] == image_content
+        assert (
+            gzip.decompress(uploaded["data/327/016/039/6337/1.json.gz"]) == ocr_content
+        )
 
     @patch("openfoodfacts_exports.tasks.images.settings.ENABLE_S3_PUSH", True)
     def test_upload_new_image_to_s3_images_not_found(self, mocker):
         """Images return 404, OCR returns 200: only OCR is uploaded."""
 
-        def fake_get_asset_from_url(asset_url, **kwargs):
+        def fake_get(asset_url):
             if asset_url.endswith(".jpg"):
-                return AssetDownloadItem(
-                    url=asset_url, response=MagicMock(status_code=404, content=b"")
-                )
-            return AssetDownloadItem(
-                url=asset_url,
-                response=MagicMock(
-                    status_code=200, content='{"ocr": 1}'.encode("utf-8")
-                ),
-            )
-
-        mock_client = mocker.MagicMock()
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_minio_client",
-            return_value=mock_client,
-        )
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_asset_from_url",
-            fake_get_asset_from_url,
-        )
+                return FakeResponse(404)
+            return FakeResponse(200, '{"ocr": 1}'.encode("utf-8"))
+
+        mock_session(mocker, fake_get)
+        mock_client, uploaded = mock_minio_client(mocker)
         images.upload_new_image_to_s3(
             image_id="1",
             barcode="3270160396337",
@@ -99,8 +143,7 @@ class TestUploadNewImageToS3:
         )
 
         assert mock_client.put_object.call_count == 1
-        calls = mock_client.put_object.call_args_list
-        call = calls[0]
+        call = mock_client.put_object.call_args_list[0]
         assert call.kwargs["bucket_name"] == "openfoodfacts-images"
         assert call.kwargs["object_name"] == "data/327/016/039/6337/1.json.gz"
 
@@ -109,25 +152,13 @@ class TestUploadNewImageToS3:
         """Images return 200, OCR returns 404: 2 images are uploaded, no OCR upload."""
         image_content = b"image"
 
-        def fake_get_asset_from_url(asset_url, **kwargs):
+        def fake_get(asset_url):
             if asset_url.endswith(".json"):
-                return AssetDownloadItem(
-                    url=asset_url, response=MagicMock(status_code=404, content=b"")
-                )
-            return AssetDownloadItem(
-                url=asset_url,
-                response=MagicMock(status_code=200, content=image_content),
-            )
-
-        mock_client = mocker.MagicMock()
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_minio_client",
-            return_value=mock_client,
-        )
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_asset_from_url",
-            fake_get_asset_from_url,
-        )
+                return FakeResponse(404)
+            return FakeResponse(200, image_content)
+
+        mock_session(mocker, fake_get)
+        mock_client, uploaded = mock_minio_client(mocker)
         images.upload_new_image_to_s3(
             image_id="1",
             barcode="3270160396337",
@@ -136,27 +167,21 @@ class TestUploadNewImageToS3:
         )
 
         assert mock_client.put_object.call_count == 2
-        calls = mock_client.put_object.call_args_list
-        assert calls[0].kwargs["object_name"] == "data/327/016/039/6337/1.jpg"
-        assert calls[1].kwargs["object_name"] == "data/327/016/039/6337/1.400.jpg"
+        assert uploaded == {
+            "data/327/016/039/6337/1.jpg": image_content,
+            "data/327/016/039/6337/1.400.jpg": image_content,
+        }
 
     @patch("openfoodfacts_exports.tasks.images.settings.ENABLE_S3_PUSH", True)
-    def test_upload_new_image_to_s3_response_none(self, mocker):
-        """When AssetDownloadItem.response is None (connection error), skip that
+    def test_upload_new_image_to_s3_connection_error(self, mocker):
+        """When the asset cannot be fetched (connection error), skip that
         asset."""
 
-        def fake_get_asset_from_url(asset_url, **kwargs):
-            return AssetDownloadItem(url=asset_url, response=None)
+        def fake_get(asset_url):
+            raise requests.exceptions.ConnectionError()
 
-        mock_client = mocker.MagicMock()
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_minio_client",
-            return_value=mock_client,
-        )
-        mocker.patch(
-            "openfoodfacts_exports.tasks.images.get_asset_from_url",
-            fake_get_asset_from_url,
-        )
+        mock_session(mocker, fake_get)
+        mock_client, _ = mock_minio_client(mocker)
         images.upload_new_image_to_s3(
             image_id="1",
             barcode="3270160396337",
@@ -164,5 +189,22 @@ class TestUploadNewImageToS3:
             environment=Environment.org,
         )
 
-        # No uploads should happen since all responses are None
+        # No uploads should happen since all downloads failed
         mock_client.put_object.assert_not_called()
+
+
+class TestDeleteImageFromS3:
+    @patch("openfoodfacts_exports.tasks.images.settings.ENABLE_S3_PUSH", True)
+    def test_delete_image_from_s3(self, mocker):
+        """The 3 assets are removed with a single multi-object delete request."""
+        mock_client, _ = mock_minio_client(mocker)
+        mock_client.remove_objects.return_value = iter([])
+        images.delete_image_from_s3(image_id="1", barcode="3270160396337")
+        mock_client.remove_objects.assert_called_once()
+        bucket_name, delete_objects = mock_client.remove_objects.call_args.args
+        assert bucket_name == "openfoodfacts-images"
+        assert sorted(obj.name for obj in delete_objects) == [
+            "data/327/016/039/6337/1.400.jpg",
+            "data/327/016/039/6337/1.jpg",
+            "data/327/016/039/6337/1.json.gz",
+        ]
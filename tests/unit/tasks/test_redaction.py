@@ -0,0 +1,76 @@
+import gzip
+from pathlib import Path
+
+import orjson
+import pytest
+
+from openfoodfacts_exports.tasks.redaction import redact_block, redact_jsonl_dump
+from openfoodfacts_exports.tasks.revisions import strip_product_from_user_ids
+
+PRODUCTS = [
+    {
+        "code": str(i),
+        "rev": i,
+        "creator": f"user{i}",
+        "editors_tags": ["user", "other"],
+        "product_name": "Product é",
+        "images": (
+            {"uploaded": {"1": {"uploader": "user", "uploaded_t": i}}}
+            if i % 2
+            else {"1": {"uploader": "user"}, "front_fr": {"imgid": "1"}}
+        ),
+    }
+    for i in range(25)
+] + [{"code": "without_user_id", "nutriments": {"energy": 1}}]
+
+
+def test_redact_block():
+    lines = [orjson.dumps(product) + b"\n" for product in PRODUCTS[:3]]
+    output, count, input_size = redact_block(lines)
+    assert count == 3
+    assert input_size == sum(len(line) for line in lines)
+    assert [orjson.loads(line) for line in output.splitlines()] == [
+        strip_product_from_user_ids(product) for product in PRODUCTS[:3]
+    ]
+
+
+@pytest.mark.parametrize(
+    "input_name,output_name",
+    [
+        ("products.jsonl.gz", "redacted.jsonl.gz"),
+        ("products.jsonl", "redacted.jsonl"),
+    ],
+)
+def test_redact_jsonl_dump(tmp_path: Path, input_name: str, output_name: str):
+    """The output matches a per-product redaction, in the same order."""
+    input_path = tmp_path / input_name
+    output_path = tmp_path / output_name
+    content = b"".join(orjson.dumps(product) + b"\n" for product in PRODUCTS)
+    # Empty lines are skipped
+    content += b"\n"
+    input_path.write_bytes(
+        gzip.compress(content) if input_name.endswith(".gz") else content
+    )
+
+    count = redact_jsonl_dump(input_path, output_path, num_processes=2, block_size=4)
+
+    assert count == len(PRODUCTS)
+    output = output_path.read_bytes()
+    if output_name.endswith(".gz"):
+        output = gzip.decompress(output)
+    assert [orjson.loads(line) for line in output.splitlines()] == [
+        strip_product_from_user_ids(product) for product in PRODUCTS
+    ]
+    # Products without user ID are kept byte for byte
+    assert output.splitlines()[-1] == orjson.dumps(PRODUCTS[-1])
+
+
+def test_redact_jsonl_dump_failure(tmp_path: Path):
+    """The temporary output file is removed if the redaction fails."""
+    input_path = tmp_path / "products.jsonl"
+    output_path = tmp_path / "redacted.jsonl"
+    input_path.write_bytes(orjson.dumps(PRODUCTS[0]) + b'\n{"creator": invalid\n')
+
+    with pytest.raises(orjson.JSONDecodeError):
+        redact_jsonl_dump(input_path, output_path, num_processes=2, block_size=1)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["products.jsonl"]
@@ -0,0 +1,206 @@
+import hashlib
+import pickle
+
+import fakeredis
+import orjson
+from openfoodfacts import APIVersion
+from rq.exceptions import InvalidJobOperation
+from rq.job import JobStatus
+
+from openfoodfacts_exports.tasks import revisions
+from openfoodfacts_exports.tasks.revision_index import (
+    RevisionIndex,
+    RevisionIndexEntry,
+    build_revision_index,
+    merge_revision_index,
+)
+from openfoodfacts_exports.tasks.revision_store import S3RevisionStore
+from openfoodfacts_exports.update_listener import UpdateListener
+
+
+def make_listing(revisions_by_barcode: dict[str, list[int]]):
+    """Return a bucket listing, in S3 (lexicographic) order."""
+    objects = []
+    for barcode, rev_ids in revisions_by_barcode.items():
+        for rev_id in rev_ids:
+            content = f"{barcode}/{rev_id}".encode()
+            objects.append(
+                (
+                    f"v2/{barcode}/{rev_id}.json",
+                    len(content),
+                    f'"{hashlib.md5(content).hexdigest()}"',
+                )
+            )
+        objects.append((f"v2/{barcode}/latest.json", 10, '"etag"'))
+    return sorted(objects)
+
+
+def test_build_revision_index(tmp_path):
+    path = tmp_path / "revisions.idx"
+    index = build_revision_index(
+        path,
+        # "123-1" is listed before "123", although it sorts after it
+        make_listing({"123": [1, 2, 10], "123-1": [1], "456": [1, 3]}),
+    )
+    assert len(index) == 6
+    assert list(index.iter_products()) == [
+        ("123", [1, 2, 10]),
+        ("123-1", [1]),
+        ("456", [1, 3]),
+    ]
+    content = b"123/10"
+    assert index.lookup("123", 10) == RevisionIndexEntry(
+        "123", 10, len(content), hashlib.md5(content).digest()
+    )
+    assert index.lookup("123", 3) is None
+    assert index.lookup("789", 1) is None
+    assert [entry.rev_id for entry in index.get_revisions("456")] == [1, 3]
+    assert index.get_revisions("12") == []
+    assert index.get_latest("123").rev_id == 10  # type: ignore
+    assert index.get_latest("789") is None
+
+
+def test_revision_index_journal(tmp_path):
+    path = tmp_path / "revisions.idx"
+    build_revision_index(path, make_listing({"123": [1, 2], "456": [1]})).close()
+
+    index = RevisionIndex(path)
+    index.add("123", 3, b"content")
+    index.add("234", 1, b"content")
+    # Journal records are visible before the merge, and survive a reopen
+    index = RevisionIndex(path)
+    assert index.lookup("123", 3).size == len(b"content")  # type: ignore
+    assert index.get_latest("123").rev_id == 3  # type: ignore
+    assert [entry.rev_id for entry in index.get_revisions("234")] == [1]
+    assert list(index.iter_products()) == [
+        ("123", [1, 2, 3]),
+        ("234", [1]),
+        ("456", [1]),
+    ]
+
+    index.add("456", 1, b"new content")
+    index.merge()
+    assert not index.journal_path.exists()
+    assert list(index.iter_products()) == [
+        ("123", [1, 2, 3]),
+        ("234", [1]),
+        ("456", [1]),
+    ]
+    # The journal record replaced the existing one
+    assert index.lookup("456", 1).size == len(b"new content")  # type: ignore
+    assert len(index) == 5
+
+
+def test_merge_revision_index(tmp_path):
+    path = tmp_path / "revisions.idx"
+    index = RevisionIndex(path)
+    index.add("123", 1, b"content")
+    index.add("123", 2, b"content")
+    assert index.journal_count == 2
+
+    merge_revision_index(path)
+    assert not index.journal_path.exists()
+    # The index of the update listener reopens the merged index on the next
+    # write
+    index.add("456", 1, b"content")
+    assert index.journal_count == 1
+    assert list(RevisionIndex(path).iter_products()) == [
+        ("123", [1, 2]),
+        ("456", [1]),
+    ]
+
+
+def test_listener_schedules_revision_index_merge(mocker, tmp_path):
+    mocker.patch(
+        "openfoodfacts_exports.update_listener.settings.REVISION_INDEX_MERGE_THRESHOLD",
+        2,
+    )
+    queue = mocker.patch("openfoodfacts_exports.update_listener.low_queue")
+    queue.enqueue.return_value.get_status.return_value = JobStatus.QUEUED
+    index = RevisionIndex(tmp_path / "revisions.idx")
+    listener = UpdateListener(
+        redis_client=fakeredis.FakeRedis(decode_responses=True),
+        redis_latest_id_key="latest_id",
+        revision_index=index,
+    )
+    index.add("123", 1, b"content")
+    listener.schedule_revision_index_merge(index)
+    queue.enqueue.assert_not_called()
+
+    index.add("123", 2, b"content")
+    listener.schedule_revision_index_merge(index)
+    queue.enqueue.assert_called_once_with(
+        merge_revision_index, index.path, job_timeout="1h"
+    )
+    # No new job while the previous one is pending
+    index.add("123", 3, b"content")
+    listener.schedule_revision_index_merge(index)
+    assert queue.enqueue.call_count == 1
+
+    # The job expired from Redis before the journal was merged
+    queue.enqueue.return_value.get_status.side_effect = InvalidJobOperation
+    listener.schedule_revision_index_merge(index)
+    assert queue.enqueue.call_count == 2
+
+
+def test_revision_index_rebuild(tmp_path):
+    path = tmp_path / "revisions.idx"
+    # The index of the update listener
+    index = RevisionIndex(path)
+    index.add("123", 3, b"content")
+    # Revision 3 was uploaded after the bucket was listed
+    build_revision_index(path, make_listing({"123": [1, 2], "456": [1]})).close()
+
+    # The listener reopens the rebuilt index before adding a revision
+    index.add("456", 2, b"content")
+    assert list(index.iter_products()) == [("123", [1, 2, 3]), ("456", [1, 2])]
+    index.merge()
+    assert list(RevisionIndex(path).iter_products()) == [
+        ("123", [1, 2, 3]),
+        ("456", [1, 2]),
+    ]
+
+
+def test_s3_revision_store_pickle(tmp_path):
+    path = tmp_path / "revisions.idx"
+    build_revision_index(path, make_listing({"123": [1, 2]})).close()
+    store = S3RevisionStore(revision_index=RevisionIndex(path))
+    # The index is reopened from its path after unpickling
+    unpickled_store = pickle.loads(pickle.dumps(store))
+    assert list(unpickled_store.iter_products()) == [("123", [1, 2])]
+
+
+def test_upload_revision_updates_index(mocker, tmp_path):
+    index = RevisionIndex(tmp_path / "revisions.idx")
+    product = {"rev": 12, "name": "Test Product"}
+    revisions.upload_revision(
+        mocker.MagicMock(),
+        api_version=APIVersion.v2,
+        barcode="3270160396337",
+        product=product,
+        revision_index=index,
+    )
+    assert index.lookup("3270160396337", 12) == RevisionIndexEntry(
+        "3270160396337",
+        12,
+        len(orjson.dumps(product)),
+        hashlib.md5(orjson.dumps(product)).digest(),
+    )
+
+
+def test_upload_revision_index_failure(mocker, tmp_path):
+    index = RevisionIndex(tmp_path / "revisions.idx")
+    mocker.patch.object(index, "add", side_effect=OSError("disk full"))
+    minio_client = mocker.MagicMock()
+    revisions.upload_revision(
+        minio_client,
+        api_version=APIVersion.v2,
+        barcode="3270160396337",
+        product={"rev": 12, "name": "Test Product"},
+        revision_index=index,
+        set_as_latest=True,
+    )
+    # The revision and latest.json were uploaded before the index update
+    assert [
+        call.kwargs["object_name"] for call in minio_client.put_object.call_args_list
+    ] == ["v2/3270160396337/12.json", "v2/3270160396337/latest.json"]
@@ -0,0 +1,179 @@
+import orjson
+import pytest
+
+from openfoodfacts_exports.tasks.revision_packs import (
+    ENTRY_SIZE,
+    PACK_MAGIC,
+    TRAILER_SIZE,
+    LocalPackSource,
+    PackedRevisionStore,
+    RevisionPackReader,
+    RevisionPackWriter,
+    compact_pack,
+    pack_revisions,
+)
+from openfoodfacts_exports.tasks.revision_store import LocalRevisionStore
+
+
+def write_revisions(root, revisions_by_barcode: dict[str, list[int]]):
+    for barcode, rev_ids in revisions_by_barcode.items():
+        product_dir = root / "v2" / barcode
+        product_dir.mkdir(parents=True, exist_ok=True)
+        for rev_id in rev_ids:
+            (product_dir / f"{rev_id}.json").write_bytes(
+                orjson.dumps({"code": barcode, "rev": rev_id})
+            )
+
+
+def test_pack_revisions(tmp_path):
+    revision_dir = tmp_path / "revisions"
+    pack_dir = tmp_path / "packs"
+    write_revisions(revision_dir, {"1230": [1, 2], "1231": [1], "456": [1, 2, 3]})
+    stats = pack_revisions(LocalRevisionStore(revision_dir), pack_dir)
+    assert stats.packed_revisions == 6
+    assert stats.updated_shards == ["123", "456"]
+
+    # Incremental run: only new revisions are appended
+    write_revisions(revision_dir, {"1230": [3], "789": [1]})
+    stats = pack_revisions(LocalRevisionStore(revision_dir), pack_dir)
+    assert stats.packed_revisions == 2
+    assert stats.updated_shards == ["123", "789"]
+
+    store = PackedRevisionStore(pack_dir)
+    assert list(store.iter_products()) == [
+        ("1230", [1, 2, 3]),
+        ("1231", [1]),
+        ("456", [1, 2, 3]),
+        ("789", [1]),
+    ]
+    assert store.get_revision("1230", 3) == {"code": "1230", "rev": 3}
+    assert store.get_revision("1230", 4) is None
+    assert store.get_revision("000", 1) is None
+
+    reader = RevisionPackReader(LocalPackSource(pack_dir / "packs/v2/123.pack"))
+    assert len(reader) == 4
+    # Small chunks, so that the scan is split into several reads
+    assert sorted(
+        (barcode, rev_id, product["rev"])
+        for barcode, rev_id, product in reader.iter_revisions(chunk_size=20)
+    ) == [("1230", 1, 1), ("1230", 2, 2), ("1230", 3, 3), ("1231", 1, 1)]
+
+
+def test_pack_writer_abort(tmp_path):
+    path = tmp_path / "123.pack"
+    with RevisionPackWriter(path) as writer:
+        assert writer.append("1230", 1, b"{}")
+        assert not writer.append("1230", 1, b"{}")
+        # Barcodes longer than 32 bytes can't be indexed, nothing is written
+        offset = writer._offset
+        assert not writer.append("1230" * 9, 1, b"{}")
+        assert writer._offset == offset == writer._fp.tell()
+    size = path.stat().st_size
+
+    with pytest.raises(RuntimeError):
+        with RevisionPackWriter(path) as writer:
+            writer.append("1230", 2, b"{}")
+            raise RuntimeError()
+    assert path.stat().st_size == size
+    assert list(RevisionPackReader(LocalPackSource(path)).iter_products()) == [
+        ("1230", [1])
+    ]
+
+    # A new pack without revisions is not created
+    with RevisionPackWriter(tmp_path / "456.pack"):
+        pass
+    assert not (tmp_path / "456.pack").exists()
+
+
+@pytest.fixture
+def truncated_pack(tmp_path):
+    """A pack written by two runs, where the second run was killed while
+    writing its index: the pack ends with revisions and a partial index, and
+    no trailer."""
+    path = tmp_path / "123.pack"
+    with RevisionPackWriter(path) as writer:
+        writer.append("1230", 1, b'{"rev": 1}')
+        writer.append("1231", 1, b'{"rev": 1}')
+    valid_size = path.stat().st_size
+    with RevisionPackWriter(path, max_stale_ratio=None) as writer:
+        writer.append("1230", 2, b'{"rev": 2}')
+    path.write_bytes(path.read_bytes()[: -TRAILER_SIZE - ENTRY_SIZE])
+    return path, valid_size
+
+
+def test_pack_writer_recovers_truncated_pack(truncated_pack):
+    path, valid_size = truncated_pack
+    with pytest.raises(ValueError):
+        RevisionPackReader(LocalPackSource(path)).index
+
+    with RevisionPackWriter(path) as writer:
+        # The pack was truncated after the trailer of the first run
+        assert writer._initial_size == valid_size
+        assert ("1230", 2) not in writer
+        assert writer.append("1230", 2, b'{"rev": 2}')
+    reader = RevisionPackReader(LocalPackSource(path))
+    assert list(reader.iter_products()) == [("1230", [1, 2]), ("1231", [1])]
+    assert reader.get_revision("1230", 2) == {"rev": 2}
+
+
+def test_pack_writer_recovers_pack_without_trailer(tmp_path):
+    path = tmp_path / "123.pack"
+    # The first run was killed before writing its index
+    path.write_bytes(PACK_MAGIC + b"revisions")
+    with RevisionPackWriter(path) as writer:
+        assert writer._initial_size == len(PACK_MAGIC)
+        writer.append("1230", 1, b"{}")
+    assert list(RevisionPackReader(LocalPackSource(path)).iter_products()) == [
+        ("1230", [1])
+    ]
+
+    path.write_bytes(b"not a pack")
+    with pytest.raises(ValueError):
+        RevisionPackWriter(path)
+
+
+def test_compact_pack(truncated_pack):
+    path, _ = truncated_pack
+    with RevisionPackWriter(path, max_stale_ratio=None) as writer:
+        writer.append("1230", 2, b'{"rev": 2}')
+    with RevisionPackWriter(path, max_stale_ratio=None) as writer:
+        writer.append("1231", 2, b'{"rev": 2}')
+        # The indexes and trailers of the first two runs
+        stale_size = 5 * ENTRY_SIZE + 2 * TRAILER_SIZE
+        assert writer.stale_size == stale_size
+    size = path.stat().st_size
+
+    compact_pack(path)
+    assert path.stat().st_size == size - stale_size
+    assert list(path.parent.iterdir()) == [path]
+    reader = RevisionPackReader(LocalPackSource(path))
+    assert list(reader.iter_products()) == [("1230", [1, 2]), ("1231", [1, 2])]
+    assert [
+        (barcode, rev_id, product)
+        for barcode, rev_id, product in reader.iter_revisions()
+    ] == [
+        ("1230", 1, {"rev": 1}),
+        ("1230", 2, {"rev": 2}),
+        ("1231", 1, {"rev": 1}),
+        ("1231", 2, {"rev": 2}),
+    ]
+    with RevisionPackWriter(path) as writer:
+        # Only the index of the compacted pack
+        assert writer.stale_size == 4 * ENTRY_SIZE + TRAILER_SIZE
+
+
+def test_pack_writer_compacts_pack(tmp_path):
+    path = tmp_path / "123.pack"
+    for rev_id in range(1, 3):
+        with RevisionPackWriter(path, max_stale_ratio=None) as writer:
+            writer.append("1230", rev_id, b"{}")
+    with RevisionPackWriter(path, max_stale_ratio=0.4) as writer:
+        writer.append("1230", 3, b"{}")
+        # The indexes of the first two runs are more than 40% of the pack
+        # once the third index is written
+        assert writer.stale_size == 3 * ENTRY_SIZE + 2 * TRAILER_SIZE
+    with RevisionPackWriter(path) as writer:
+        assert writer.stale_size == 3 * ENTRY_SIZE + TRAILER_SIZE
+    assert list(RevisionPackReader(LocalPackSource(path)).iter_products()) == [
+        ("1230", [1, 2, 3])
+    ]
@@ -1,9 +1,11 @@
+import copy
 import json
 
 import orjson
 from openfoodfacts import APIVersion
 
 from openfoodfacts_exports.tasks import revisions
+from openfoodfacts_exports.tasks.deletion import BatchDeleter
 from openfoodfacts_exports.tasks.revisions import strip_product_from_user_ids
 
 
@@ -145,3 +147,123 @@ def test_strip_product_from_user_ids():
             },
         },
     }
+
+
+class TestDeleteProductFromS3:
+    _BARCODE = "3270160396337"
+
+    def test_delete_latest_revision(self, mocker):
+        mock_client = mocker.MagicMock()
+        mock_client.remove_objects.return_value = iter([])
+        mocker.patch(
+            "openfoodfacts_exports.tasks.revisions.get_minio_client",
+            return_value=mock_client,
+        )
+        revisions.delete_product_from_s3(self._BARCODE)
+        mock_client.list_objects.assert_not_called()
+        bucket_name, delete_objects = mock_client.remove_objects.call_args.args
+        assert bucket_name == "openfoodfacts-product-revisions"
+        assert [obj.name for obj in delete_objects] == [
+            f"v2/{self._BARCODE}/latest.json"
+        ]
+
+    def test_delete_is_not_buffered(self, mocker):
+        # A buffered deletion of latest.json could remove the revision
+        # uploaded by a later update of the product
+        mock_client = mocker.MagicMock()
+        mock_client.remove_objects.return_value = iter([])
+        mocker.patch(
+            "openfoodfacts_exports.tasks.revisions.get_minio_client",
+            return_value=mock_client,
+        )
+        deleter = BatchDeleter(mock_client, window=60)
+        revisions.delete_product_from_s3(self._BARCODE, deleter=deleter)
+        mock_client.remove_objects.assert_called_once()
+        assert deleter.pending_count == 0
+
+    def test_purge_revisions(self, mocker):
+        mock_client = mocker.MagicMock()
+        mock_client.remove_objects.return_value = iter([])
+        mock_client.list_objects.return_value = [
+            mocker.MagicMock(object_name=f"v2/{self._BARCODE}/{name}")
+            for name in ("1.json", "2.json", "latest.json")
+        ]
+        mocker.patch(
+            "openfoodfacts_exports.tasks.revisions.get_minio_client",
+            return_value=mock_client,
+        )
+        revisions.delete_product_from_s3(self._BARCODE, purge_revisions=True)
+        mock_client.list_objects.assert_called_once_with(
+            "openfoodfacts-product-revisions",
+            prefix=f"v2/{self._BARCODE}/",
+            recursive=True,
+        )
+        _, delete_objects = mock_client.remove_objects.call_args.args
+        assert [obj.name for obj in delete_objects] == [
+            f"v2/{self._BARCODE}/1.json",
+            f"v2/{self._BARCODE}/2.json",
+            f"v2/{self._BARCODE}/latest.json",
+        ]
+
+
+def test_strip_product_from_user_ids_does_not_mutate_input():
+    product = {
+        "code": "3245968594852",
+        "creator": "user",
+        "nutriments": {"energy": 42},
+        "images": {
+            "uploaded": {
+                "1": {"uploader": "user", "uploaded_t": 1520424046},
+                "2": {"uploaded_t": 1520424047},
+            },
+            "selected": {"front": {"de": {"imgid": 1, "rev": 11}}},
+        },
+    }
+    expected_input = copy.deepcopy(product)
+    stripped = strip_product_from_user_ids(product)
+
+    assert product == expected_input
+    assert stripped == {
+        "code": "3245968594852",
+        "nutriments": {"energy": 42},
+        "images": {
+            "uploaded": {
+                "1": {"uploaded_t": 1520424046},
+                "2": {"uploaded_t": 1520424047},
+            },
+            "selected": {"front": {"de": {"imgid": 1, "rev": 11}}},
+        },
+    }
+    # Unchanged sub-structures are shared with the input
+    assert stripped["nutriments"] is product["nutriments"]
+    assert stripped["images"]["selected"] is product["images"]["selected"]
+    assert stripped["images"]["uploaded"]["2"] is product["images"]["uploaded"]["2"]
+
+
+def test_strip_product_from_user_ids_without_user_id():
+    product = {"code": "3245968594852", "images": {"1": {"uploaded_t": 1}}}
+    assert strip_product_from_user_ids(product) is product
+
+
+def test_compile_redaction_trie():
+    trie = revisions.compile_redaction_trie(
+        [("a",), ("b", "*", "c"), ("b", "d", "*", "c")]
+    )
+    assert trie == {
+        "a": None,
+        "b": {
+            "*": {"c": None},
+            "d": {"*": {"c": None}, "c": None},
+        },
+    }
+
+
+def test_strip_product_json_from_user_ids():
+    product = {"code": "1", "creator": "user", "images": {"1": {"uploader": "u"}}}
+    assert orjson.loads(
+        revisions.strip_product_json_from_user_ids(orjson.dumps(product))
+    ) == {"code": "1", "images": {"1": {}}}
+
+    # JSON without user ID is returned as is
+    product_json = orjson.dumps({"code": "1", "images": {"1": {"rev": 1}}})
+    assert revisions.strip_product_json_from_user_ids(product_json) is product_json
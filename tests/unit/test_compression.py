@@ -0,0 +1,48 @@
+import gzip
+from pathlib import Path
+
+import pytest
+
+from openfoodfacts_exports.compression import (
+    ParallelCompressedWriter,
+    get_block_compressor,
+)
+
+
+def test_parallel_compressed_writer(tmp_path: Path):
+    """Blocks are written in order, as a valid multi-member gzip file."""
+    output_path = tmp_path / "output.jsonl.gz"
+    lines = [f'{{"id": {i}}}\n'.encode() for i in range(1000)]
+
+    with ParallelCompressedWriter(
+        output_path, level=1, block_size=100, num_threads=4
+    ) as writer:
+        for line in lines:
+            writer.write(line)
+
+    content = output_path.read_bytes()
+    assert gzip.decompress(content) == b"".join(lines)
+    # One gzip member per block of ~100 bytes
+    assert content.count(b"\x1f\x8b\x08") > 100
+    assert writer.uncompressed_size == sum(len(line) for line in lines)
+    assert writer.compressed_size == len(content)
+
+
+def test_parallel_compressed_writer_empty(tmp_path: Path):
+    output_path = tmp_path / "output.jsonl.gz"
+    with ParallelCompressedWriter(output_path):
+        pass
+    assert gzip.decompress(output_path.read_bytes()) == b""
+
+
+def test_get_block_compressor_unknown_compression():
+    with pytest.raises(ValueError, match="Unsupported compression"):
+        get_block_compressor("bz2")  # type: ignore[arg-type]
+
+
+def test_get_block_compressor_default_level():
+    # Same level as `gzip.open`, used by the previous event dump writer
+    data = b'{"id": 1}\n' * 1000
+    assert get_block_compressor("gzip")(data) == gzip.compress(
+        data, compresslevel=9, mtime=0
+    )
@@ -0,0 +1,157 @@
+import threading
+import time
+
+import fakeredis
+from rq import Queue, get_current_job
+from rq.job import JobStatus
+
+from openfoodfacts_exports.workers import admission
+from openfoodfacts_exports.workers.admission import (
+    JobBudget,
+    JobRun,
+    ResourceSemaphore,
+    estimate_budget,
+    record_job_run,
+)
+from openfoodfacts_exports.workers.pool import (
+    AdmissionControlledWorker,
+    AdmissionMixin,
+    ThreadWorker,
+)
+
+CAPACITY_MB = 7168
+
+
+def test_estimate_budget():
+    connection = fakeredis.FakeRedis()
+    assert estimate_budget(
+        connection, "export", 1000, default_memory_mb=4096
+    ) == JobBudget(memory_mb=4096, cpus=1.0)
+
+    record_job_run(
+        connection,
+        "export",
+        JobRun(input_size=1000, peak_rss_mb=1000, cpu_time=200, wall_time=100),
+    )
+    record_job_run(
+        connection,
+        "export",
+        JobRun(input_size=2000, peak_rss_mb=1500, cpu_time=100, wall_time=100),
+    )
+    # Largest scaled peak RSS (1000 MB for 1000 bytes), with a 20% margin
+    assert estimate_budget(connection, "export", 2000) == JobBudget(
+        memory_mb=2400, cpus=2.0
+    )
+
+
+def test_resource_semaphore():
+    semaphore = ResourceSemaphore(fakeredis.FakeRedis(), memory_mb=1000, cpus=2)
+    # A job alone is always admitted, even above the capacity
+    assert semaphore.try_acquire("1", JobBudget(memory_mb=1500), ttl=60)
+    assert not semaphore.try_acquire("2", JobBudget(memory_mb=100), ttl=60)
+    semaphore.release("1")
+    assert semaphore.try_acquire("2", JobBudget(memory_mb=600), ttl=60)
+    assert not semaphore.try_acquire("3", JobBudget(memory_mb=500), ttl=60)
+    assert semaphore.try_acquire("3", JobBudget(memory_mb=400), ttl=60)
+    # Not enough CPUs left
+    assert not semaphore.try_acquire("4", JobBudget(memory_mb=0, cpus=1), ttl=60)
+    assert semaphore.get_usage() == JobBudget(memory_mb=1000, cpus=2.0)
+    semaphore.release("2")
+    semaphore.release("3")
+    assert semaphore.get_usage() == JobBudget(memory_mb=0, cpus=0)
+
+    # Expired reservations are ignored
+    assert semaphore.try_acquire("5", JobBudget(memory_mb=1000), ttl=-1)
+    assert semaphore.try_acquire("6", JobBudget(memory_mb=1000), ttl=60)
+    assert list(semaphore.get_reservations()) == ["6"]
+
+
+def simulated_export(duration: float) -> None:
+    job = get_current_job()
+    assert job is not None
+    usage = ResourceSemaphore(job.connection).get_usage()
+    job.connection.rpush("simulation:memory_usage", usage.memory_mb)
+    time.sleep(duration)
+
+
+class AdmissionThreadWorker(AdmissionMixin, ThreadWorker):
+    """Admission control in thread workers, as fakeredis can't be shared with
+    forked work horses."""
+
+    def get_semaphore(self):
+        return ResourceSemaphore(self.connection, memory_mb=CAPACITY_MB, cpus=4)
+
+
+def test_admission_deferral(mocker):
+    connection = fakeredis.FakeRedis()
+    queue = Queue("off-exports-cpu", connection=connection)
+    ResourceSemaphore(connection, memory_mb=CAPACITY_MB).try_acquire(
+        "other", JobBudget(memory_mb=5000), ttl=60
+    )
+    job = queue.enqueue(
+        simulated_export, 0, meta={"budget": {"memory_mb": 3000, "cpus": 1}}
+    )
+    # The job is deferred before a work horse is forked
+    worker = AdmissionControlledWorker(queues=[queue], connection=connection)
+    worker.work(burst=True)
+
+    job.refresh()
+    assert job.get_status() == JobStatus.SCHEDULED
+    assert job.meta["admission_attempts"] == 1
+    assert job.id in queue.scheduled_job_registry
+    assert queue.intermediate_queue.get_job_ids() == []
+
+
+def test_admission_simulation(mocker):
+    """Simulate the nightly exports on 4 workers sharing 7 GB: without
+    admission control, the jobs would use up to 11.5 GB."""
+    mocker.patch.object(admission, "RETRY_BASE_DELAY", 0.1)
+    connection = fakeredis.FakeRedis()
+    queue = Queue("off-exports-cpu", connection=connection)
+    budgets = {"off": 5000, "obf": 2500, "op": 3000, "opf": 500, "opff": 500}
+    jobs = [
+        queue.enqueue(
+            simulated_export,
+            0.3,
+            meta={"budget": {"memory_mb": memory_mb, "cpus": 1}},
+            job_id=name,
+        )
+        for name, memory_mb in budgets.items()
+    ]
+    stop_event = threading.Event()
+
+    def run_worker():
+        worker = AdmissionThreadWorker(queues=[queue], connection=connection)
+        # Burst mode avoids blocking dequeues, that fakeredis does not
+        # support well from several threads
+        while not stop_event.is_set():
+            worker.work(burst=True)
+            time.sleep(0.05)
+
+    threads = [threading.Thread(target=run_worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+
+    deadline = time.monotonic() + 30
+    try:
+        while time.monotonic() < deadline and not all(
+            job.get_status(refresh=True) == JobStatus.FINISHED for job in jobs
+        ):
+            # Requeue the deferred jobs, as the rq scheduler does
+            for job_id in queue.scheduled_job_registry.get_jobs_to_schedule():
+                queue.scheduled_job_registry.requeue(job_id)
+            time.sleep(0.05)
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+    for job in jobs:
+        job.refresh()
+    assert all(job.get_status() == JobStatus.FINISHED for job in jobs)
+    memory_usage = [int(x) for x in connection.lrange("simulation:memory_usage", 0, -1)]
+    assert len(memory_usage) == len(jobs)
+    assert max(memory_usage) <= CAPACITY_MB
+    # Some jobs had to wait
+    assert any(job.meta.get("admission_attempts") for job in jobs)
+    assert ResourceSemaphore(connection).get_reservations() == {}
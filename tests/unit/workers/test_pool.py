@@ -0,0 +1,63 @@
+import fakeredis
+from rq import Queue
+from rq.job import JobStatus
+
+from openfoodfacts_exports.workers import pool
+from openfoodfacts_exports.workers.pool import ThreadWorker, run_thread_workers
+
+
+def busy_loop(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+def failing_job() -> None:
+    raise ValueError("failure")
+
+
+def test_thread_worker_records_resources():
+    connection = fakeredis.FakeRedis()
+    queue = Queue("off-exports-high", connection=connection)
+    job = queue.enqueue(busy_loop, 1_000_000)
+    failed_job = queue.enqueue(failing_job)
+    worker = ThreadWorker(queues=[queue], connection=connection)
+    worker.work(burst=True)
+
+    job.refresh()
+    assert job.get_status() == JobStatus.FINISHED
+    assert job.return_value() == busy_loop(1_000_000)
+    assert job.meta["cpu_time"] > 0
+    assert job.meta["peak_rss_mb"] > 0
+    # Resources are also recorded for failed jobs
+    failed_job.refresh()
+    assert failed_job.get_status() == JobStatus.FAILED
+    assert "cpu_time" in failed_job.meta
+
+
+def test_run_thread_workers():
+    connection = fakeredis.FakeRedis()
+    queues = [
+        Queue("off-exports-high", connection=connection),
+        Queue("off-exports-low", connection=connection),
+    ]
+    jobs = [queue.enqueue(busy_loop, 1000) for queue in queues for _ in range(4)]
+    run_thread_workers(
+        [queue.name for queue in queues],
+        num_threads=3,
+        burst=True,
+        connection=connection,
+    )
+    for job in jobs:
+        job.refresh()
+        assert job.get_status() == JobStatus.FINISHED
+        assert "cpu_time" in job.meta
+
+
+def test_get_cpu_pool_size(mocker):
+    mocker.patch("os.sched_getaffinity", return_value=set(range(8)))
+    mocker.patch.object(pool, "get_available_memory_mb", return_value=16 * 1024)
+    # Memory-bound
+    assert pool.get_cpu_pool_size(memory_per_job_mb=4096) == 4
+    # CPU-bound
+    assert pool.get_cpu_pool_size(memory_per_job_mb=1024) == 8
+    # At least one worker
+    assert pool.get_cpu_pool_size(memory_per_job_mb=32 * 1024) == 1